@@ -0,0 +1,111 @@
+from pathlib import Path
+import os
+import sys
+import platform
+import argparse
+import tempfile
+import ujson
+import constants
+import precompute
+import find_conflicts
+import instrumentation
+from generate_repository import generate_repository
+
+# Benchmarks every stage of the analysis on a generated repository.
+# The repository and all files written by the analysis live in a temporary directory, so that nothing is cached
+# between runs. With the same parameters, the generated repository and thereby the counts are the same on every run.
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="benchmark the analysis on a generated repository")
+    parser.add_argument("--files", type=int, default=100, help="number of generated headers")
+    parser.add_argument("--units-per-file", type=int, default=10)
+    parser.add_argument("--include-fan-out", type=int, default=3,
+                        help="maximal number of other headers every header includes")
+    parser.add_argument("--call-density", type=float, default=0.2,
+                        help="probability of a function calling a function of an included header")
+    parser.add_argument("--branches", type=int, default=4)
+    parser.add_argument("--changed-files-per-branch", type=int, default=5)
+    parser.add_argument("--changed-units-per-file", type=int, default=2)
+    parser.add_argument("--overlap", type=float, default=0.5,
+                        help="share of the changed files of a branch, that are also changed by other branches")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=constants.PREPROCESSING_WORKERS)
+    parser.add_argument("--extractor", choices=[constants.EXTRACTOR_SRCML, constants.EXTRACTOR_TOKENIZER],
+                        default=constants.EXTRACTOR)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the peak of python allocations of every stage, slows down all stages")
+    parser.add_argument("--quiet", action="store_true", help="hide the progress bars")
+    parser.add_argument("--output", type=Path, default=Path("benchmark.json"))
+    return parser.parse_args()
+
+
+def run_benchmark(arguments):
+    instrumentation.trace_memory = arguments.trace_memory
+    constants.EXTRACTOR = arguments.extractor
+    if arguments.quiet:
+        constants.PROGRESS_BARS = False
+    previous_path = Path.cwd()
+    with tempfile.TemporaryDirectory() as work_path:
+        work_path = Path(work_path)
+        src_path = work_path / "repository"
+        master, branches = generate_repository(src_path, files=arguments.files,
+                                               units_per_file=arguments.units_per_file,
+                                               include_fan_out=arguments.include_fan_out,
+                                               call_density=arguments.call_density,
+                                               branch_count=arguments.branches,
+                                               changed_files_per_branch=arguments.changed_files_per_branch,
+                                               changed_units_per_file=arguments.changed_units_per_file,
+                                               overlap=arguments.overlap,
+                                               seed=arguments.seed)
+        (work_path / "output").mkdir()
+        os.chdir(str(work_path / "output"))
+        try:
+            with instrumentation.stage("parse_source_code"):
+                precompute.parse_source_code(src_path, None, arguments.workers)
+            with instrumentation.stage("build_call_graph"):
+                called_by_graph, id_to_named_unit, named_unit_to_id = precompute.build_call_graph(False)
+            with instrumentation.stage("find_changes"):
+                branch_changed_units = find_conflicts.find_changes(src_path, branches)
+            unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids = \
+                find_conflicts.map_changed_units(branches, branch_changed_units, named_unit_to_id)
+            with instrumentation.stage("find_callers"):
+                callers, caller_paths, incidence = find_conflicts.find_callers(called_by_graph, changed_ids)
+            with instrumentation.stage("examine_pairs"):
+                potential_conflicts = find_conflicts.examine_pairs(unit_id_to_branch_revision,
+                                                                   branch_revision_to_unit_id, changed_ids, callers,
+                                                                   caller_paths, incidence, id_to_named_unit)
+            with instrumentation.stage("save_potential_conflicts"):
+                find_conflicts.save_potential_conflicts(potential_conflicts)
+        finally:
+            os.chdir(str(previous_path))
+
+    return {"parameters": {key: str(value) if isinstance(value, Path) else value
+                           for key, value in vars(arguments).items()},
+            "environment": {"python": platform.python_version(),
+                            "platform": platform.platform(),
+                            "cpu_count": os.cpu_count()},
+            **instrumentation.metrics()}
+
+
+def main():
+    arguments = parse_arguments()
+    result = run_benchmark(arguments)
+    with arguments.output.open("w") as fp:
+        ujson.dump(result, fp, indent=4, sort_keys=True)
+
+    print("{:<26}{:>10}{:>10}{:>12}{:>14}".format("stage", "wall [s]", "cpu [s]", "child [s]", "max rss [MB]"),
+          file=sys.stderr)
+    for stage in result["stages"]:
+        # the peak of the stage is unknown where it can not be reset
+        max_rss = "-" if stage["max_rss_bytes"] is None else "{:.1f}".format(stage["max_rss_bytes"] / 1024 ** 2)
+        print("{:<26}{:>10.3f}{:>10.3f}{:>12.3f}{:>14}".format(stage["stage"], stage["wall_seconds"],
+                                                               stage["cpu_seconds"], stage["child_cpu_seconds"],
+                                                               max_rss),
+              file=sys.stderr)
+    for count in result["counts"]:
+        print("{} {}: {}".format(count["name"], ", ".join(count["labels"].values()), count["value"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+from pathlib import Path
+import subprocess as sp
+import constants
+import git_objects
+import save_and_load as io
+
+
+def is_source_file(rel_path):
+    return Path(rel_path).suffix[1:] in constants.VALID_FILE_EXTENSIONS
+
+
+def run_git(src_path, *arguments, stdin=None):
+    return sp.check_output([*constants.GIT_CALL, str(src_path.resolve()), *arguments], input=stdin)
+
+
+def split_null_separated(output):
+    return [entry for entry in str(output, 'utf-8').split("\0") if entry]
+
+
+# Find the blob hash of every source file in the working tree.
+# Files that differ from the index, are unmerged or untracked are hashed by git hash-object.
+def get_worktree_blobs(src_path):
+    blobs = {}
+    rehash = set([])
+    for entry in split_null_separated(run_git(src_path, "ls-files", "--stage", "-z")):
+        info, rel_path = entry.split("\t", 1)
+        if not is_source_file(rel_path):
+            continue
+        _, blob, stage = info.split()
+        if stage == "0":
+            blobs[rel_path] = blob
+        else:
+            rehash.add(rel_path)
+
+    for rel_path in split_null_separated(
+            run_git(src_path, "ls-files", "--modified", "--others", "--exclude-standard", "-z")):
+        if is_source_file(rel_path):
+            rehash.add(rel_path)
+
+    for rel_path in rehash:
+        blobs.pop(rel_path, None)
+    # hash-object reads one path per line
+    rehash = sorted(rel_path for rel_path in rehash if "\n" not in rel_path and (src_path / rel_path).is_file())
+    if rehash:
+        output = run_git(src_path, "hash-object", "--stdin-paths", stdin="\n".join(rehash).encode("utf-8"))
+        blobs.update(zip(rehash, str(output, 'utf-8').split()))
+    return blobs
+
+
+# Find the blob hash of every source file in a revision. The mapping is cached per commit.
+def get_revision_blobs(src_path, revision):
+    commit = git_objects.git_channel(src_path).resolve(revision)
+    blobs = io.load_revision_blobs(commit)
+    if blobs is None:
+        blobs = {}
+        for entry in split_null_separated(run_git(src_path, "ls-tree", "-r", "-z", commit)):
+            info, rel_path = entry.split("\t", 1)
+            _, object_type, blob = info.split()
+            if object_type == "blob" and is_source_file(rel_path):
+                blobs[rel_path] = blob
+        io.save_revision_blobs(commit, blobs)
+    return blobs
+
+
+# Preprocessed properties are cached without the path of the file itself, which every file includes,
+# so that identical files at different paths share one entry.
+def blob_properties(rel_path, properties):
+    return {constants.INCLUDES: properties[constants.INCLUDES] - {rel_path},
+            constants.CALLS_NAIVE: properties[constants.CALLS_NAIVE]}
+
+
+def path_properties(rel_path, properties):
+    return {constants.INCLUDES: properties[constants.INCLUDES] | {rel_path},
+            constants.CALLS_NAIVE: properties[constants.CALLS_NAIVE]}
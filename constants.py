@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 
@@ -13,7 +14,23 @@ TAGS = {"unit": "{http://www.srcML.org/srcML/src}unit",
         "typename": "{http://www.srcML.org/srcML/src}typename",
         "comment": "{http://www.srcML.org/srcML/src}comment",
         "block": "{http://www.srcML.org/srcML/src}block",
-        "position": "{http://www.srcML.org/srcML/position}position"}
+        "position": "{http://www.srcML.org/srcML/position}position",
+        "file": "{http://www.srcML.org/srcML/cpp}file",
+        "function": "{http://www.srcML.org/srcML/src}function",
+        "function_decl": "{http://www.srcML.org/srcML/src}function_decl",
+        "class": "{http://www.srcML.org/srcML/src}class",
+        "class_decl": "{http://www.srcML.org/srcML/src}class_decl",
+        "template": "{http://www.srcML.org/srcML/src}template",
+        "macro": "{http://www.srcML.org/srcML/src}macro",
+        "decl": "{http://www.srcML.org/srcML/src}decl",
+        "decl_stmt": "{http://www.srcML.org/srcML/src}decl_stmt",
+        "namespace": "{http://www.srcML.org/srcML/src}namespace",
+        "call": "{http://www.srcML.org/srcML/src}call",
+        "type": "{http://www.srcML.org/srcML/src}type"}
+
+POSITION_ATTRIBUTES = {"line": "{http://www.srcML.org/srcML/position}line",
+                       "start": "{http://www.srcML.org/srcML/position}start",
+                       "end": "{http://www.srcML.org/srcML/position}end"}
 
 ns = {"cpp": "http://www.srcML.org/srcML/cpp",
       "src": "http://www.srcML.org/srcML/src",
@@ -36,6 +53,11 @@ NAMED_UNIT_QUERY = "self::src:constructor or " \
                    "self::src:decl[parent::src:decl_stmt[parent::src:block[parent::src:namespace]]]"
 
 
+# named units that need no further condition, the streaming extraction checks the other parts of the query by hand
+UNCONDITIONAL_NAMED_UNIT_TAGS = set(["{http://www.srcML.org/srcML/src}" + tag for tag in
+                                     ["constructor", "constructor_decl", "destructor", "destructor_decl", "struct",
+                                      "struct_decl", "enum", "typedef", "union"]])
+
 NAMED_UNIT_NAME_QUERY = "./src:name[1]"
 
 CALLING_UNIT_QUERY = "self::src:call or" \
@@ -49,17 +71,84 @@ DUMP_FILE = "preprocessed_files.xml"
 DUMP_FOLDER_JSON = Path("preprocessed_files/json/")
 DUMP_PATH_LIST = Path("preprocessed_files_paths.json")
 LAST_SCANNED_REVISION = Path("preprocessed_files/last_scanned_revision.txt")
+# taken by merge checks and follow_master.py while they update the preprocessed files and the call graph
+ANALYSIS_LOCK = Path("preprocessed_files/analysis.lock")
+# the preprocessed files are stored either as one json file per source file or in a single sqlite database
+STORAGE_JSON = "json"
+STORAGE_SQLITE = "sqlite"
+STORAGE_BACKEND = STORAGE_SQLITE
+DUMP_DATABASE = Path("preprocessed_files/preprocessed_files.sqlite")
+# Reuse preprocessed files and the named unit spans of changed file versions by the hash of their git blob.
+# The cache is stored in DUMP_DATABASE.
+BLOB_CACHE = True
+# size in bytes the cached blobs may take, before blobs no longer referenced by any path or revision are evicted
+BLOB_CACHE_MAX_SIZE = 4 * 1024 ** 3
+# number of revisions, whose path to blob mapping is kept
+BLOB_CACHE_REVISIONS = 16
 
 SRCML_BASE_CALL = ["srcml"]
 SRCML_POSITION = "--position"
+SRCML_ARCHIVE = "--archive"
+SRCML_TIMEOUT = 60
+# number of files passed to a single srcml call and the time the whole batch may take
+SRCML_BATCH_SIZE = 64
+SRCML_BATCH_TIMEOUT = 600
+# extract from the srcml output while it is being parsed, instead of building the whole tree first
+STREAMING_EXTRACTION = False
+# Extract includes and named units with srcml or with an in-process tokenizer, which is much faster but less precise,
+# set by --extractor. With the blob cache, files are parsed again when the extractor changes, without it the
+# preprocessed files of both are not told apart and every extractor needs its own working directory.
+EXTRACTOR_SRCML = "srcml"
+EXTRACTOR_TOKENIZER = "tokenizer"
+EXTRACTOR = EXTRACTOR_SRCML
+# extract files, that srcml fails on or times out on, with the tokenizer instead of dropping them
+TOKENIZER_FALLBACK = True
 GIT_CALL = ["git", "-C"]
+# number of (master, branch) diffs kept by the long running git processes of a repository
+GIT_CACHED_DIFFS = 1024
+# Analyse without checking out any revision in the working tree of the repository.
+# The merge is performed in a throwaway worktree. Changed files of the branches are always read from git objects.
+CHECKOUT_FREE = False
 INPUT_LINE_NUMBER_SEPARATOR = ","
 
+# Directory of the uncompressed indptr and indices arrays of the called_by_graph, which are memory mapped on load.
+# The call graph is not stored, it is the transpose of the called_by_graph.
+CALLED_BY_GRAPH = Path("called_by_graph")
+# directory of the memory mapped table of the named units and their IDs
+SYMBOL_TABLE = Path("symbol_table")
+CALL_GRAPH_FILES = "call_graph_files.json"
+# only rebuild the call graph of changed files and the files including them
+INCREMENTAL_CALL_GRAPH = True
+# fraction of the IDs of the call graph, that may belong to no named unit, before an incremental build renumbers them
+CALL_GRAPH_MAX_UNUSED_IDS = 0.25
+
+# Write potential conflicts as NDJSON while they are found instead of sorting all of them in memory,
+# enabled by --stream. The summary keeps the ranking, the conflicting branches
+# and the given number of closest conflicts.
+STREAMING_OUTPUT = False
+TOP_POTENTIAL_CONFLICTS = 1000
+# Only search for this number of closest potential conflicts and stop the search after the given number of seconds,
+# set by --top and --time-budget. None searches for all conflicts without a time limit.
+TOP_CONFLICTS = None
+TIME_BUDGET = None
+# show progress bars, disabled by --quiet
+PROGRESS_BARS = True
+
 OUT_OF_DATE = True
 MAX_TRANSITIVE_INCLUDE_LEVEL = 1
+# number of files whose include closure is computed at once
+INCLUDE_BLOCK_SIZE = 4096
+# number of processes used to preprocess the source files, 1 disables the process pool
+PREPROCESSING_WORKERS = os.cpu_count() or 1
 
 CHANGES = "_changes.txt"
 
 MAX_PATH_LENGTH = 1
-MAX_FILE_CHANGES = 500
+# number of changed units, whose candidate pairs are computed at once
+PAIR_BLOCK_SIZE = 1024
 BRANCH_SEPARATOR = "-"
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+# number of query results the server keeps
+SERVER_CACHED_RESULTS = 64
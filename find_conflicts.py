@@ -1,150 +1,193 @@
 from pathlib import Path
 import sys
 import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import subprocess as sp
 import lxml.etree as etree
-from scipy.sparse import csgraph, load_npz
+from scipy.sparse import csgraph, csr_matrix
 import ujson
 import numpy as np
 import precompute
-import itertools
+import reachability
 from tqdm import tqdm
 import constants
 import save_and_load as io
+import blob_cache
+import git_objects
+import instrumentation
+import tokenizer
 from operator import itemgetter
-import re
+from bisect import bisect_left
+import heapq
+
+
+# options of the command line, some entry points only accept a part of them
+OPTIONS = ["--quiet", "--stream", "--extractor", "--top", "--time-budget", "--metrics"]
+
+
+# Apply the options among the arguments to constants, options not in accepted exit.
+# Returns the other arguments and the path given by --metrics, None without it.
+def parse_options(arguments, accepted=OPTIONS):
+    metrics_path = None
+    for option in [argument for argument in arguments if argument.startswith("--")]:
+        if option.split("=", 1)[0] not in accepted:
+            sys.exit("unknown option {}".format(option))
+        if option == "--quiet":
+            constants.PROGRESS_BARS = False
+        elif option == "--stream":
+            constants.STREAMING_OUTPUT = True
+        elif option.startswith("--top="):
+            constants.TOP_CONFLICTS = int(option[len("--top="):])
+        elif option.startswith("--time-budget="):
+            constants.TIME_BUDGET = float(option[len("--time-budget="):])
+        elif option.startswith("--extractor="):
+            constants.EXTRACTOR = option[len("--extractor="):]
+            if constants.EXTRACTOR not in (constants.EXTRACTOR_SRCML, constants.EXTRACTOR_TOKENIZER):
+                sys.exit("unknown extractor {}".format(constants.EXTRACTOR))
+        elif option.startswith("--metrics="):
+            metrics_path = Path(option[len("--metrics="):])
+        else:
+            sys.exit("unknown option {}".format(option))
+    return [argument for argument in arguments if not argument.startswith("--")], metrics_path
 
 
 def parse_input():
-    # expect input in the format PATH_TO_SOURCE_FOLDER CURRENT_MASTER_REVISION BRANCH_REVISION-REQUESTED_MASTER_REVISION
-    src_path = Path(sys.argv[1]).resolve()
-    master = sys.argv[2]
-    branches = [branch.split(constants.BRANCH_SEPARATOR) for branch in sys.argv[3:]]
-    return src_path, master, branches
-
-
-def get_changed_files(src_path):
+    # expect input in the format PATH_TO_SOURCE_FOLDER CURRENT_MASTER_REVISION REQUESTED_MASTER_REVISION-BRANCH_REVISION
+    # optionally preceded by --quiet to hide the progress bars, --stream to write the conflicts while they are found,
+    # --extractor=tokenizer to extract the source code without srcml,
+    # --top=K and --time-budget=SECONDS to only search for the K closest conflicts within the given time
+    # and --metrics=PATH to save the metrics of the run, as json or in the text format of prometheus for paths ending
+    # in .prom
+    arguments, metrics_path = parse_options(sys.argv[1:])
+    src_path = Path(arguments[0]).resolve()
+    master = arguments[1]
+    branches = [branch.split(constants.BRANCH_SEPARATOR) for branch in arguments[2:]]
+    return src_path, master, branches, metrics_path
+
+
+# Find the source files of the working tree changed since the last scan, None if there has been none.
+# If master has been scanned last, the given files changed by the merge compared to master are reused.
+def get_changed_files(src_path, master=None, dirty_files=None):
     last_scanned = io.load_last_scanned_revision()
     if last_scanned is None:
         return None
-    changed_files = set([])
-    output = sp.check_output([*constants.GIT_CALL, str(src_path.resolve()), "diff", "--name-only", last_scanned])
-    output = str(output, 'utf-8')
-    output = output.split("\n")
-
-    for rel_path in output:
-        abs_path = src_path / rel_path
-        if abs_path.exists and abs_path.suffix[1:] in constants.VALID_FILE_EXTENSIONS:
-            changed_files.add(str(abs_path.relative_to(src_path).as_posix()))
-
-    return changed_files
-
-
-def parse_diff(src_path, master, branch):
-    changed_files = set([])
-    output = sp.check_output(
-        [*constants.GIT_CALL, str(src_path.resolve()), "diff", "--name-only", master + ".." + branch])
-    output = str(output, 'utf-8')
-    output = output.split("\n")
-
-    for rel_path in output:
-        abs_path = src_path / rel_path
-        if abs_path.exists and abs_path.suffix[1:] in constants.VALID_FILE_EXTENSIONS:
-            changed_files.add(str(abs_path.relative_to(src_path).as_posix()))
-
-    output = sp.check_output([*constants.GIT_CALL, str(src_path.resolve()), "diff", "-U0", master + "..." + branch])
-    output = re.findall(b"(@@)(.*)(@@)|(\+\+\+)(.*)\n", output)
-    output = ["".join([str(match, 'utf-8') for match in group]) for group in output]
-
-    change_intervals = {}
-    last_file = None
-
-    for line in output:
-        if line.startswith("+++ b/"):
-            rel_path = line[6:]
-            abs_path = src_path / rel_path
-            last_file = None
-            if abs_path.exists() and abs_path.suffix[1:] in constants.VALID_FILE_EXTENSIONS:
-                potential_changed_file = str(Path(rel_path).as_posix())
-                if potential_changed_file in changed_files:
-                    # try to catch cherry picks
-                    last_file = potential_changed_file
-                    change_intervals[last_file] = []
-        elif line.startswith("@@") and last_file:
-            for change in line.split():
-                if change.startswith("+"):
-                    if constants.INPUT_LINE_NUMBER_SEPARATOR in change:
-                        # multiple lines changed
-                        change_interval = change[1:].split(constants.INPUT_LINE_NUMBER_SEPARATOR)
-                        change_intervals[last_file].append(
-                            range(int(change_interval[0]), int(change_interval[0]) + int(change_interval[1])))
-                        break
-                    else:
-                        # single line changed
-                        change_intervals[last_file].append(
-                            range(int(change[1:]), int(change[1:])))
-                        break
-
-    return change_intervals
-
-
-def find_changes(src_path, branch):
-    checkout(branch[1], src_path)
-    change_intervals = parse_diff(src_path, *branch)
-    xpath_named_unit_name_query = etree.XPath(constants.NAMED_UNIT_NAME_QUERY, namespaces=constants.ns)
-
-    changed_units = {}
-    if not change_intervals:
-        # empty loops upset the progress bar
+    if dirty_files is not None and last_scanned == master:
+        rel_paths = dirty_files
+    else:
+        rel_paths = git_objects.worktree_changes(src_path, last_scanned)
+    return set([rel_path for rel_path in rel_paths if blob_cache.is_source_file(rel_path)])
+
+
+# Find the changed lines of every source file a branch changed since its merge base with master.
+# Files that do not differ between master and branch are left out, to catch cherry picks.
+# Returns {path: (blob in the branch, change intervals)} for every branch.
+def parse_diffs(src_path, branches):
+    branch_change_intervals = []
+    for changed_files, changes in git_objects.git_channel(src_path).branch_diffs(branches):
+        changed_files = set([rel_path for rel_path in changed_files if blob_cache.is_source_file(rel_path)])
+        branch_change_intervals.append({rel_path: change for rel_path, change in changes.items()
+                                        if rel_path in changed_files})
+    return branch_change_intervals
+
+
+# Find the named units changed by every branch, reading the changed files from git objects.
+# The diffs of all branches are read through the long running git processes of the repository, the srcml runs
+# share one thread pool. Every file version, identified by path and blob, is parsed only once and matched against
+# the changes of all branches touching it. With the blob cache enabled, the named unit spans of parsed versions are
+# cached by blob, so that versions parsed by earlier runs or server queries are not parsed again.
+# Returns the changed units of each branch in the order of branches.
+def find_changes(src_path, branches):
+    # changes of every file version, as (branch index, change intervals)
+    version_changes = {}
+    for index, change_intervals in enumerate(parse_diffs(src_path, branches)):
+        for rel_path, (blob, intervals) in change_intervals.items():
+            version_changes.setdefault((rel_path, blob), []).append((index, intervals))
+    instrumentation.count("changed_file_versions", len(version_changes))
+
+    changed_units = [{} for _ in branches]
+    if constants.BLOB_CACHE:
+        cached_spans = io.load_blob_spans(set(blob for _, blob in version_changes), constants.EXTRACTOR)
+        cached_versions = [version for version in version_changes if version[1] in cached_spans]
+        instrumentation.count("span_cache_hits", len(cached_versions))
+        for rel_path, blob in cached_versions:
+            add_changed_units(changed_units, match_changes(rel_path, cached_spans[blob],
+                                                           version_changes.pop((rel_path, blob))))
+
+    with ThreadPoolExecutor(max_workers=constants.PREPROCESSING_WORKERS) as pool:
+        with tempfile.TemporaryDirectory() as revision_path:
+            version_paths = git_objects.write_blobs(src_path, version_changes.keys(), Path(revision_path))
+            # schedule the largest files first, so that they do not end up as a long tail on a single worker
+            versions = sorted(version_paths.keys(), key=lambda version: version_paths[version].stat().st_size,
+                              reverse=True)
+            jobs = [[(version, version_paths[version], version_changes[version]) for version in batch]
+                    for batch in precompute.batches(versions, constants.SRCML_BATCH_SIZE)]
+
+            with tqdm(total=len(versions), desc="finding changed units",
+                      disable=not constants.PROGRESS_BARS) as progress:
+                for results, blob_spans in pool.map(extract_changed_units, jobs):
+                    add_changed_units(changed_units, results)
+                    if constants.BLOB_CACHE:
+                        io.save_blob_spans(blob_spans)
+                    progress.update(len(blob_spans))
         return changed_units
 
-    for rel_path in tqdm(change_intervals.keys(), desc=branch[1]):
-        path = (src_path / rel_path).resolve()
-        if not path.exists():
-            continue
-
-        path = str(path)
-        change_interval_condition = ""
-        if len(change_intervals[rel_path]) > constants.MAX_FILE_CHANGES:
-            change_interval_condition += "(@pos:line>={0} and @pos:line<={1})".format(
-                change_intervals[rel_path][0].start, change_intervals[rel_path][-1].stop)
-            tqdm.write("too many changes, using pessimistic estimate instead")
-        else:
-            for change in change_intervals[rel_path]:
-                if change_interval_condition:
-                    change_interval_condition += " or "
-                change_interval_condition += "(@pos:line>={0} and @pos:line<={1})".format(change.start, change.stop)
-
-        xpath_named_unit_pos_query = etree.XPath("//*[({0}) and descendant-or-self::node()[{1}]]".format(
-            constants.NAMED_UNIT_QUERY, change_interval_condition), namespaces=constants.ns)
-
-        extensions = ["--register-ext", rel_path.split(".")[-1] + "=C++"]
-        counter = 0
-        xml = None
-        while not xml:
-            try:
-                xml = sp.check_output([*constants.SRCML_BASE_CALL, constants.SRCML_POSITION, *extensions, path],
-                                      timeout=60)
-            except sp.CalledProcessError:
-                # retry, srcml occasionally crashes
-                counter += 1
-                if counter > 3:
-                    print("multiple crashes occured at {}".format(path))
-                    raise
-            except sp.TimeoutExpired:
-                tqdm.write("timeout while parsing {}".format(str((src_path / path).resolve())))
-                break
-
-        if xml:
-            parser = etree.XMLParser(recover=True)
-            root = etree.fromstring(xml, parser=parser)
-            root = xpath_named_unit_pos_query(root)
-
-            for node in root:
-                text, _ = precompute.get_named_unit_name(xpath_named_unit_name_query, node)
-                if text:
-                    changed_units.setdefault(rel_path, set([])).add(text)
-    return changed_units
+
+# add (branch index, relative path, names of changed units) to the changed units of the branches
+def add_changed_units(changed_units, results):
+    for index, rel_path, names in results:
+        changed_units[index].setdefault(rel_path, set([])).update(names)
+
+
+# Match the named unit spans of a file version against the changes of every branch touching it.
+# Returns (branch index, relative path, names of changed units) for every branch.
+def match_changes(rel_path, spans, changes):
+    return [(index, rel_path, find_changed_spans(spans, change_intervals)) for index, change_intervals in changes]
+
+
+# Run srcml on a batch of file versions and find the named units overlapping the changed lines of every branch.
+# Expects (version, path, [(branch index, change intervals)]) for every file version and returns
+# (branch index, relative path, names of changed units) for every branch touching a version, together with
+# (blob, extractor, spans) for every parsed version.
+def extract_changed_units(batch):
+    paths = [path for _, path, _ in batch]
+    if constants.EXTRACTOR == constants.EXTRACTOR_TOKENIZER:
+        extracted = [(tokenizer.extract_file(path), constants.EXTRACTOR_TOKENIZER) for path in paths]
+    elif constants.STREAMING_EXTRACTION:
+        extracted = precompute.tokenizer_fallback(
+            Path("/"), paths, precompute.stream_srcml_batch(Path("/"), paths, [constants.SRCML_POSITION]))
+    else:
+        xpath_find_named_units = etree.XPath(".//*[({0})]".format(constants.NAMED_UNIT_QUERY),
+                                             namespaces=constants.ns)
+        xpath_named_unit_name_query = etree.XPath(constants.NAMED_UNIT_NAME_QUERY, namespaces=constants.ns)
+        units = precompute.run_srcml_batch(Path("/"), paths, [constants.SRCML_POSITION], etree.XMLParser(recover=True))
+        extracted = precompute.tokenizer_fallback(
+            Path("/"), paths, [(None, precompute.find_named_unit_spans(xpath_find_named_units,
+                                                                       xpath_named_unit_name_query, unit))
+                               if unit is not None else None for unit in units])
+
+    results = []
+    blob_spans = []
+    for ((rel_path, blob), _, changes), (result, extractor) in zip(batch, extracted):
+        spans = result[1] if result else []
+        results.extend(match_changes(rel_path, spans, changes))
+        if result:
+            blob_spans.append((blob, extractor, spans))
+    return results, blob_spans
+
+
+# Find the names of all named units, whose line span overlaps one of the changed intervals.
+# Both are sorted by their first line, every unit is resolved by bisecting the ends of the changed intervals.
+def find_changed_spans(spans, change_intervals):
+    # the changed lines of a hunk, including its stop line, as the hunks do not overlap their stops are sorted too
+    change_intervals = sorted(change_intervals, key=lambda change: change.start)
+    change_stops = [change.stop for change in change_intervals]
+    names = set([])
+    for start, end, name in spans:
+        i = bisect_left(change_stops, start)
+        if i < len(change_intervals) and change_intervals[i].start <= end:
+            names.add(name)
+    return names
 
 
 # collect optional data about the call graph
@@ -163,81 +206,114 @@ def call_graph_analysis(graph):
 
 # Find the earliest points of overlap in the call graph between the calling units
 # This prevents callers of the affected unit to show up as new affected units
-def find_earliest_caller(units, overlap, predecessors):
-    unit_1, unit_2 = units
-    predecessors_1, predecessors_2 = predecessors
-
-    paths_to_units = []
-    for caller in overlap:
-        paths_to_units_candidate = (
-            find_path_to_unit(caller, unit_1, predecessors_1), find_path_to_unit(caller, unit_2, predecessors_2))
-        if paths_to_units_candidate[0] and paths_to_units_candidate[1] and len(
-                set(paths_to_units_candidate[0]).intersection(paths_to_units_candidate[1])) <= 1:
-            # should never be less than one, as both paths contain the same origin
-            paths_to_units.append(paths_to_units_candidate)
-    return sorted(paths_to_units, key=path_length_sort_key)
-
-
-
-def find_path_to_unit(caller, unit, predecessors):
-    path = [caller]
-    while path[-1] != unit:
-        if path[-1] in predecessors:
-            path.append(predecessors[path[-1]])
-        else:
-            return None
-    return path
+# The common callers are given by their positions in the callers of both units, all their paths are checked at once.
+# Returns the pairs of paths, that share no unit but the common caller, sorted by path_length_sort_key.
+def find_earliest_caller(positions, caller_paths):
+    paths_1 = caller_paths[0][positions[0]]
+    paths_2 = caller_paths[1][positions[1]]
+    # the units of a shortest path are distinct, so equal entries count the shared units
+    shared = ((paths_1[:, :, None] == paths_2[:, None, :]) & (paths_1[:, :, None] >= 0)).sum(axis=(1, 2))
+    lengths_1 = (paths_1 >= 0).sum(axis=1)
+    lengths_2 = (paths_2 >= 0).sum(axis=1)
+    # the lengths of path_length_sort_key
+    lengths = lengths_1 + lengths_2 - 0.5 * ((lengths_1 == 1) | (lengths_2 == 1))
+    # should never be less than one, as both paths contain the same origin
+    disjoint = np.flatnonzero(shared <= 1)
+    return [(paths_1[row, :lengths_1[row]].tolist(), paths_2[row, :lengths_2[row]].tolist())
+            for row in disjoint[np.argsort(lengths[disjoint], kind="stable")]]
+
+
+# Find all callers of the changed units up to the maximal path length with a single batched search.
+# Returns the callers of every unit as a sorted array, the shortest call paths from its callers to the unit
+# as the rows of a matrix in the same order, and a sparse incidence matrix of changed units (in the given order)
+# by callers. The arrays are views of the result of the search, whose size is proportional to the number of callers,
+# not to the size of the graph.
+# The entries of the incidence matrix are the distance of the caller from the unit plus one.
+def find_callers(called_by_graph, changed_ids):
+    print("find callers of {} changed units".format(len(changed_ids)))
+    origins, nodes, distances, preds = reachability.bounded_bfs(called_by_graph, changed_ids,
+                                                                constants.MAX_PATH_LENGTH)
+    paths = reachability.shortest_paths(called_by_graph.shape[0], origins, nodes, preds)
+    bounds = np.searchsorted(origins, np.arange(len(changed_ids) + 1))
+
+    callers = {}
+    caller_paths = {}
+    for i, unit_id in enumerate(changed_ids):
+        callers[unit_id] = nodes[bounds[i]:bounds[i + 1]]
+        caller_paths[unit_id] = paths[bounds[i]:bounds[i + 1]]
+    incidence = csr_matrix(((distances + 1).astype(np.int8), (origins, nodes)),
+                           shape=(len(changed_ids), called_by_graph.shape[0]))
+    return callers, caller_paths, incidence
 
 
 # export final results
-def save_potential_conflicts(potential_conflicts):
-    # build ranking
+# count a conflict for both of its units and for every pair of branches it occurs in
+def count_potential_conflict(conflict, ranking, pairs):
+    units = set(conflict.get("conflicting units", []))
+    for unit in units:
+        ranking[unit] = ranking.get(unit, 0) + 1
+    branches = conflict.get("branch revisions", [])
+    if len(branches) == 2:
+        branches_a = branches[0]
+        branches_b = branches[1]
+        for branch_a in branches_a:
+            pairs.setdefault(branch_a, {})
+            for branch_b in branches_b:
+                if branch_a == branch_b:
+                    continue
+
+                pairs.setdefault(branch_b, {})
+
+                count_a = pairs[branch_a].setdefault(branch_b, 0)
+                pairs[branch_a][branch_b] = count_a + 1
+
+                count_b = pairs[branch_b].setdefault(branch_a, 0)
+                pairs[branch_b][branch_a] = count_b + 1
+
+
+def sort_ranking(ranking):
+    ranking = list(ranking.items())
+    ranking.sort(reverse=True, key=itemgetter(1))
+    return ranking
+
+
+# count the conflicts of every unit and of every pair of branches
+def rank_potential_conflicts(potential_conflicts):
     ranking = {}
     pairs = {}
     for conflict in potential_conflicts:
-        units = set(conflict.get("conflicting units", []))
-        for unit in units:
-            ranking[unit] = ranking.get(unit, 0) + 1
-        branches = conflict.get("branch revisions", [])
-        if len(branches) == 2:
-            branches_a = branches[0]
-            branches_b = branches[1]
-            for branch_a in branches_a:
-                pairs.setdefault(branch_a, {})
-                for branch_b in branches_b:
-                    if branch_a == branch_b:
-                        continue
-
-                    pairs.setdefault(branch_b, {})
-
-                    count_a = pairs[branch_a].setdefault(branch_b, 0)
-                    pairs[branch_a][branch_b] = count_a + 1
-
-                    count_b = pairs[branch_b].setdefault(branch_a, 0)
-                    pairs[branch_b][branch_a] = count_b + 1
+        count_potential_conflict(conflict, ranking, pairs)
+    return sort_ranking(ranking), pairs
 
-    ranking = list(ranking.items())
-    ranking.sort(reverse=True, key=itemgetter(1))
 
-    result = {"number_of_conflicts": len(potential_conflicts),
-              "conflicting_branches": pairs,
-              "ranking": ranking,
-              "conflicts": potential_conflicts}
-    potential_conflicts_minimal = []
+# the complete results of an analysis
+def summarize_potential_conflicts(potential_conflicts):
+    ranking, pairs = rank_potential_conflicts(potential_conflicts)
+    return {"number_of_conflicts": len(potential_conflicts),
+            "conflicting_branches": pairs,
+            "ranking": ranking,
+            "conflicts": potential_conflicts}
+
+
+def minimal_potential_conflict(conflict):
+    return {"conflicting units": conflict["conflicting units"],
+            "branch revisions": conflict["branch revisions"],
+            "shortest path:": conflict["call paths"][0]}
+
+
+def save_potential_conflicts(potential_conflicts):
+    result = summarize_potential_conflicts(potential_conflicts)
+    pairs = result["conflicting_branches"]
+    ranking = result["ranking"]
 
     print("save potential_conflicts_transitive_{}.json...".format(constants.MAX_TRANSITIVE_INCLUDE_LEVEL))
     with open("potential_conflicts_transitive_{}.json".format(constants.MAX_TRANSITIVE_INCLUDE_LEVEL), 'w') as fp:
         ujson.dump(result, fp, indent=4)
 
-    for conflict in potential_conflicts:
-        potential_conflicts_minimal.append({"conflicting units": conflict["conflicting units"],
-                                            "branch revisions": conflict["branch revisions"],
-                                            "shortest path:": conflict["call paths"][0]})
-
     result_minimal = {"number_of_conflicts": len(potential_conflicts),
                       "conflicting_branches": pairs,
                       "ranking": ranking,
-                      "conflicts": potential_conflicts_minimal}
+                      "conflicts": [minimal_potential_conflict(conflict) for conflict in potential_conflicts]}
 
     print("save potential_conflicts_transitive_{}_minimal.json...".format(constants.MAX_TRANSITIVE_INCLUDE_LEVEL))
     with open("potential_conflicts_transitive_{}_minimal.json".format(constants.MAX_TRANSITIVE_INCLUDE_LEVEL),
@@ -247,6 +323,55 @@ def save_potential_conflicts(potential_conflicts):
     print("save complete")
 
 
+# Writes potential conflicts as NDJSON while they are found, one conflict per line, and their minimal form alongside.
+# Ranking and conflicting branches are counted incrementally. The top_count closest conflicts are kept in a bounded
+# heap and written to the summary on close, in the order of potential_conflict_sort_key.
+class PotentialConflictWriter:
+    def __init__(self, prefix, top_count):
+        print("stream potential conflicts to {}.ndjson...".format(prefix))
+        self.file = open("{}.ndjson".format(prefix), "w")
+        self.minimal_file = open("{}_minimal.ndjson".format(prefix), "w")
+        self.summary_path = "{}_summary.json".format(prefix)
+        self.top_count = top_count
+        self.ranking = {}
+        self.pairs = {}
+        self.count = 0
+        # (-sort key, -number of the conflict, conflict), the root is the conflict dropped next.
+        # Of conflicts with the same sort key the earlier found ones are kept, as in a stable sort.
+        self.top = []
+
+    def write(self, conflict):
+        self.file.write(ujson.dumps(conflict) + "\n")
+        self.minimal_file.write(ujson.dumps(minimal_potential_conflict(conflict)) + "\n")
+        count_potential_conflict(conflict, self.ranking, self.pairs)
+
+        entry = (-potential_conflict_sort_key(conflict), -self.count, conflict)
+        if len(self.top) < self.top_count:
+            heapq.heappush(self.top, entry)
+        elif self.top and entry[:2] > self.top[0][:2]:
+            heapq.heapreplace(self.top, entry)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        self.minimal_file.close()
+        summary = {"number_of_conflicts": self.count,
+                   "conflicting_branches": self.pairs,
+                   "ranking": sort_ranking(self.ranking),
+                   "closest_conflicts": [conflict for _, _, conflict in sorted(self.top, key=itemgetter(0, 1),
+                                                                                reverse=True)]}
+        print("save {}...".format(self.summary_path))
+        with open(self.summary_path, "w") as fp:
+            ujson.dump(summary, fp, indent=4)
+        print("save complete")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 # sort conflicts by the distance between their conflicting units
 def potential_conflict_sort_key(potential_conflict):
     min_length = np.inf
@@ -275,9 +400,12 @@ def perform_merge(master, branches, src_path):
     sp.run([*constants.GIT_CALL, str(src_path.resolve()), "merge", "--no-commit", "--no-ff", *contributions])
 
 
+# Without a merge in progress, e.g. when the merge stopped before it started, the staged changes of the merge are
+# reset instead, so that the working tree is clean for the next analysis.
 def abort_merge(src_path):
     print("reverting temporary merge")
-    sp.run([*constants.GIT_CALL, str(src_path.resolve()), "merge", "--abort"])
+    if sp.run([*constants.GIT_CALL, str(src_path.resolve()), "merge", "--abort"]).returncode != 0:
+        sp.run([*constants.GIT_CALL, str(src_path.resolve()), "reset", "--merge"])
 
 
 def checkout(branch, src_path):
@@ -287,108 +415,304 @@ def checkout(branch, src_path):
 # Delete preprocessed files, that have been changed by the merge.
 def delete_dirty_files(dirty_files):
     if dirty_files:
-        for rel_path in tqdm(dirty_files, desc="deleting temporary files"):
-            path = constants.DUMP_FOLDER_JSON / rel_path
-            if path.exists():
-                path.unlink()
+        print("deleting {} temporary files".format(len(dirty_files)))
+        io.delete_preprocessed_files(dirty_files)
 
 
 # Find preprocessed files, that have been changed by the merge.
 def get_dirty_files(src_path, master):
+    return set(git_objects.worktree_changes(src_path, master))
+
+
+# The first and the last branch changing each of the changed units (in the given order), as two arrays.
+# A pair (unit_1, unit_2) is changed in two branches a < b, if the first branch of unit_1 precedes the last branch
+# of unit_2.
+def branch_order(branch_unit_sets, changed_ids):
+    rows = {unit_id: row for row, unit_id in enumerate(changed_ids)}
+    first_branches = np.full(len(changed_ids), len(branch_unit_sets), dtype=np.int64)
+    last_branches = np.full(len(changed_ids), -1, dtype=np.int64)
+    for branch, unit_ids in enumerate(branch_unit_sets):
+        unit_rows = np.fromiter((rows[unit_id] for unit_id in unit_ids), dtype=np.int64, count=len(unit_ids))
+        first_branches[unit_rows] = np.minimum(first_branches[unit_rows], branch)
+        last_branches[unit_rows] = branch
+    return first_branches, last_branches
+
+
+# Find pairs of changed units, that share a caller in at least one pair of incidence matrices of units by callers,
+# given as (incidence, transposed incidence). A pair (unit_1, unit_2) is yielded once, if unit_1 is changed in an
+# earlier branch than unit_2. The pairs are read blockwise from the products of the incidence matrices and only
+# their nonzero entries are filtered by the order of the branches, so pairs without a common caller are never
+# generated and no set of scanned pairs is needed.
+def shared_caller_pairs(incidence_pairs, changed_ids, first_branches, last_branches):
+    for start in range(0, len(changed_ids), constants.PAIR_BLOCK_SIZE):
+        block = slice(start, start + constants.PAIR_BLOCK_SIZE)
+        shared_callers = sum([incidence[block] @ incidence_transposed
+                              for incidence, incidence_transposed in incidence_pairs])
+        candidates = shared_callers.tocoo()
+        ordered = first_branches[start + candidates.row] < last_branches[candidates.col]
+        for row, column in zip(candidates.row[ordered].tolist(), candidates.col[ordered].tolist()):
+            yield changed_ids[start + row], changed_ids[column]
+
+
+# Find pairs of units changed in different branches, that share at least one caller.
+def pairs(branch_unit_sets, changed_ids, incidence):
+    incidence = incidence.astype(np.int32)
+    yield from shared_caller_pairs([(incidence, incidence.transpose().tocsc())], changed_ids,
+                                   *branch_order(branch_unit_sets, changed_ids))
+
+
+# Parse the temporary merge of all branches into master.
+# Without a checkout, the merge is performed in a throwaway worktree instead of the working tree of src_path.
+# The files changed by the merge compared to master are parsed again and afterwards deleted from the preprocessed
+# files, the comparison serves both steps.
+def preprocess_merge(src_path, master, branches):
+    master_commit = git_objects.git_channel(src_path).resolve(master)
+    # if parsing fails, the files of the merge parsed so far are deleted all the same
     dirty_files = set([])
-    output = sp.check_output([*constants.GIT_CALL, str(src_path.resolve()), "diff", "--name-only", master])
-    output = str(output, 'utf-8')
-    output = output.split("\n")
-
-    for rel_path in output:
-        abs_path = src_path / rel_path
-        if abs_path.exists:
-            dirty_files.add(str(abs_path.relative_to(src_path).as_posix()) + ".json")
-
-    return dirty_files
-
-
-# Find pairs of units with replacement and without considering their order
-def pairs(*sets):
-    scanned = set([])
-    for t in itertools.combinations(sets, 2):
-        for pair in itertools.product(*t):
-            if pair not in scanned:
-                scanned.add(pair)
-                yield pair
-
-
-def main():
-    src_path, master, branches = parse_input()
-    perform_merge(master, branches, src_path)
-    precompute.parse_source_code(src_path, changed_files=get_changed_files(src_path))
-    delete_dirty_files(get_dirty_files(src_path, master))
-    abort_merge(src_path)
-    io.save_last_scanned_revision(master)
-    precompute.build_call_graph()
-
-    called_by_graph = load_npz("called_by_graph.npz")
-
-    id_to_named_unit, named_unit_to_id = io.load_id_dicts()
-
-    call_graph_analysis(called_by_graph)
-
+    if constants.CHECKOUT_FREE:
+        worktree_path, merge_path = git_objects.create_worktree(src_path, master)
+        try:
+            perform_merge(master, branches, merge_path)
+            dirty_files = get_dirty_files(merge_path, master_commit)
+            precompute.parse_source_code(merge_path,
+                                         changed_files=get_changed_files(merge_path, master_commit, dirty_files))
+        finally:
+            delete_dirty_files(dirty_files)
+            git_objects.remove_worktree(src_path, worktree_path)
+    else:
+        try:
+            perform_merge(master, branches, src_path)
+            dirty_files = get_dirty_files(src_path, master_commit)
+            precompute.parse_source_code(src_path,
+                                         changed_files=get_changed_files(src_path, master_commit, dirty_files))
+        finally:
+            delete_dirty_files(dirty_files)
+            abort_merge(src_path)
+
+
+# Bring the preprocessed files and the call graph up to date with the merge of all branches into master.
+# Returns the called_by_graph and both ID dicts. resident is the precompute.PreprocessedFiles of a long running process.
+# Holds the analysis lock, the returned views stay valid when follow_master.py replaces the files afterwards.
+def prepare_call_graph(src_path, master, branches, resident=None):
+    with io.analysis_lock():
+        with instrumentation.stage("preprocess_merge"):
+            preprocess_merge(src_path, master, branches)
+            # the commit, as a branch name may point elsewhere on the next scan
+            io.save_last_scanned_revision(git_objects.git_channel(src_path).resolve(master))
+            if constants.BLOB_CACHE:
+                # keeps the blobs of master referenced, so they are not evicted from the cache
+                blob_cache.get_revision_blobs(src_path, master)
+        with instrumentation.stage("build_call_graph"):
+            return precompute.build_call_graph(resident=resident)
+
+
+# Map the changed units of every branch to their IDs.
+# Returns the branch revisions of every changed unit, the changed units of every branch revision and all changed IDs.
+def map_changed_units(branches, branch_changed_units, named_unit_to_id):
     unit_id_to_branch_revision = {}
     branch_revision_to_unit_id = {}
     changed_ids = set([])
-    for branch in branches:
-        changed_units = find_changes(src_path, branch)
+    for branch, changed_units in zip(branches, branch_changed_units):
         branch_revision_to_unit_id[branch[1]] = set([])
         for key, value in changed_units.items():
             for unit in value:
                 unit_id = named_unit_to_id.get((key, unit), None)
-                if unit_id:
+                if unit_id is not None:
                     if unit_id not in unit_id_to_branch_revision:
                         unit_id_to_branch_revision[unit_id] = {branch[1]}
                     else:
                         unit_id_to_branch_revision[unit_id].add(branch[1])
                     branch_revision_to_unit_id[branch[1]].add(unit_id)
                     changed_ids.add(unit_id)
+        instrumentation.count("changed_units", len(branch_revision_to_unit_id[branch[1]]), branch=branch[1])
+    return unit_id_to_branch_revision, branch_revision_to_unit_id, sorted(changed_ids)
+
+
+# Find the call paths from the earliest common callers to both units.
+# Returns the potential conflict of both units or None, if they have no common caller.
+def examine_pair(unit_1, unit_2, unit_id_to_branch_revision, callers, caller_paths, id_to_named_unit):
+    _, positions_1, positions_2 = np.intersect1d(callers[unit_1], callers[unit_2], assume_unique=True,
+                                                 return_indices=True)
+    if len(positions_1):
+        path_pairs = find_earliest_caller((positions_1, positions_2), (caller_paths[unit_1], caller_paths[unit_2]))
+
+        # the paths share most of their units, every unit is looked up once
+        named_units = {unit_id: id_to_named_unit[unit_id] for unit_id in
+                       set([unit_id for paths in path_pairs for path in paths for unit_id in path])}
+        readable_paths = [[[named_units[unit_id] for unit_id in path] for path in paths] for paths in path_pairs]
+
+        if readable_paths:
+            return {"conflicting units": [id_to_named_unit[unit_1], id_to_named_unit[unit_2]],
+                    "branch revisions": [sorted(unit_id_to_branch_revision[unit_1]),
+                                         sorted(unit_id_to_branch_revision[unit_2])],
+                    "call paths": readable_paths}
+    return None
+
+
+# Examine all pairs of units changed in different branches for common callers.
+# Yields the potential conflicts in the order in which they are found.
+def generate_potential_conflicts(unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids, callers,
+                                 caller_paths, incidence, id_to_named_unit):
+    for unit_1, unit_2 in tqdm(pairs(list(branch_revision_to_unit_id.values()), changed_ids, incidence),
+                               desc="examining units pairwise", disable=not constants.PROGRESS_BARS):
+        instrumentation.count("pairs_examined")
+        potential_conflict = examine_pair(unit_1, unit_2, unit_id_to_branch_revision, callers, caller_paths,
+                                          id_to_named_unit)
+        if potential_conflict:
+            instrumentation.count("potential_conflicts")
+            yield potential_conflict
+
+
+# all potential conflicts, sorted by the distance of the conflicting units
+def examine_pairs(unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids, callers, caller_paths,
+                  incidence, id_to_named_unit):
+    return sorted(generate_potential_conflicts(unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids,
+                                               callers, caller_paths, incidence, id_to_named_unit),
+                  key=potential_conflict_sort_key)
+
+
+# Tiers of the sort key of potential conflicts in increasing order, with the pairs of distances of a common caller
+# from both units, that lead to it. A conflict, whose shortest call paths have d_1 + d_2 edges, has the sort key
+# d_1 + d_2 + 1.5, if one unit calls the other, and d_1 + d_2 + 2 otherwise.
+def sort_key_tiers(max_distance):
+    for total in range(2 * max_distance + 1):
+        if total <= max_distance:
+            yield total + 1.5, sorted(set([(0, total), (total, 0)]))
+        indirect = [(distance, total - distance) for distance in range(1, total)
+                    if distance <= max_distance and total - distance <= max_distance]
+        if indirect:
+            yield total + 2, indirect
+
+
+# Find the potential conflicts with the shortest call paths first.
+# Pairs are generated tier by tier of their smallest possible sort key, from the callers at the matching distances
+# of both units. Every pair is examined once, when it first appears, and its conflict is kept until no unexamined
+# pair can have a smaller sort key. The search stops as soon as top_count conflicts are proven to be the closest,
+# or at the deadline given as time.perf_counter() value.
+# Returns the conflicts sorted like find_potential_conflicts and whether they are proven to be the closest ones.
+# Without the proof, the closest of all conflicts found so far are returned.
+def closest_potential_conflicts(unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids, callers,
+                                caller_paths, incidence, id_to_named_unit, top_count=None, deadline=None):
+    first_branches, last_branches = branch_order(list(branch_revision_to_unit_id.values()), changed_ids)
+    # the incidence of callers at every distance, the entries of the incidence matrix are the distance plus one
+    incidence = incidence.astype(np.int32)
+    distance_incidences = []
+    for distance in range(constants.MAX_PATH_LENGTH + 1):
+        distance_incidence = incidence.multiply(incidence == distance + 1).tocsr()
+        distance_incidences.append((distance_incidence, distance_incidence.transpose().tocsc()))
+
+    examined = set([])
+    # (sort key, number of the conflict, conflict) of conflicts not yet proven to be among the closest
+    candidates = []
+    closest = []
+    for sort_key, distance_pairs in sort_key_tiers(constants.MAX_PATH_LENGTH):
+        incidence_pairs = [(distance_incidences[distance_1][0], distance_incidences[distance_2][1])
+                           for distance_1, distance_2 in distance_pairs]
+        for unit_1, unit_2 in shared_caller_pairs(incidence_pairs, changed_ids, first_branches, last_branches):
+            if deadline_passed(deadline):
+                return (closest + [conflict for _, _, conflict in sorted(candidates)])[:top_count], False
+            if (unit_1, unit_2) in examined:
+                continue
+            examined.add((unit_1, unit_2))
+            instrumentation.count("pairs_examined")
+            potential_conflict = examine_pair(unit_1, unit_2, unit_id_to_branch_revision, callers, caller_paths,
+                                              id_to_named_unit)
+            if potential_conflict:
+                heapq.heappush(candidates, (potential_conflict_sort_key(potential_conflict), len(examined),
+                                            potential_conflict))
+
+        # every pair not examined yet has a larger sort key than this tier
+        while candidates and candidates[0][0] <= sort_key:
+            closest.append(heapq.heappop(candidates)[2])
+            instrumentation.count("potential_conflicts")
+        if top_count is not None and len(closest) >= top_count:
+            break
+
+    instrumentation.gauge("search_complete", 1)
+    closest += [conflict for _, _, conflict in sorted(candidates)]
+    return closest[:top_count], True
+
+
+# find the potential conflicts between the changes of the branches, in the order in which they are found
+def iterate_potential_conflicts(src_path, branches, called_by_graph, id_to_named_unit, named_unit_to_id):
+    with instrumentation.stage("find_changes"):
+        branch_changed_units = find_changes(src_path, branches)
+    unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids = \
+        map_changed_units(branches, branch_changed_units, named_unit_to_id)
+    with instrumentation.stage("find_callers"):
+        callers, caller_paths, incidence = find_callers(called_by_graph, changed_ids)
+    with instrumentation.stage("examine_pairs"):
+        yield from generate_potential_conflicts(unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids,
+                                                callers, caller_paths, incidence, id_to_named_unit)
+
+
+# whether the deadline given as time.perf_counter() value has passed, reported as an unproven search
+def deadline_passed(deadline):
+    if deadline is None or time.perf_counter() <= deadline:
+        return False
+    tqdm.write("time budget exhausted, the closest conflicts are not proven")
+    instrumentation.gauge("search_complete", 0)
+    return True
+
+
+# Find the top_count closest potential conflicts between the changes of the branches, within the time budget
+# in seconds, if given. Returns the conflicts and whether they are proven to be the closest ones.
+# The budget starts after the call graph was prepared. find_changes and find_callers are not interrupted, but the
+# budget is checked after each of them, so that no conflicts are searched for once they used it up.
+def find_closest_potential_conflicts(src_path, branches, called_by_graph, id_to_named_unit, named_unit_to_id,
+                                     top_count=None, time_budget=None):
+    deadline = time.perf_counter() + time_budget if time_budget is not None else None
+    with instrumentation.stage("find_changes"):
+        branch_changed_units = find_changes(src_path, branches)
+    if deadline_passed(deadline):
+        return [], False
+    unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids = \
+        map_changed_units(branches, branch_changed_units, named_unit_to_id)
+    with instrumentation.stage("find_callers"):
+        callers, caller_paths, incidence = find_callers(called_by_graph, changed_ids)
+    if deadline_passed(deadline):
+        return [], False
+    with instrumentation.stage("closest_potential_conflicts"):
+        return closest_potential_conflicts(unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids,
+                                           callers, caller_paths, incidence, id_to_named_unit, top_count, deadline)
+
+
+# find the potential conflicts between the changes of the branches, sorted by the distance of the conflicting units
+def find_potential_conflicts(src_path, branches, called_by_graph, id_to_named_unit, named_unit_to_id):
+    return sorted(iterate_potential_conflicts(src_path, branches, called_by_graph, id_to_named_unit,
+                                              named_unit_to_id), key=potential_conflict_sort_key)
 
-    checkout(master, src_path)
 
-    callers = {}
-    predecessors = {}
-    for unit_id in tqdm(changed_ids, desc="find callers"):
-
-        dist, pred = csgraph.dijkstra(called_by_graph, return_predecessors=True, indices=[unit_id],
-                                      limit=constants.MAX_PATH_LENGTH)
-        _, Y = np.where(dist <= constants.MAX_PATH_LENGTH)
-        callers[unit_id] = set(Y)
-        _, Y = np.where(pred >= 0)
-        predecessors[unit_id] = {}
-        for y in Y:
-            predecessors[unit_id][y] = pred[0, y]
-
-    potential_conflicts = []
-
-    for unit_1, unit_2 in tqdm(pairs(*branch_revision_to_unit_id.values()),
-                               desc="examining units pairwise"):
-
-        overlap = callers[unit_1].intersection(callers[unit_2])
-        if overlap:
-            path_pairs = find_earliest_caller((unit_1, unit_2), overlap, (predecessors[unit_1], predecessors[unit_2]))
-
-            readable_paths = []
-            for paths in path_pairs:
-                readable_pair = []
-                for path in paths:
-                    readable_path = [id_to_named_unit[unit_id] for unit_id in path]
-                    readable_pair.append(readable_path)
-                readable_paths.append(readable_pair)
-
-            if readable_paths:
-                potential_conflicts.append({"conflicting units": [id_to_named_unit[unit_1], id_to_named_unit[unit_2]],
-                                            "branch revisions": [unit_id_to_branch_revision[unit_1],
-                                                                 unit_id_to_branch_revision[unit_2]],
-                                            "call paths": readable_paths})
-
-    save_potential_conflicts(sorted(potential_conflicts, key=potential_conflict_sort_key))
+def main():
+    src_path, master, branches, metrics_path = parse_input()
+    with instrumentation.stage("total"):
+        called_by_graph, id_to_named_unit, named_unit_to_id = prepare_call_graph(src_path, master, branches)
+
+        with instrumentation.stage("call_graph_analysis"):
+            call_graph_analysis(called_by_graph)
+
+        if constants.TOP_CONFLICTS is not None or constants.TIME_BUDGET is not None:
+            potential_conflicts, complete = find_closest_potential_conflicts(src_path, branches, called_by_graph,
+                                                                             id_to_named_unit, named_unit_to_id,
+                                                                             constants.TOP_CONFLICTS,
+                                                                             constants.TIME_BUDGET)
+            if not complete:
+                print("partial results: the time budget ran out before the closest conflicts were proven")
+            with instrumentation.stage("save_potential_conflicts"):
+                save_potential_conflicts(potential_conflicts)
+        elif constants.STREAMING_OUTPUT:
+            prefix = "potential_conflicts_transitive_{}".format(constants.MAX_TRANSITIVE_INCLUDE_LEVEL)
+            with PotentialConflictWriter(prefix, constants.TOP_POTENTIAL_CONFLICTS) as writer:
+                for conflict in iterate_potential_conflicts(src_path, branches, called_by_graph, id_to_named_unit,
+                                                            named_unit_to_id):
+                    writer.write(conflict)
+        else:
+            potential_conflicts = find_potential_conflicts(src_path, branches, called_by_graph, id_to_named_unit,
+                                                           named_unit_to_id)
+            with instrumentation.stage("save_potential_conflicts"):
+                save_potential_conflicts(potential_conflicts)
+    if metrics_path:
+        instrumentation.save_metrics(metrics_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+from pathlib import Path
+import sys
+import time
+import constants
+import precompute
+import find_conflicts
+import blob_cache
+import git_objects
+import instrumentation
+import save_and_load as io
+
+
+def parse_input():
+    # expect input in the format PATH_TO_SOURCE_FOLDER MASTER_REVISION
+    # optionally preceded by --quiet, --extractor=tokenizer, which has to match the extractor of the merge checks,
+    # and --metrics=PATH, as for find_conflicts.py
+    arguments, metrics_path = find_conflicts.parse_options(sys.argv[1:], ["--quiet", "--extractor", "--metrics"])
+    if len(arguments) != 2:
+        sys.exit("usage: follow_master.py [--quiet] [--extractor=tokenizer] [--metrics=PATH] "
+                 "PATH_TO_SOURCE_FOLDER MASTER_REVISION")
+    return Path(arguments[0]).resolve(), arguments[1], metrics_path
+
+
+# Parse the files of master changed since the last scan and the files missing from the preprocessed files,
+# like those deleted after the last merge check. Without a checkout, master is read from a throwaway worktree.
+def parse_master(src_path, master):
+    if constants.CHECKOUT_FREE:
+        worktree_path, master_path = git_objects.create_worktree(src_path, master)
+        try:
+            precompute.parse_source_code(master_path, changed_files=find_conflicts.get_changed_files(master_path))
+        finally:
+            git_objects.remove_worktree(src_path, worktree_path)
+    else:
+        find_conflicts.checkout(master, src_path)
+        precompute.parse_source_code(src_path, changed_files=find_conflicts.get_changed_files(src_path))
+
+
+# Bring the preprocessed files, the call graph and the last scanned revision up to date with master, so that the
+# next merge check only parses the files changed by its branches. Meant to run from a cron job or a post-receive
+# hook, in the working directory of the merge checks. Waits for running merge checks and blocks new ones meanwhile.
+def follow_master(src_path, master):
+    with io.analysis_lock():
+        master_commit = git_objects.git_channel(src_path).resolve(master)
+        print("following master at {}".format(master_commit))
+        with instrumentation.stage("parse_master"):
+            parse_master(src_path, master)
+            io.save_last_scanned_revision(master_commit)
+            if constants.BLOB_CACHE:
+                # keeps the blobs of master referenced, so they are not evicted from the cache
+                blob_cache.get_revision_blobs(src_path, master_commit)
+        with instrumentation.stage("build_call_graph"):
+            precompute.build_call_graph()
+
+
+def main():
+    src_path, master, metrics_path = parse_input()
+    with instrumentation.stage("total"):
+        follow_master(src_path, master)
+    if metrics_path:
+        instrumentation.save_metrics(metrics_path)
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    main()
+    print("--- {0:.2f} seconds ---".format(time.time() - start_time))
@@ -0,0 +1,113 @@
+from pathlib import Path
+import os
+import sys
+import random
+import subprocess as sp
+import constants
+
+# Generates a synthetic C++ git repository for benchmarks.
+# Every module is a header defining inline functions. A header includes up to include_fan_out headers of modules with
+# a lower number, so that the includes are acyclic, and its functions call their functions with the given probability.
+# Every branch changes the bodies of functions in changed_files_per_branch headers. The share given by overlap is
+# drawn from a set of headers changed by all branches, so that their changes share callers. Branches never change
+# the same function, so that all of them can be merged at once.
+
+# fixed identity and dates, so that the same parameters always produce the same revisions
+GIT_ENVIRONMENT = {"GIT_AUTHOR_NAME": "benchmark", "GIT_AUTHOR_EMAIL": "benchmark@localhost",
+                   "GIT_COMMITTER_NAME": "benchmark", "GIT_COMMITTER_EMAIL": "benchmark@localhost",
+                   "GIT_AUTHOR_DATE": "2000-01-01T00:00:00+0000", "GIT_COMMITTER_DATE": "2000-01-01T00:00:00+0000",
+                   "GIT_CONFIG_NOSYSTEM": "1", "HOME": os.devnull}
+
+
+def git(repository_path, *args):
+    output = sp.check_output([*constants.GIT_CALL, str(repository_path), *args],
+                             env=dict(os.environ, **GIT_ENVIRONMENT))
+    return str(output, 'utf-8').strip()
+
+
+def function_name(module, unit):
+    return "module_{}_unit_{}".format(module, unit)
+
+
+def header_path(module):
+    return "include/module_{}.h".format(module)
+
+
+# The second line of every function body is the one changed by the branches, followed by the calls.
+# Unchanged lines around it keep the changes of different branches from touching each other.
+def write_header(repository_path, module, units_per_file, includes, calls, changes):
+    lines = ["#pragma once"]
+    # the analysis matches includes against paths relative to the root of the repository
+    lines += ['#include "{}"'.format(header_path(included_module)) for included_module in includes]
+    for unit in range(units_per_file):
+        lines += ["",
+                  "inline int {}(int value)".format(function_name(module, unit)),
+                  "{",
+                  "    int result = value;",
+                  "    result += {};".format(changes.get(unit, 0)),
+                  "    result -= 1;"]
+        lines += ["    result += {}(result);".format(function_name(*call)) for call in calls[unit]]
+        lines += ["    return result;",
+                  "}"]
+    (repository_path / header_path(module)).write_text("\n".join(lines) + "\n")
+
+
+# Create the repository and return the master revision and the branches as pairs of master and branch revision.
+def generate_repository(repository_path, files=100, units_per_file=10, include_fan_out=3, call_density=0.2,
+                        branch_count=4, changed_files_per_branch=5, changed_units_per_file=2, overlap=0.5, seed=0):
+    generator = random.Random(seed)
+    repository_path = Path(repository_path)
+    (repository_path / "include").mkdir(parents=True)
+    git(repository_path, "init", "-q")
+    # the temporary merge of the analysis needs an identity in the repository itself
+    git(repository_path, "config", "user.name", GIT_ENVIRONMENT["GIT_COMMITTER_NAME"])
+    git(repository_path, "config", "user.email", GIT_ENVIRONMENT["GIT_COMMITTER_EMAIL"])
+
+    modules = list(range(files))
+    includes = {module: generator.sample(range(module), min(include_fan_out, module)) for module in modules}
+    calls = {}
+    for module in modules:
+        callable_units = [(included_module, unit) for included_module in includes[module]
+                          for unit in range(units_per_file)]
+        calls[module] = [[call for call in callable_units if generator.random() < call_density]
+                         for _ in range(units_per_file)]
+
+    for module in modules:
+        write_header(repository_path, module, units_per_file, includes[module], calls[module], {})
+    git(repository_path, "add", "-A")
+    git(repository_path, "commit", "-q", "-m", "generated master")
+    master = git(repository_path, "rev-parse", "HEAD")
+
+    # the functions of every file, that are still free to be changed by a branch
+    free_units = {module: generator.sample(range(units_per_file), units_per_file) for module in modules}
+    shared_modules = generator.sample(modules, min(files, changed_files_per_branch))
+    shared_count = int(round(changed_files_per_branch * overlap))
+
+    branches = []
+    for branch in range(branch_count):
+        candidates = [module for module in shared_modules if len(free_units[module]) >= changed_units_per_file]
+        changed_modules = generator.sample(candidates, min(shared_count, len(candidates)))
+        candidates = [module for module in modules if module not in changed_modules and
+                      len(free_units[module]) >= changed_units_per_file]
+        changed_modules += generator.sample(candidates, min(changed_files_per_branch - len(changed_modules),
+                                                            len(candidates)))
+
+        git(repository_path, "checkout", "-q", "-b", "branch_{}".format(branch), master)
+        for module in changed_modules:
+            changes = {free_units[module].pop(): branch + 1 for _ in range(changed_units_per_file)}
+            write_header(repository_path, module, units_per_file, includes[module], calls[module], changes)
+        git(repository_path, "commit", "-q", "-a", "-m", "generated branch {}".format(branch))
+        branches.append([master, git(repository_path, "rev-parse", "HEAD")])
+
+    git(repository_path, "checkout", "-q", master)
+    return master, branches
+
+
+def main():
+    # expect input in the format TARGET_PATH [SEED]
+    master, branches = generate_repository(Path(sys.argv[1]), seed=int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    print(" ".join([master] + [constants.BRANCH_SEPARATOR.join(branch) for branch in branches]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+from pathlib import Path
+from collections import OrderedDict
+import codecs
+import subprocess as sp
+import tempfile
+import threading
+import constants
+
+# diff-tree echoes and flushes every input line, that does not start with an object name.
+# Written after every query, this line marks the end of the output of the query.
+DIFF_END_MARKER = b"#end of diff\n"
+
+
+# Reads objects of a repository through a single long running "git cat-file --batch" process.
+class ObjectReader:
+    def __init__(self, src_path):
+        self.process = sp.Popen([*constants.GIT_CALL, str(src_path.resolve()), "cat-file", "--batch"],
+                                stdin=sp.PIPE, stdout=sp.PIPE)
+
+    # return the content of an object given as "<revision>:<path>" or hash, None if it does not exist
+    def read(self, object_name):
+        self.process.stdin.write(object_name.encode("utf-8") + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            # "<object_name> missing" or "<object_name> ambiguous"
+            return None
+        content = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)
+        return content
+
+    # return the hash of the commit a revision points to, None if it does not exist
+    def resolve(self, revision):
+        self.process.stdin.write(revision.encode("utf-8") + b"^{commit}\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            return None
+        self.process.stdout.read(int(header[2]) + 1)
+        return str(header[0], 'utf-8')
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+# Compares pairs of commits through a single long running "git diff-tree --stdin" process with the given options.
+class DiffReader:
+    def __init__(self, src_path, *options):
+        self.process = sp.Popen([*constants.GIT_CALL, str(src_path.resolve()), "diff-tree", "--stdin", "-r", *options],
+                                stdin=sp.PIPE, stdout=sp.PIPE)
+
+    def write_queries(self, commit_pairs):
+        for old, new in commit_pairs:
+            # "<commit> <parent>", diffs go from the parent to the commit
+            self.process.stdin.write("{} {}\n".format(new, old).encode("utf-8") + DIFF_END_MARKER)
+        self.process.stdin.flush()
+
+    # Yield the output of the next query line by line, as it is read from the process, without the end marker.
+    def read_lines(self):
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise sp.CalledProcessError(self.process.wait(), self.process.args)
+            if line == DIFF_END_MARKER:
+                return
+            # with -z, the marker directly follows the last null separated path
+            if line.endswith(b"\0" + DIFF_END_MARKER):
+                yield line[:-len(DIFF_END_MARKER)]
+                return
+            yield line
+
+    # Parse the output of every (old, new) pair of commits with parse, which is given an iterable of the lines of the
+    # output. The queries are written by a thread while the outputs are read, so that neither process blocks on a
+    # full pipe.
+    def diff(self, commit_pairs, parse):
+        writer = threading.Thread(target=self.write_queries, args=(commit_pairs,))
+        writer.start()
+        results = []
+        for _ in commit_pairs:
+            lines = self.read_lines()
+            results.append(parse(lines))
+            # the output of the next query starts after the end marker
+            for _ in lines:
+                pass
+        writer.join()
+        return results
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+# Parse the lines of "diff-tree -z --name-only" into the changed paths, a path may span several lines.
+def split_paths(lines):
+    paths = []
+    pending = b""
+    for line in lines:
+        entries = (pending + line).split(b"\0")
+        pending = entries.pop()
+        paths.extend(str(entry, 'utf-8') for entry in entries if entry)
+    if pending:
+        paths.append(str(pending, 'utf-8'))
+    # the first entry is the commit the paths were compared against
+    return paths[1:]
+
+
+# The path of a "+++ b/<path>" line. Git ends paths containing spaces with a tab and quotes paths with special
+# characters like C strings, with octal escapes for the bytes of non-ASCII characters.
+def patch_path(name):
+    if name.endswith(b"\t"):
+        name = name[:-1]
+    if name.startswith(b'"'):
+        name = codecs.escape_decode(name[1:-1])[0]
+    return str(name[2:], 'utf-8')
+
+
+# Parse the lines of "diff-tree -p -U0 --full-index" into {path: (blob, changed lines)} for every path that exists
+# after the change. A single changed line n is given as range(n, n), lines added at once as range(first, last + 1).
+def parse_patch(lines):
+    changes = {}
+    blob = None
+    intervals = None
+    in_header = False
+    for line in lines:
+        line = line.rstrip(b"\n")
+        if line.startswith(b"diff --git "):
+            in_header = True
+            blob = None
+            intervals = None
+        elif in_header and line.startswith(b"index "):
+            # "index <old blob>..<new blob> [<mode>]"
+            blob = str(line.split()[1].split(b"..")[1], 'utf-8')
+        elif in_header and (line.startswith(b"+++ b/") or line.startswith(b'+++ "b/')):
+            # files deleted by the change are listed as "+++ /dev/null"
+            intervals = []
+            changes[patch_path(line[4:])] = (blob, intervals)
+        elif line.startswith(b"@@ "):
+            in_header = False
+            if intervals is None:
+                continue
+            # "@@ -<old start>[,<old count>] +<new start>[,<new count>] @@"
+            change = str(line.split()[2][1:], 'utf-8')
+            if constants.INPUT_LINE_NUMBER_SEPARATOR in change:
+                start, length = change.split(constants.INPUT_LINE_NUMBER_SEPARATOR)
+                intervals.append(range(int(start), int(start) + int(length)))
+            else:
+                intervals.append(range(int(change), int(change)))
+    return changes
+
+
+# raised for revisions that name no commit of the repository
+class UnknownRevisionError(ValueError):
+    pass
+
+
+# Long running git processes answering the revision, object and diff queries of the analysis of one repository.
+# Diffs between two commits never change, so the diffs of the last GIT_CACHED_DIFFS pairs of commits are kept.
+class GitChannel:
+    def __init__(self, src_path):
+        self.src_path = src_path
+        self.lock = threading.Lock()
+        self.objects = ObjectReader(src_path)
+        # rename detection like "git diff", so that renamed files are not reported as changed entirely
+        self.names = DiffReader(src_path, "-M", "--name-only", "-z")
+        self.patches = DiffReader(src_path, "-M", "-p", "-U0", "--full-index")
+        self.diffs = OrderedDict()
+
+    # return the hash of the commit a revision points to
+    def resolve(self, revision):
+        with self.lock:
+            commit = self.objects.resolve(revision)
+        if commit is None:
+            raise UnknownRevisionError("unknown revision {}".format(revision))
+        return commit
+
+    def read(self, object_name):
+        with self.lock:
+            return self.objects.read(object_name)
+
+    # the first merge base of every (master, branch) pair of commits, found by a single "git rev-parse"
+    def merge_bases(self, commit_pairs):
+        output = sp.check_output([*constants.GIT_CALL, str(self.src_path.resolve()), "rev-parse",
+                                  *["{}...{}".format(master, branch) for master, branch in commit_pairs]])
+        # every pair is listed as master, branch and its merge bases prefixed by "^"
+        bases = []
+        tips = 0
+        for line in str(output, 'utf-8').split():
+            if not line.startswith("^"):
+                if tips % 2 == 0:
+                    bases.append(None)
+                tips += 1
+            elif bases[-1] is None:
+                bases[-1] = line[1:]
+        for (master, branch), base in zip(commit_pairs, bases):
+            if base is None:
+                raise ValueError("{} and {} have no merge base".format(master, branch))
+        return bases
+
+    # Compare every (master, branch) pair of revisions. Returns for every pair the paths that differ between master
+    # and branch and the changes of the branch since its merge base with master, as {path: (blob, changed lines)}.
+    # The diffs of all pairs not compared before are computed in a single pass through both diff processes.
+    def branch_diffs(self, revision_pairs):
+        commit_pairs = [(self.resolve(master), self.resolve(branch)) for master, branch in revision_pairs]
+        with self.lock:
+            missing = sorted(set([pair for pair in commit_pairs if pair not in self.diffs]))
+            if missing:
+                bases = self.merge_bases(missing)
+                names = self.names.diff(missing, split_paths)
+                patches = self.patches.diff([(base, branch) for base, (_, branch) in zip(bases, missing)],
+                                            parse_patch)
+                for pair, changed_paths, changes in zip(missing, names, patches):
+                    self.diffs[pair] = (changed_paths, changes)
+            for pair in commit_pairs:
+                self.diffs.move_to_end(pair)
+            result = [self.diffs[pair] for pair in commit_pairs]
+            while len(self.diffs) > constants.GIT_CACHED_DIFFS:
+                self.diffs.popitem(last=False)
+            return result
+
+    def close(self):
+        self.objects.close()
+        self.names.close()
+        self.patches.close()
+
+
+channels = {}
+channels_lock = threading.Lock()
+
+
+# the channel to the repository of src_path, started on first use and kept open for all later queries
+def git_channel(src_path):
+    key = str(src_path.resolve())
+    with channels_lock:
+        if key not in channels:
+            channels[key] = GitChannel(src_path.resolve())
+        return channels[key]
+
+
+# Paths changed in the working tree of src_path, including the index, compared to a revision.
+# The working tree can not be compared by the diff-tree processes of the channel, every call runs "git diff".
+def worktree_changes(src_path, revision):
+    output = sp.check_output([*constants.GIT_CALL, str(src_path.resolve()), "diff", "--name-only", "-z", revision])
+    return [str(entry, 'utf-8') for entry in output.split(b"\0") if entry]
+
+
+# Write the given file versions, as (relative path, blob), to target_path without touching the working tree.
+# Returns the path every version was written to.
+def write_blobs(src_path, versions, target_path):
+    version_paths = {}
+    channel = git_channel(src_path)
+    for rel_path, blob in versions:
+        content = channel.read(blob)
+        if content is None:
+            continue
+        path = target_path / blob / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        version_paths[(rel_path, blob)] = path
+    return version_paths
+
+
+# path of src_path relative to the root of its repository, ending with "/" unless empty
+def get_prefix(src_path):
+    output = sp.check_output([*constants.GIT_CALL, str(src_path.resolve()), "rev-parse", "--show-prefix"])
+    return str(output, 'utf-8').strip()
+
+
+# Create a throwaway worktree of the repository at the given revision.
+# Returns the root of the worktree and the path corresponding to src_path within it.
+def create_worktree(src_path, revision):
+    worktree_path = Path(tempfile.mkdtemp(prefix="worktree_"))
+    print("creating temporary worktree at {}".format(worktree_path))
+    sp.check_output([*constants.GIT_CALL, str(src_path.resolve()), "worktree", "add", "--detach",
+                     str(worktree_path), revision])
+    return worktree_path, worktree_path / get_prefix(src_path)
+
+
+def remove_worktree(src_path, worktree_path):
+    print("removing temporary worktree at {}".format(worktree_path))
+    sp.run([*constants.GIT_CALL, str(src_path.resolve()), "worktree", "remove", "--force", str(worktree_path)])
+    sp.run([*constants.GIT_CALL, str(src_path.resolve()), "worktree", "prune"])
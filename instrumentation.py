@@ -0,0 +1,176 @@
+from pathlib import Path
+from contextlib import contextmanager
+import time
+import resource
+import threading
+import tracemalloc
+import ujson
+
+# Collects the wall time, CPU time and peak memory of the stages of a run and counts of the items they processed.
+# Counts may carry labels, e.g. the branch whose changed units are counted. Worker processes hand their counts
+# back with take_counts, so that the parent process can merge them.
+
+stages = []
+counts = {}
+counts_lock = threading.Lock()
+# record the peak of python allocations of every stage, slows down all stages
+trace_memory = False
+# resident set size peaks of the open stages, the outermost first, and of the run, measured before the peak was
+# last reset, which also resets ru_maxrss
+open_rss_peaks = []
+run_rss_peak = 0
+
+PROC_STATUS = Path("/proc/self/status")
+PROC_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+METRIC_PREFIX = "merge_conflicts_"
+
+
+def count_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+# add to a count
+def count(name, value=1, **labels):
+    key = count_key(name, labels)
+    with counts_lock:
+        counts[key] = counts.get(key, 0) + value
+
+
+# set a count, for values like the size of a graph that are measured instead of accumulated
+def gauge(name, value, **labels):
+    with counts_lock:
+        counts[count_key(name, labels)] = value
+
+
+def take_counts():
+    global counts
+    with counts_lock:
+        taken = counts
+        counts = {}
+    return taken
+
+
+def merge_counts(other_counts):
+    with counts_lock:
+        for key, value in other_counts.items():
+            counts[key] = counts.get(key, 0) + value
+
+
+def cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+# the peak resident set size of the process since its last reset in bytes, None if it can not be read
+def read_peak_rss():
+    try:
+        with PROC_STATUS.open() as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# Reset the peak resident set size to the current one, which linux supports since 4.0. The peak so far is kept
+# for the open stages first. Returns whether the peak was reset.
+def reset_peak_rss():
+    global run_rss_peak
+    peak = read_peak_rss()
+    if peak is None:
+        return False
+    run_rss_peak = max(run_rss_peak, peak)
+    for i, open_peak in enumerate(open_rss_peaks):
+        if open_peak is not None:
+            open_rss_peaks[i] = max(open_peak, peak)
+    try:
+        with PROC_CLEAR_REFS.open("w") as fp:
+            fp.write("5")
+    except OSError:
+        return False
+    return True
+
+
+# Measure a stage. CPU time of child processes covers srcml and git, as well as worker processes once they ended.
+# The peak resident set size of the process is reset at the start of every stage, so that max_rss_bytes is the peak
+# of the stage itself, or None where the peak can not be reset. The resident set sizes of the process and of its
+# largest child over the whole run so far are process_max_rss_bytes and child_max_rss_bytes.
+@contextmanager
+def stage(name):
+    global run_rss_peak
+    if trace_memory:
+        tracemalloc.start()
+    open_rss_peaks.append(0 if reset_peak_rss() else None)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_before
+        cpu = time.process_time() - cpu_before
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rss_peak = open_rss_peaks.pop()
+        if rss_peak is not None:
+            rss_peak = max(rss_peak, read_peak_rss() or 0)
+            run_rss_peak = max(run_rss_peak, rss_peak)
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        stages.append({"stage": name,
+                       "wall_seconds": round(wall, 3),
+                       "cpu_seconds": round(cpu, 3),
+                       "child_cpu_seconds": round(cpu_seconds(children) - cpu_seconds(children_before), 3),
+                       "peak_traced_bytes": peak,
+                       "max_rss_bytes": rss_peak,
+                       # kilobytes on linux
+                       "process_max_rss_bytes": max(run_rss_peak,
+                                                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+                       "child_max_rss_bytes": children.ru_maxrss * 1024})
+
+
+def metrics():
+    return {"stages": list(stages),
+            "counts": [{"name": name, "labels": dict(labels), "value": value}
+                       for (name, labels), value in sorted(counts.items())]}
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_sample(name, labels, value):
+    if labels:
+        label_text = ",".join(["{}=\"{}\"".format(key, escape_label(label)) for key, label in labels])
+        return "{}{}{{{}}} {}".format(METRIC_PREFIX, name, label_text, value)
+    return "{}{} {}".format(METRIC_PREFIX, name, value)
+
+
+# all metrics in the text format of prometheus, one gauge per stage measurement and per count
+def prometheus_text():
+    lines = []
+    for measurement in ["wall_seconds", "cpu_seconds", "child_cpu_seconds", "peak_traced_bytes", "max_rss_bytes",
+                        "process_max_rss_bytes", "child_max_rss_bytes"]:
+        samples = [prometheus_sample("stage_" + measurement, [("stage", record["stage"])], record[measurement])
+                   for record in stages if record[measurement] is not None]
+        if samples:
+            lines.append("# TYPE {}stage_{} gauge".format(METRIC_PREFIX, measurement))
+            lines += samples
+    names = sorted(set([name for name, _ in counts.keys()]))
+    for name in names:
+        lines.append("# TYPE {}{} gauge".format(METRIC_PREFIX, name))
+        lines += [prometheus_sample(name, labels, value) for (other_name, labels), value in sorted(counts.items())
+                  if other_name == name]
+    return "\n".join(lines) + "\n"
+
+
+# save the metrics of the run, in the text format of prometheus for files ending in .prom and as json otherwise
+def save_metrics(path):
+    path = Path(path)
+    with path.open("w") as fp:
+        if path.suffix == ".prom":
+            fp.write(prometheus_text())
+        else:
+            ujson.dump(metrics(), fp, indent=4, sort_keys=True)
@@ -1,11 +1,19 @@
+import hashlib
+from array import array
 import subprocess as sp
+import threading
+from multiprocessing import Pool
 import lxml.etree as etree
-from scipy.sparse import lil_matrix, save_npz
+from scipy.sparse import coo_matrix, csr_matrix
 import ujson
 import numpy as np
 from tqdm import tqdm
 import constants
 import save_and_load as io
+import blob_cache
+import instrumentation
+import reachability
+import tokenizer
 
 
 def find_includes(xpath_find_includes, unit, properties):
@@ -78,112 +86,762 @@ def find_named_units(xpath_find_named_units, xpath_find_calls, xpath_named_unit_
             properties[constants.CALLS_NAIVE].setdefault(name, {name}).update(calls, xpath_find_calls(unit))
 
 
-# parse the entire source directory.
-# If changed_files is passed, all other files will be skipped
-def parse_source_code(src_path, changed_files=None):
-    scanned_paths = set([])
+# first and last line of a node of positional srcml, supporting "pos:line" as well as "pos:start" and "pos:end"
+def get_position_lines(node):
+    lines = []
+    line = node.get(constants.POSITION_ATTRIBUTES["line"])
+    if line:
+        lines.append(int(line))
+    for position in (node.get(constants.POSITION_ATTRIBUTES["start"]), node.get(constants.POSITION_ATTRIBUTES["end"])):
+        if position:
+            lines.append(int(position.split(":")[0]))
+    return lines
+
+
+# Find the named units of positional srcml with the first and last line of any of their descendants.
+# Returns (first line, last line, name) sorted by the first line, the spans are computed in one walk over the tree.
+def find_named_unit_spans(xpath_find_named_units, xpath_named_unit_name_query, element):
+    named_units = set(xpath_find_named_units(element))
+    spans = []
+    # first and last line seen below every open element
+    open_spans = []
+    for event, node in etree.iterwalk(element, events=("start", "end")):
+        if event == "start":
+            lines = get_position_lines(node)
+            open_spans.append([min(lines), max(lines)] if lines else [None, None])
+            continue
+        first, last = open_spans.pop()
+        if first is None:
+            continue
+        if open_spans:
+            parent_span = open_spans[-1]
+            parent_span[0] = first if parent_span[0] is None else min(parent_span[0], first)
+            parent_span[1] = last if parent_span[1] is None else max(parent_span[1], last)
+        if node in named_units:
+            name, _ = get_named_unit_name(xpath_named_unit_name_query, node)
+            if name:
+                spans.append((first, last, name))
+    spans.sort(key=lambda span: span[0])
+    return spans
+
+
+# compile the xpath queries used to extract includes and named units from srcml
+def compile_preprocessing_queries():
     xpath_find_includes = etree.XPath(".//cpp:include/cpp:file/text()", namespaces=constants.ns)
     xpath_find_named_units = etree.XPath(".//*[({0})]".format(constants.NAMED_UNIT_QUERY), namespaces=constants.ns)
     xpath_find_calls = etree.XPath(".//*[{0}]//src:name/text()".format(constants.CALLING_UNIT_QUERY), namespaces=constants.ns)
     xpath_named_unit_name_query = etree.XPath(constants.NAMED_UNIT_NAME_QUERY, namespaces=constants.ns)
-    parser = etree.XMLParser(huge_tree=True)
+    return xpath_find_includes, xpath_find_named_units, xpath_find_calls, xpath_named_unit_name_query
+
+
+# compiled queries of the current process, lxml objects can not be passed to worker processes
+worker_queries = None
+
+
+def init_preprocessing_worker(worker_process=False):
+    global worker_queries
+    if worker_process:
+        # forked workers inherit the counts of the parent process, which must not be merged back a second time
+        instrumentation.take_counts()
+    worker_queries = compile_preprocessing_queries()
+
+
+# Extract the files srcml could not parse with the tokenizer, if TOKENIZER_FALLBACK is set.
+# Expects the extracted result or None for every path and returns (result, extractor) for every path,
+# so that the results of the fallback are cached as results of the tokenizer.
+def tokenizer_fallback(src_path, paths, extracted):
+    results = []
+    for path, result in zip(paths, extracted):
+        if result is None and constants.TOKENIZER_FALLBACK:
+            tqdm.write("extracting {} with the tokenizer".format(str((src_path / path).resolve())))
+            instrumentation.count("tokenizer_fallbacks")
+            results.append((tokenizer.extract_file(src_path / path), constants.EXTRACTOR_TOKENIZER))
+        else:
+            results.append((result, constants.EXTRACTOR))
+    return results
+
+
+# Run srcml on a batch of files and extract the includes and named units of every file from its whole tree.
+# Returns the properties of every file, None for files that could not be parsed.
+def srcml_properties(src_path, paths, queries):
+    xpath_find_includes, xpath_find_named_units, xpath_find_calls, xpath_named_unit_name_query = queries
+    results = []
+    for element in run_srcml_batch(src_path, paths, parser=etree.XMLParser(huge_tree=True)):
+        if element is None:
+            results.append(None)
+            continue
+        properties = {constants.INCLUDES: set([]), constants.CALLS_NAIVE: {}}
+        find_includes(xpath_find_includes, element, properties)
+        find_named_units(xpath_find_named_units, xpath_find_calls, xpath_named_unit_name_query, element, properties)
+        results.append(properties)
+    return results
+
+
+# Extract the includes and named units of a batch of files with the configured extractor.
+# Returns (properties, extractor) for every file, with properties of None for files that could not be parsed.
+def extract_properties(src_path, paths, queries):
+    if constants.EXTRACTOR == constants.EXTRACTOR_TOKENIZER:
+        extracted = [(tokenizer.extract_file(src_path / path), constants.EXTRACTOR_TOKENIZER) for path in paths]
+    elif constants.STREAMING_EXTRACTION:
+        extracted = tokenizer_fallback(src_path, paths, stream_srcml_batch(src_path, paths))
+    else:
+        extracted = tokenizer_fallback(src_path, paths, [(properties, None) if properties is not None else None
+                                                         for properties in srcml_properties(src_path, paths, queries)])
+    return [(result[0] if result else None, extractor) for result, extractor in extracted]
+
+
+# extract the includes and named units of a batch of files, as (relative path, properties, extractor)
+def preprocess_batch(src_path, batch, queries):
+    results = []
+    for (_, rel_path), (properties, extractor) in zip(batch, extract_properties(src_path, [path for path, _ in batch],
+                                                                                 queries)):
+        if properties is not None:
+            properties[constants.INCLUDES].add(rel_path)
+        results.append((rel_path, properties, extractor))
+    return results
+
+
+# returns the results of the batch and the counts recorded while preprocessing it
+def preprocess_batch_in_worker(job):
+    src_path, batch = job
+    return preprocess_batch(src_path, batch, worker_queries), instrumentation.take_counts()
+
+
+# merge the counts of every finished batch into the counts of this process and yield its results
+def merge_batch_counts(finished):
+    for results, counts in finished:
+        instrumentation.merge_counts(counts)
+        yield results
+
+
+# preprocess the given batches, using a process pool if more than one worker is requested.
+# The results are yielded in the order in which the batches are finished.
+def preprocess_batches(jobs, workers):
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers, initializer=init_preprocessing_worker, initargs=(True,)) as pool:
+            yield from merge_batch_counts(pool.imap_unordered(preprocess_batch_in_worker, jobs))
+    else:
+        init_preprocessing_worker()
+        yield from merge_batch_counts(map(preprocess_batch_in_worker, jobs))
+
 
+# Split a list into batches of at most the given size, dealing the items round-robin, so that the items at the front of
+# the list are spread over all batches. With the largest files first, every batch gets a share of the large files
+# and no single batch holds all of them.
+def batches(items, batch_size):
+    batch_count = -(-len(items) // batch_size)
+    for i in range(batch_count):
+        yield items[i::batch_count]
+
+
+# Copy the properties of already parsed blobs to the preprocessed files of the given paths.
+# Returns the paths, whose blobs are not cached yet.
+def reuse_cached_blobs(path_blobs):
+    cached_blobs = io.load_blob_properties(set(path_blobs.values()), constants.EXTRACTOR)
+    reused = {rel_path: blob for rel_path, blob in path_blobs.items() if blob in cached_blobs}
+    io.save_preprocessed_files((rel_path, blob_cache.path_properties(rel_path, cached_blobs[blob]))
+                               for rel_path, blob in reused.items())
+    io.save_path_blobs(reused, constants.EXTRACTOR)
+    return set(path_blobs.keys()) - set(reused.keys())
+
+
+# parse the entire source directory.
+# If changed_files is passed, all other files will be skipped.
+# With the blob cache enabled, files tracked by git are only parsed if their content has never been parsed before.
+def parse_source_code(src_path, changed_files=None, workers=constants.PREPROCESSING_WORKERS):
+    scanned_paths = set([])
     paths = set([])
 
-    for file_ext in tqdm(constants.VALID_FILE_EXTENSIONS, desc="finding files"):
+    for file_ext in tqdm(constants.VALID_FILE_EXTENSIONS, desc="finding files", disable=not constants.PROGRESS_BARS):
         paths.update(src_path.rglob("*.{}".format(file_ext)))
 
-    for path in tqdm(paths, desc="parsing files"):
+    worktree_blobs = blob_cache.get_worktree_blobs(src_path) if constants.BLOB_CACHE else {}
+    stored_blobs = io.load_path_blobs(constants.EXTRACTOR) if constants.BLOB_CACHE else {}
+    preprocessed_paths = io.preprocessed_file_paths()
+    outdated_blobs = {}
+    files = {}
+    for path in paths:
         rel_path = str(path.relative_to(src_path).as_posix())
-        jsonpath = constants.DUMP_FOLDER_JSON / (rel_path + ".json")
 
         scanned_paths.add(rel_path)
-        if changed_files is None or rel_path in changed_files or not jsonpath.exists():
-            srcml = run_srcml_one_file(src_path, path)
-            if srcml:
-                properties = {constants.INCLUDES: {rel_path}, constants.CALLS_NAIVE: {}}
-                element = etree.fromstring(srcml, parser)
-                find_includes(xpath_find_includes, element, properties)
-                find_named_units(xpath_find_named_units, xpath_find_calls, xpath_named_unit_name_query, element,
-                                 properties)
+        blob = worktree_blobs.get(rel_path)
+        if blob:
+            if stored_blobs.get(rel_path) != blob or rel_path not in preprocessed_paths:
+                outdated_blobs[rel_path] = blob
+        elif changed_files is None or rel_path in changed_files or rel_path not in preprocessed_paths:
+            files[rel_path] = path
+
+    if outdated_blobs:
+        uncached_paths = reuse_cached_blobs(outdated_blobs)
+        tqdm.write("reused {} cached files".format(len(outdated_blobs) - len(uncached_paths)))
+        instrumentation.count("blob_cache_hits", len(outdated_blobs) - len(uncached_paths))
+        for rel_path in uncached_paths:
+            files[rel_path] = src_path / rel_path
 
-                io.save_preprocessed_file(rel_path, properties)
+    # schedule the largest files first, so that they do not end up as a long tail on a single worker
+    files = sorted(((path, rel_path) for rel_path, path in files.items()), key=lambda file: file[0].stat().st_size,
+                   reverse=True)
+    jobs = [(src_path, batch) for batch in batches(files, constants.SRCML_BATCH_SIZE)]
 
+    instrumentation.count("files_scanned", len(scanned_paths))
+    instrumentation.count("files_parsed", len(files))
+    with tqdm(total=len(files), desc="parsing files", disable=not constants.PROGRESS_BARS) as progress:
+        for results in preprocess_batches(jobs, workers):
+            progress.update(len(results))
+            parsed_count = len(results)
+            results = [(rel_path, properties, extractor) for rel_path, properties, extractor in results if properties]
+            instrumentation.count("files_failed", parsed_count - len(results))
+            io.save_preprocessed_files((rel_path, properties) for rel_path, properties, _ in results)
+            if constants.BLOB_CACHE:
+                io.save_blob_properties((worktree_blobs[rel_path], extractor,
+                                         blob_cache.blob_properties(rel_path, properties))
+                                        for rel_path, properties, extractor in results if rel_path in worktree_blobs)
+                # recorded with the configured extractor, even for the files of the tokenizer fallback
+                io.save_path_blobs({rel_path: worktree_blobs.get(rel_path) for rel_path, _, _ in results},
+                                   constants.EXTRACTOR)
+
+    # drop the preprocessed files of deleted files
+    deleted_paths = preprocessed_paths - scanned_paths
+    if deleted_paths:
+        io.delete_preprocessed_files(deleted_paths)
     io.save_paths(scanned_paths)
+    if constants.BLOB_CACHE:
+        io.evict_blobs(constants.BLOB_CACHE_MAX_SIZE)
+
+
+# fingerprint of the properties of a preprocessed file, used to detect changed files between call graph builds
+def fingerprint_properties(properties):
+    content = [sorted(properties[constants.INCLUDES]),
+               sorted((unit, calls.tolist()) for unit, calls in properties[constants.CALLS_NAIVE].items())]
+    return hashlib.md5(ujson.dumps(content).encode("utf-8")).hexdigest()
+
+
+# Index the named units of every file by their symbol IDs. Returns for every file the sorted symbol IDs
+# and the unit IDs in the same order.
+def build_unit_index(named_unit_dict, named_unit_to_id):
+    io.intern_symbols(list(set([]).union(*named_unit_dict.values())))
+    unit_index = {}
+    for path, named_units in named_unit_dict.items():
+        named_units = list(named_units)
+        symbols = np.array(io.intern_symbols(named_units), dtype=np.int64)
+        unit_ids = np.array([named_unit_to_id[(path, named_unit)] for named_unit in named_units], dtype=np.int64)
+        order = np.argsort(symbols)
+        unit_index[path] = symbols[order], unit_ids[order]
+    return unit_index
+
+
+# Index all preprocessed files and include targets and build the sparse matrix of their direct includes.
+# Returns the list of files, the index of every file and the matrix.
+def build_include_graph(includes_dict):
+    files = sorted(set(includes_dict.keys()).union(*includes_dict.values()))
+    file_index = {file: index for index, file in enumerate(files)}
+    rows = array("q")
+    columns = array("q")
+    for including_file, includes in includes_dict.items():
+        rows.extend([file_index[including_file]] * len(includes))
+        columns.extend([file_index[include] for include in includes])
+    include_graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (np.frombuffer(rows, dtype=np.int64),
+                                                                     np.frombuffer(columns, dtype=np.int64))),
+                               shape=(len(files), len(files)))
+    return files, file_index, include_graph
+
+
+# The files whose named units may be called from every file, as a boolean matrix.
+# Call edges reach MAX_TRANSITIVE_INCLUDE_LEVEL + 1 includes deep. Every preprocessed file includes itself,
+# so it is part of its own row.
+def build_include_closure(include_graph):
+    return reachability.bounded_reachability(include_graph, constants.MAX_TRANSITIVE_INCLUDE_LEVEL + 1,
+                                             constants.INCLUDE_BLOCK_SIZE)
+
+
+# Find the call edges starting in the named units of the given including files.
+# Calls are only matched against the files reachable in the include closure. The called symbols of all units
+# of a file are joined with the sorted symbols of all reachable units at once.
+# Returns the edges as two arrays of caller and callee IDs.
+def find_call_edges(including_files, preprocessed_files, unit_index, files, file_index, include_closure):
+    from_ids = [np.empty(0, dtype=np.int64)]
+    to_ids = [np.empty(0, dtype=np.int64)]
+    for including_file in tqdm(including_files, desc="building callgraph: ", disable=not constants.PROGRESS_BARS):
+        including_file_dict = preprocessed_files.get(including_file)
+        if not including_file_dict or not including_file_dict[constants.CALLS_NAIVE]:
+            continue
+        row = file_index[including_file]
+        callable_units = [unit_index[files[included_file]] for included_file in
+                          include_closure.indices[include_closure.indptr[row]:include_closure.indptr[row + 1]]
+                          if files[included_file] in unit_index]
+        if not callable_units:
+            continue
+        callable_symbols = np.concatenate([symbols for symbols, _ in callable_units])
+        order = np.argsort(callable_symbols, kind="stable")
+        callable_symbols = callable_symbols[order]
+        callable_ids = np.concatenate([unit_ids for _, unit_ids in callable_units])[order]
+
+        calling_symbols, calling_ids = unit_index[including_file]
+        calls_naive = including_file_dict[constants.CALLS_NAIVE]
+        caller_ids = calling_ids[np.searchsorted(calling_symbols, io.intern_symbols(list(calls_naive.keys())))]
+        calls = np.concatenate(list(calls_naive.values()))
+        callers = np.repeat(caller_ids, [len(unit_calls) for unit_calls in calls_naive.values()])
+
+        # every call matches the run of equal symbols between left and right
+        left = np.searchsorted(callable_symbols, calls, side="left")
+        counts = np.searchsorted(callable_symbols, calls, side="right") - left
+        matched = counts > 0
+        left, counts = left[matched], counts[matched]
+        offsets = np.cumsum(counts) - counts
+        from_ids.append(np.repeat(callers[matched], counts))
+        to_ids.append(callable_ids[np.repeat(left - offsets, counts) + np.arange(counts.sum())])
+    return np.concatenate(from_ids), np.concatenate(to_ids)
+
+
+# find all files that include one of the given files, directly or up to the maximal transitive include level
+def find_including_files(changed_files, files, file_index, include_closure):
+    including_files = set(changed_files)
+    columns = [file_index[file] for file in changed_files if file in file_index]
+    if columns:
+        rows = np.flatnonzero(include_closure[:, columns].getnnz(axis=1))
+        including_files.update([files[row] for row in rows])
+    return including_files
+
+
+def edge_matrix(from_ids, to_ids, size):
+    return coo_matrix((np.ones(len(from_ids), dtype=np.int8), (from_ids, to_ids)), shape=(size, size)).tocsr()
+
+
+# grow a square csr matrix to the given size, keeping its entries
+def resize_graph(graph, size):
+    indptr = np.concatenate([graph.indptr, np.full(size - graph.shape[0], graph.indptr[-1], dtype=graph.indptr.dtype)])
+    return csr_matrix((graph.data, graph.indices, indptr), shape=(size, size))
 
 
-def build_call_graph():
-    paths = io.load_paths()
-    named_unit_dict = {}
-    includes_dict = {}
+# the IDs below size, that belong to no named unit, in increasing order
+def unused_ids(named_unit_to_id, size):
+    used = np.zeros(size, dtype=bool)
+    used[np.fromiter(named_unit_to_id.values(), dtype=np.int64, count=len(named_unit_to_id))] = True
+    return np.flatnonzero(~used).tolist()
 
-    id_counter = 0
-    named_unit_to_id = {}
-    for path in tqdm(paths, desc="assigning IDs to named units: "):
-        properties = io.load_preprocessed_file(path)
-        if properties:
-            named_unit_dict[path] = set(properties[constants.CALLS_NAIVE].keys())
-            includes_dict[path] = properties[constants.INCLUDES]
-            for named_unit in properties[constants.CALLS_NAIVE].keys():
+
+# Renumber the named units to consecutive IDs in the order of their current IDs and drop the unused IDs from the graph.
+# Returns the graph and the ID dict of the new IDs.
+def compact_ids(called_by_graph, named_unit_to_id):
+    named_units = sorted(named_unit_to_id.items(), key=lambda item: item[1])
+    ids = np.array([unit_id for _, unit_id in named_units], dtype=np.int64)
+    called_by_graph = called_by_graph[ids][:, ids].tocsr()
+    return called_by_graph, {named_unit: unit_id for unit_id, (named_unit, _) in enumerate(named_units)}
+
+
+# load the called_by_graph of the previous build, if it was built from the same include level, as a writable copy
+def load_previous_call_graph():
+    call_graph_files = io.load_call_graph_files()
+    if call_graph_files is None or call_graph_files["include_level"] != constants.MAX_TRANSITIVE_INCLUDE_LEVEL:
+        return None
+    called_by_graph = io.load_called_by_graph()
+    if called_by_graph is None:
+        return None
+    _, named_unit_to_id = io.load_id_dicts()
+    return csr_matrix(called_by_graph, copy=True), dict(named_unit_to_id.items()), call_graph_files["files"]
+
+
+# The preprocessed files of all scanned paths with their fingerprints, named units and include closure, as read by
+# build_call_graph. Long running processes like server.py keep one instance, so that a build only loads the files
+# this process saved or deleted since the previous build, unless another process changed preprocessed files meanwhile.
+# The called_by_graph and the ID dict of the last build are kept as well, to update them without loading them again.
+class PreprocessedFiles:
+    def __init__(self):
+        # io.change_sequence and io.database_version at the last update
+        self.sequence = 0
+        self.version = None
+        self.paths = None
+        self.preprocessed_files = {}
+        self.fingerprints = {}
+        self.named_unit_dict = {}
+        self.includes_dict = {}
+        # files, file_index and include_closure of the include graph
+        self.include_closure = None
+        # called_by_graph, named_unit_to_id and fingerprints of the last build
+        self.previous = None
+
+    def update(self):
+        changed_paths, sequence = io.changes_since(self.sequence)
+        version = io.database_version()
+        paths = io.load_paths()
+        if self.paths is None or version is None or version != self.version:
+            self.__init__()
+            loaded = dict((path, properties) for path, properties in io.load_preprocessed_files() if path in paths)
+            reload_paths = paths
+        else:
+            reload_paths = changed_paths.union(paths.symmetric_difference(self.paths))
+            loaded = dict(io.load_preprocessed_files(reload_paths.intersection(paths)))
+        instrumentation.count("preprocessed_files_loaded", len(loaded))
+
+        includes_changed = self.include_closure is None
+        for path in reload_paths:
+            self.preprocessed_files.pop(path, None)
+            self.fingerprints.pop(path, None)
+            self.named_unit_dict.pop(path, None)
+            includes = self.includes_dict.pop(path, None)
+            properties = loaded.get(path)
+            if properties is not None:
+                self.preprocessed_files[path] = properties
+                self.fingerprints[path] = fingerprint_properties(properties)
+                self.named_unit_dict[path] = set(properties[constants.CALLS_NAIVE].keys())
+                self.includes_dict[path] = properties[constants.INCLUDES]
+            if includes != self.includes_dict.get(path):
+                includes_changed = True
+        self.paths = paths
+        self.sequence = sequence
+        self.version = version
+
+        if includes_changed:
+            files, file_index, include_graph = build_include_graph(self.includes_dict)
+            self.include_closure = files, file_index, build_include_closure(include_graph)
+
+
+# Build the call graph of all preprocessed files and return the called_by_graph and both ID dicts,
+# as views of the saved graph and symbol table.
+# Only the called_by_graph is stored, the call graph is its transpose, loaded by io.load_call_graph.
+# In incremental mode only the edges of changed files and the files including them are rebuilt,
+# named units keep their IDs between builds. A PreprocessedFiles kept between builds is updated and used instead of
+# loading all preprocessed files and the previous call graph.
+def build_call_graph(incremental=constants.INCREMENTAL_CALL_GRAPH, resident=None):
+    if resident is None:
+        resident = PreprocessedFiles()
+    resident.update()
+    paths = resident.paths
+    preprocessed_files = resident.preprocessed_files
+    fingerprints = resident.fingerprints
+    named_unit_dict = resident.named_unit_dict
+    files, file_index, include_closure = resident.include_closure
+    instrumentation.gauge("include_closure_pairs", include_closure.nnz)
+
+    previous = None
+    if incremental:
+        # taken from the resident files, as it is updated in place
+        previous, resident.previous = resident.previous, None
+        if previous is None:
+            previous = load_previous_call_graph()
+    if previous is None:
+        id_counter = 0
+        named_unit_to_id = {}
+        # in sorted order, so that the same files get the same IDs on every build
+        for path in tqdm(sorted(paths), desc="assigning IDs to named units: ", disable=not constants.PROGRESS_BARS):
+            for named_unit in sorted(named_unit_dict.get(path, set([]))):
                 named_unit_to_id[(path, named_unit)] = id_counter
                 id_counter += 1
 
-    call_graph = lil_matrix((id_counter, id_counter), dtype=np.int8)
-    called_by_graph = lil_matrix((id_counter, id_counter), dtype=np.int8)
-
-    for including_file in tqdm(paths, desc="building callgraph: "):
-        scanned_files = set([])
-        including_file_dict = io.load_preprocessed_file(including_file)
-        if including_file_dict:
-            included_files = set([(include, 0) for include in including_file_dict[constants.INCLUDES]])
-            while included_files:
-                included_file, include_level = included_files.pop()
-                if include_level < constants.MAX_TRANSITIVE_INCLUDE_LEVEL:
-                    scanned_files.add(included_file)
-                    included_files = included_files.union([(include, include_level + 1) for include in
-                                                           includes_dict.get(included_file, set([])) - scanned_files])
-                calling_named_units = named_unit_dict[including_file]
-                callable_units = named_unit_dict.get(included_file, set([]))
-                for calling_named_unit in calling_named_units:
-                    calls = including_file_dict[constants.CALLS_NAIVE].get(calling_named_unit, set([]))
-                    for callable_unit in callable_units:
-                        if callable_unit in calls:
-                            from_id = named_unit_to_id[(including_file, calling_named_unit)]
-                            to_id = named_unit_to_id[(included_file, callable_unit)]
-                            call_graph[from_id, to_id] = 1
-                            called_by_graph[to_id, from_id] = 1
-
-    call_graph = call_graph.tocsr()
-    called_by_graph = called_by_graph.tocsr()
-
-    id_to_named_unit = {}
-    for k, v in named_unit_to_id.items():
-        id_to_named_unit[v] = (k[0], k[1])
-
-    print("save call_graph.npz...")
-    save_npz("call_graph.npz", call_graph)
-    print("save called_by_graph.npz...")
-    save_npz("called_by_graph.npz", called_by_graph)
-
-    print("save id_to_named_unit.json...")
-    with open("id_to_named_unit.json", 'w') as fp:
-        ujson.dump(id_to_named_unit, fp)
-
-
-def run_srcml_one_file(src_path, path):
-    query = ["srcml", "-X", "--register-ext", "{}=C++".format(path.suffix[1:])]
+        unit_index = build_unit_index(named_unit_dict, named_unit_to_id)
+        from_ids, to_ids = find_call_edges(paths, preprocessed_files, unit_index, files, file_index, include_closure)
+        called_by_graph = edge_matrix(to_ids, from_ids, id_counter)
+    else:
+        called_by_graph, named_unit_to_id, previous_fingerprints = previous
+        changed_files = set([path for path in set(fingerprints.keys()).union(previous_fingerprints.keys())
+                             if fingerprints.get(path) != previous_fingerprints.get(path)])
+        affected_files = find_including_files(changed_files, files, file_index,
+                                              include_closure).intersection(preprocessed_files.keys())
+        print("updating call graph: {} changed files, {} affected files".format(len(changed_files),
+                                                                               len(affected_files)))
+        instrumentation.gauge("call_graph_changed_files", len(changed_files))
+        instrumentation.gauge("call_graph_affected_files", len(affected_files))
+
+        removed_ids = []
+        affected_ids = []
+        for (path, named_unit), unit_id in list(named_unit_to_id.items()):
+            if path in changed_files and named_unit not in named_unit_dict.get(path, set([])):
+                removed_ids.append(unit_id)
+                del named_unit_to_id[(path, named_unit)]
+            elif path in affected_files:
+                affected_ids.append(unit_id)
+
+        # new units take the IDs freed by removed units first, so that the graph only grows with the number of units
+        id_counter = called_by_graph.shape[0]
+        free_ids = unused_ids(named_unit_to_id, id_counter)[::-1]
+        for path in sorted(changed_files.intersection(preprocessed_files.keys())):
+            for named_unit in sorted(named_unit_dict[path]):
+                if (path, named_unit) not in named_unit_to_id:
+                    if free_ids:
+                        named_unit_to_id[(path, named_unit)] = free_ids.pop()
+                    else:
+                        named_unit_to_id[(path, named_unit)] = id_counter
+                        id_counter += 1
+
+        # drop the calls of affected units and all edges of removed units in place
+        called_by_graph = resize_graph(called_by_graph, id_counter)
+        for unit_id in removed_ids:
+            called_by_graph.data[called_by_graph.indptr[unit_id]:called_by_graph.indptr[unit_id + 1]] = 0
+        if affected_ids or removed_ids:
+            called_by_graph.data[np.isin(called_by_graph.indices, affected_ids + removed_ids)] = 0
+        called_by_graph.eliminate_zeros()
+
+        unit_index = build_unit_index(named_unit_dict, named_unit_to_id)
+        from_ids, to_ids = find_call_edges(affected_files, preprocessed_files, unit_index, files, file_index,
+                                           include_closure)
+        called_by_graph = called_by_graph + edge_matrix(to_ids, from_ids, id_counter)
+
+        if id_counter and 1 - len(named_unit_to_id) / id_counter > constants.CALL_GRAPH_MAX_UNUSED_IDS:
+            print("compacting the IDs of {} named units".format(len(named_unit_to_id)))
+            called_by_graph, named_unit_to_id = compact_ids(called_by_graph, named_unit_to_id)
+            id_counter = len(named_unit_to_id)
+
+    instrumentation.gauge("named_units", len(named_unit_to_id))
+    instrumentation.gauge("call_graph_edges", called_by_graph.nnz)
+
+    resident.previous = called_by_graph, named_unit_to_id, dict(fingerprints)
+
+    print("save called_by_graph...")
+    io.save_called_by_graph(called_by_graph)
+
+    print("save symbol table...")
+    io.save_id_dicts(named_unit_to_id, id_counter)
+    io.save_call_graph_files({"include_level": constants.MAX_TRANSITIVE_INCLUDE_LEVEL, "files": fingerprints})
+    return (io.load_called_by_graph(), *io.load_id_dicts())
+
+
+# register all valid file extensions as C++, so that srcml accepts every file of a batch
+def srcml_extension_arguments():
+    arguments = []
+    for file_ext in constants.VALID_FILE_EXTENSIONS:
+        arguments += ["--register-ext", "{}=C++".format(file_ext)]
+    return arguments
+
+
+# Run srcml once for a batch of files and split the resulting archive into one unit per file.
+# Returns a list of unit elements in the order of the given paths, None for files that could not be parsed.
+# If the batch crashes or times out, the files are parsed one by one, so a single bad file does not spoil the batch.
+def run_srcml_batch(src_path, paths, options=(), parser=None):
+    filenames = [str((src_path / path).resolve()) for path in paths]
+    query = [*constants.SRCML_BASE_CALL, *options, constants.SRCML_ARCHIVE, *srcml_extension_arguments()]
+    try:
+        output = sp.check_output([*query, *filenames], timeout=constants.SRCML_BATCH_TIMEOUT)
+    except (sp.CalledProcessError, sp.TimeoutExpired):
+        if len(paths) > 1:
+            tqdm.write("srcml failed on a batch of {} files, parsing them one by one".format(len(paths)))
+            instrumentation.count("srcml_batch_failures")
+        units = []
+        for path in paths:
+            output = run_srcml_one_file(src_path, path, options)
+            units.append(etree.fromstring(output, parser) if output else None)
+        return units
+
+    archive = etree.fromstring(output, parser)
+    units = {}
+    for unit in archive.iterchildren(constants.TAGS["unit"]):
+        units[unit.get("filename")] = unit
+    return [units.get(filename) for filename in filenames]
+
+
+def run_srcml_one_file(src_path, path, options=()):
+    query = [*constants.SRCML_BASE_CALL, "-X", *options, "--register-ext", "{}=C++".format(path.suffix[1:])]
     output = ""
     counter = 0
     while not output:
         try:
-            output = sp.check_output([*query, str((src_path/path).resolve())], timeout=60)
+            output = sp.check_output([*query, str((src_path/path).resolve())], timeout=constants.SRCML_TIMEOUT)
             return output
         except sp.CalledProcessError:
             #retry, srcml occasionally crashes
             counter += 1
+            instrumentation.count("srcml_retries")
             if counter > 3:
                 print("multiple crashes occured at {}".format(path))
                 raise
         except sp.TimeoutExpired:
             tqdm.write("timeout while parsing {}".format(str((src_path/path).resolve())))
+            instrumentation.count("srcml_timeouts")
             return None
+
+
+# Extracts includes, named units with their naive calls and their line spans from a srcml archive while it is parsed.
+# Every element is emptied once it has been processed and removed once its next sibling is done,
+# so the memory needed is bounded by the nesting depth of the source instead of its size.
+class StreamingExtractor:
+    def __init__(self, xpath_named_unit_name_query):
+        self.xpath_named_unit_name_query = xpath_named_unit_name_query
+        # tags and line spans of all open elements
+        self.open_elements = []
+        # open named units, the outermost first
+        self.frames = []
+        # depths of open call and type elements
+        self.calling_depths = []
+        # depth of the name or macro element, which is kept intact until the name of its named unit is known
+        self.protected_depth = None
+        self.properties = None
+        self.spans = None
+
+    # yields (filename, properties, spans) for every file in the srcml archive read from source
+    def extract(self, source):
+        for event, element in etree.iterparse(source, events=("start", "end"), huge_tree=True, recover=True):
+            if event == "start":
+                self.start(element)
+            else:
+                result = self.end(element)
+                if result:
+                    yield result
+
+    def start(self, element):
+        depth = len(self.open_elements)
+        lines = get_position_lines(element)
+        self.open_elements.append([element.tag, min(lines) if lines else None, max(lines) if lines else None])
+        if depth == 1 and element.tag == constants.TAGS["unit"]:
+            self.properties = {constants.INCLUDES: set([]), constants.CALLS_NAIVE: {}}
+            self.spans = []
+            return
+        if self.properties is None:
+            return
+
+        if element.tag == constants.TAGS["call"] or element.tag == constants.TAGS["type"]:
+            self.calling_depths.append(depth)
+        elif element.tag == constants.TAGS["name"] and self.protected_depth is None and self.frames and \
+                self.frames[-1]["depth"] == depth - 1 and self.frames[-1]["name"] is None:
+            # the first name of a named unit, keep it until it is complete
+            self.protected_depth = depth
+        elif element.tag == constants.TAGS["macro"] and self.protected_depth is None:
+            # the name of a macro block is the text of the whole macro
+            self.protected_depth = depth
+
+        if self.is_named_unit(element):
+            frame = {"depth": depth, "element": element, "name": None, "calls": set([])}
+            if element.tag == constants.TAGS["block"]:
+                # the name of a macro is known as soon as its block starts
+                frame["name"], frame["calls"] = get_named_unit_name(self.xpath_named_unit_name_query, element)
+            self.frames.append(frame)
+
+    # the streaming equivalent of NAMED_UNIT_QUERY, decided on the start of an element
+    def is_named_unit(self, element):
+        tag = element.tag
+        if tag in constants.UNCONDITIONAL_NAMED_UNIT_TAGS:
+            return True
+        if tag == constants.TAGS["function"] or tag == constants.TAGS["function_decl"]:
+            return element.get("type") != "operator"
+        if tag == constants.TAGS["class"] or tag == constants.TAGS["class_decl"]:
+            return not any(open_tag == constants.TAGS["template"] for open_tag, _, _ in self.open_elements[:-1])
+        if tag == constants.TAGS["block"]:
+            previous = element.getprevious()
+            while previous is not None and not isinstance(previous.tag, str):
+                previous = previous.getprevious()
+            return previous is not None and previous.tag == constants.TAGS["macro"]
+        if tag == constants.TAGS["decl"]:
+            ancestors = [open_tag for open_tag, _, _ in self.open_elements[-4:-1]]
+            return ancestors == [constants.TAGS["namespace"], constants.TAGS["block"], constants.TAGS["decl_stmt"]]
+        return False
+
+    def end(self, element):
+        depth = len(self.open_elements) - 1
+        tag, first, last = self.open_elements.pop()
+        if first is not None and self.open_elements:
+            parent = self.open_elements[-1]
+            parent[1] = first if parent[1] is None else min(parent[1], first)
+            parent[2] = last if parent[2] is None else max(parent[2], last)
+
+        result = None
+        if self.properties is not None:
+            if depth == 1:
+                result = element.get("filename"), self.properties, sorted(self.spans, key=lambda span: span[0])
+                self.properties = None
+            else:
+                self.end_in_file(element, depth, first, last)
+
+        if self.protected_depth is None or depth <= self.protected_depth:
+            if self.protected_depth == depth:
+                self.protected_depth = None
+            if tag != constants.TAGS["macro"]:
+                # macros are needed by the block following them
+                del element[:]
+                element.text = None
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+        return result
+
+    def end_in_file(self, element, depth, first, last):
+        tag = element.tag
+        if tag == constants.TAGS["name"]:
+            if self.calling_depths:
+                texts = [element.text] + [child.tail for child in element]
+                texts = [text for text in texts if text is not None]
+                for frame in self.frames:
+                    if frame["depth"] >= self.calling_depths[-1]:
+                        break
+                    frame["calls"].update(texts)
+            if depth == self.protected_depth:
+                frame = self.frames[-1]
+                frame["name"], name_calls = get_named_unit_name(self.xpath_named_unit_name_query, frame["element"])
+                frame["calls"].update(name_calls)
+        elif tag == constants.TAGS["file"] and self.open_elements[-1][0] == constants.TAGS["include"]:
+            texts = [element.text] + [child.tail for child in element]
+            for included_file in texts:
+                if included_file is not None:
+                    included_file = included_file.split("\"")
+                    if len(included_file) == 3:
+                        self.properties[constants.INCLUDES].add(included_file[1])
+        elif tag == constants.TAGS["call"] or tag == constants.TAGS["type"]:
+            self.calling_depths.pop()
+
+        if self.frames and self.frames[-1]["depth"] == depth:
+            frame = self.frames.pop()
+            if frame["name"]:
+                self.properties[constants.CALLS_NAIVE].setdefault(frame["name"], {frame["name"]}).update(
+                    frame["calls"])
+                if first is not None:
+                    self.spans.append((first, last, frame["name"]))
+
+
+# Run srcml on the given files and extract them while the output is parsed.
+# Returns the (properties, spans) of every extracted file by filename, the return code of srcml
+# and whether it timed out.
+def stream_srcml(src_path, paths, options, timeout):
+    filenames = [str((src_path / path).resolve()) for path in paths]
+    query = [*constants.SRCML_BASE_CALL, *options, constants.SRCML_ARCHIVE, *srcml_extension_arguments()]
+    process = sp.Popen([*query, *filenames], stdout=sp.PIPE)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    extracted = {}
+    extractor = StreamingExtractor(etree.XPath(constants.NAMED_UNIT_NAME_QUERY, namespaces=constants.ns))
+    try:
+        for filename, properties, spans in extractor.extract(process.stdout):
+            extracted[filename] = properties, spans
+    except etree.XMLSyntaxError:
+        # truncated output of a crashed or killed srcml
+        pass
+    finally:
+        timer.cancel()
+        process.stdout.close()
+        return_code = process.wait()
+    return extracted, return_code, timed_out.is_set()
+
+
+# Streaming counterpart of run_srcml_batch. Returns (properties, spans) for every path, None if it could not be parsed.
+# Files missing after a crash or timeout of the batch are parsed one by one, retrying crashes like run_srcml_one_file.
+def stream_srcml_batch(src_path, paths, options=()):
+    extracted, return_code, timed_out = stream_srcml(src_path, paths, options, constants.SRCML_BATCH_TIMEOUT)
+    failed = return_code != 0 or timed_out
+    if failed and len(paths) > 1:
+        tqdm.write("srcml failed on a batch of {} files, parsing them one by one".format(len(paths)))
+        instrumentation.count("srcml_batch_failures")
+
+    results = []
+    for path in paths:
+        filename = str((src_path / path).resolve())
+        counter = 0
+        while failed and filename not in extracted:
+            single, return_code, timed_out = stream_srcml(src_path, [path], options, constants.SRCML_TIMEOUT)
+            extracted.update(single)
+            if timed_out:
+                tqdm.write("timeout while parsing {}".format(filename))
+                instrumentation.count("srcml_timeouts")
+                break
+            if return_code == 0:
+                break
+            # retry, srcml occasionally crashes
+            counter += 1
+            instrumentation.count("srcml_retries")
+            if counter > 3:
+                print("multiple crashes occured at {}".format(path))
+                raise sp.CalledProcessError(return_code, constants.SRCML_BASE_CALL)
+        results.append(extracted.get(filename))
+    return results
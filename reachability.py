@@ -0,0 +1,95 @@
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+
+# Breadth first search from many sources at once, following the rows of a csr graph up to max_depth edges.
+# Returns four arrays describing every visited (source, node) pair, sorted by source index and node:
+# the index of the source in sources, the node, its distance from the source and its predecessor on a shortest path.
+# The predecessor of a source itself is -1. Memory stays proportional to the number of visited pairs.
+def bounded_bfs(graph, sources, max_depth):
+    size = graph.shape[0]
+    indptr = graph.indptr
+    indices = graph.indices
+    sources = np.asarray(sources, dtype=np.int64)
+
+    frontier_origins = np.arange(len(sources), dtype=np.int64)
+    frontier_nodes = sources
+    visited_keys = np.sort(frontier_origins * size + frontier_nodes)
+    origins = [frontier_origins]
+    nodes = [frontier_nodes]
+    distances = [np.zeros(len(sources), dtype=np.int64)]
+    predecessors = [np.full(len(sources), -1, dtype=np.int64)]
+
+    for depth in range(1, int(max_depth) + 1):
+        starts = indptr[frontier_nodes].astype(np.int64)
+        counts = indptr[frontier_nodes + 1].astype(np.int64) - starts
+        total = int(counts.sum())
+        if total == 0:
+            break
+        # expand the neighbours of all frontier nodes at once
+        owner = np.repeat(np.arange(len(frontier_nodes)), counts)
+        offsets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        neighbours = indices[starts[owner] + offsets].astype(np.int64)
+        keys, first = np.unique(frontier_origins[owner] * size + neighbours, return_index=True)
+        new = ~np.isin(keys, visited_keys, assume_unique=True)
+        if not new.any():
+            break
+        keys = keys[new]
+        first = first[new]
+
+        predecessors.append(frontier_nodes[owner[first]])
+        frontier_origins = keys // size
+        frontier_nodes = keys % size
+        visited_keys = np.union1d(visited_keys, keys)
+        origins.append(frontier_origins)
+        nodes.append(frontier_nodes)
+        distances.append(np.full(len(keys), depth, dtype=np.int64))
+
+    origins = np.concatenate(origins)
+    nodes = np.concatenate(nodes)
+    order = np.lexsort((nodes, origins))
+    return origins[order], nodes[order], np.concatenate(distances)[order], np.concatenate(predecessors)[order]
+
+
+# The shortest paths of all (source, node) pairs visited by bounded_bfs, reconstructed for all pairs at once by
+# following the predecessors back to the source. Expects the arrays returned by bounded_bfs.
+# Returns a matrix with one row per pair, holding the path from the node to its source, padded with -1.
+def shortest_paths(size, origins, nodes, predecessors):
+    keys = origins * size + nodes
+    has_predecessor = predecessors >= 0
+    predecessor_positions = np.full(len(nodes), -1, dtype=np.int64)
+    predecessor_positions[has_predecessor] = np.searchsorted(keys, origins[has_predecessor] * size +
+                                                             predecessors[has_predecessor])
+    positions = np.arange(len(nodes), dtype=np.int64)
+    columns = [nodes]
+    while True:
+        positions = np.where(positions >= 0, predecessor_positions[positions], -1)
+        if (positions < 0).all():
+            return np.stack(columns, axis=1)
+        columns.append(np.where(positions >= 0, nodes[positions], -1))
+
+
+# Pairs of nodes connected by a path of 1 to max_depth edges, as a boolean csr matrix.
+# The paths are extended by sparse matrix products on blocks of block_size rows, only by the nodes first reached in
+# the previous step, so that the intermediate products of only one block are held at a time.
+def bounded_reachability(graph, max_depth, block_size):
+    size = graph.shape[0]
+    graph = csr_matrix(graph, dtype=np.int32)
+    graph.data[:] = 1
+    blocks = []
+    for start in range(0, size, block_size):
+        frontier = graph[start:start + block_size]
+        reachable = frontier
+        for _ in range(1, int(max_depth)):
+            frontier = frontier @ graph
+            frontier = frontier - frontier.multiply(reachable)
+            frontier.eliminate_zeros()
+            if frontier.nnz == 0:
+                break
+            # count every path only once, so that path counts can not overflow
+            frontier.data[:] = 1
+            reachable = reachable + frontier
+        blocks.append(reachable)
+    if not blocks:
+        return csr_matrix((size, size), dtype=bool)
+    return vstack(blocks, format="csr").astype(bool)
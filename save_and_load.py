@@ -1,4 +1,14 @@
+from pathlib import Path
+from contextlib import contextmanager
+import fcntl
+import os
+import sqlite3
+import tempfile
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
 import constants
+import symbol_table
 import ujson
 
 
@@ -17,38 +27,376 @@ def load_last_scanned_revision():
         return None
 
 
-def save_preprocessed_file(path, properties):
-    properties[constants.INCLUDES] = list(properties[constants.INCLUDES])
+# Hold the lock of the working directory, while the preprocessed files, the call graph and the symbol table are
+# updated and loaded, so that merge checks and follow_master.py see a consistent state. Blocks until it is free.
+# The lock is not reentrant.
+@contextmanager
+def analysis_lock():
+    constants.ANALYSIS_LOCK.parent.mkdir(parents=True, exist_ok=True)
+    with constants.ANALYSIS_LOCK.open("w") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+# connection to the sqlite database holding the preprocessed files, opened on first use
+database = None
+
+
+def get_database():
+    global database
+    if database is None:
+        constants.DUMP_DATABASE.parent.mkdir(parents=True, exist_ok=True)
+        database = sqlite3.connect(str(constants.DUMP_DATABASE))
+        database.execute("CREATE TABLE IF NOT EXISTS preprocessed_files (path TEXT PRIMARY KEY, properties TEXT NOT NULL)")
+        database.execute("CREATE TABLE IF NOT EXISTS paths (path TEXT PRIMARY KEY)")
+        # the cached blobs of older versions lack the extractor, which parsed them, and are dropped
+        if "extractor" not in [column[1] for column in database.execute("PRAGMA table_info(blobs)")]:
+            database.execute("DROP TABLE IF EXISTS blobs")
+        database.execute("CREATE TABLE IF NOT EXISTS blobs (blob TEXT, extractor TEXT, properties TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, last_used REAL, PRIMARY KEY (blob, extractor))")
+        database.execute("CREATE TABLE IF NOT EXISTS blob_spans (blob TEXT, extractor TEXT, spans TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, last_used REAL, PRIMARY KEY (blob, extractor))")
+        # as do the path blobs, which must be parsed again if the extractor changes
+        if "extractor" not in [column[1] for column in database.execute("PRAGMA table_info(path_blobs)")]:
+            database.execute("DROP TABLE IF EXISTS path_blobs")
+        database.execute("CREATE TABLE IF NOT EXISTS path_blobs "
+                         "(path TEXT PRIMARY KEY, blob TEXT NOT NULL, extractor TEXT NOT NULL)")
+        database.execute("CREATE INDEX IF NOT EXISTS path_blobs_blob ON path_blobs (blob)")
+        database.execute("CREATE TABLE IF NOT EXISTS revisions (revision TEXT PRIMARY KEY, last_used REAL)")
+        database.execute("CREATE TABLE IF NOT EXISTS revision_blobs "
+                         "(revision TEXT, path TEXT, blob TEXT NOT NULL, PRIMARY KEY (revision, path))")
+        database.execute("CREATE INDEX IF NOT EXISTS revision_blobs_blob ON revision_blobs (blob)")
+        database.execute("CREATE TABLE IF NOT EXISTS symbols (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        database.commit()
+    return database
+
+
+def use_database():
+    return constants.STORAGE_BACKEND == constants.STORAGE_SQLITE
+
+
+# IDs of the interned symbols, loaded from the symbols table on first use. IDs are never reassigned,
+# so the dict stays valid while other processes intern further symbols.
+symbol_ids = None
+
+
+# Return the IDs of the given names, interning the names not seen before in DUMP_DATABASE,
+# which holds the symbols for every storage backend.
+def intern_symbols(names):
+    global symbol_ids
+    names = list(names)
+    db = get_database()
+    if symbol_ids is None:
+        symbol_ids = dict(db.execute("SELECT name, id FROM symbols"))
+    unknown = set(name for name in names if name not in symbol_ids)
+    if unknown:
+        db.executemany("INSERT OR IGNORE INTO symbols (name) VALUES (?)", ((name,) for name in unknown))
+        db.commit()
+        unknown = list(unknown)
+        for i in range(0, len(unknown), 500):
+            chunk = unknown[i:i + 500]
+            symbol_ids.update(db.execute("SELECT name, id FROM symbols WHERE name IN ({})".format(
+                ",".join("?" * len(chunk))), chunk))
+    return [symbol_ids[name] for name in names]
+
+
+# the calls of a named unit as a sorted list of symbol IDs, given by the set of their names or as an array already
+def symbol_list(calls):
+    if isinstance(calls, np.ndarray):
+        return calls.tolist()
+    return sorted(intern_symbols(calls))
+
+
+# intern the called names of many properties at once, so that the symbols table is written once
+def intern_properties(properties_list):
+    names = set([])
+    for properties in properties_list:
+        for calls in properties[constants.CALLS_NAIVE].values():
+            if not isinstance(calls, np.ndarray):
+                names.update(calls)
+    intern_symbols(names)
+
+
+# The calls of every named unit are stored as sorted symbol IDs and loaded as sorted int64 arrays.
+def serialize_properties(properties):
+    return ujson.dumps({constants.INCLUDES: list(properties[constants.INCLUDES]),
+                        constants.CALLS_NAIVE: {unit: symbol_list(calls) for unit, calls in
+                                                properties[constants.CALLS_NAIVE].items()}})
+
+
+def deserialize_properties(serialized):
+    properties = ujson.loads(serialized)
+    properties[constants.INCLUDES] = set(properties[constants.INCLUDES])
     for unit, calls in properties[constants.CALLS_NAIVE].items():
-        properties[constants.CALLS_NAIVE][unit] = list(calls)
-    path += ".json"
-    filepath = constants.DUMP_FOLDER_JSON / path
-    filepath.parent.mkdir(parents=True, exist_ok=True)
-    with filepath.open("w") as fp:
-        ujson.dump(properties, fp)
+        # files preprocessed before the symbols were interned store the names themselves
+        if calls and isinstance(calls[0], str):
+            calls = symbol_list(set(calls))
+        properties[constants.CALLS_NAIVE][unit] = np.array(calls, dtype=np.int64)
+    return properties
+
+
+def json_dump_path(path):
+    return constants.DUMP_FOLDER_JSON / (path + ".json")
+
+
+# save the properties of many preprocessed files at once, expects an iterable of (path, properties)
+# Every save or deletion of preprocessed files by this process increases change_sequence,
+# path_changes holds the sequence number of the last change of every path.
+change_sequence = 0
+path_changes = {}
+
+
+def record_changes(paths):
+    global change_sequence
+    change_sequence += 1
+    for path in paths:
+        path_changes[path] = change_sequence
+
+
+# the paths, whose preprocessed files this process changed after the given sequence number, and the current number
+def changes_since(sequence):
+    return set([path for path, path_sequence in path_changes.items() if path_sequence > sequence]), change_sequence
+
+
+# Changes with every commit of another connection to the database, None for json files, whose changes by other
+# processes can not be told.
+def database_version():
+    if not use_database():
+        return None
+    return get_database().execute("PRAGMA data_version").fetchone()[0]
+
+
+def save_preprocessed_files(preprocessed_files):
+    preprocessed_files = list(preprocessed_files)
+    intern_properties([properties for _, properties in preprocessed_files])
+    record_changes(path for path, _ in preprocessed_files)
+    if use_database():
+        db = get_database()
+        db.executemany("INSERT OR REPLACE INTO preprocessed_files (path, properties) VALUES (?, ?)",
+                       ((path, serialize_properties(properties)) for path, properties in preprocessed_files))
+        db.commit()
+    else:
+        for path, properties in preprocessed_files:
+            filepath = json_dump_path(path)
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            with filepath.open("w") as fp:
+                fp.write(serialize_properties(properties))
+
+
+def save_preprocessed_file(path, properties):
+    save_preprocessed_files([(path, properties)])
 
 
 def load_preprocessed_file(path):
-    path += ".json"
-    filepath = constants.DUMP_FOLDER_JSON / path
+    if use_database():
+        row = get_database().execute("SELECT properties FROM preprocessed_files WHERE path = ?", (path,)).fetchone()
+        return deserialize_properties(row[0]) if row else None
+
+    filepath = json_dump_path(path)
     if filepath.exists():
         with filepath.open("r") as fp:
-            properties = ujson.load(fp)
+            return deserialize_properties(fp.read())
+    else:
+        return None
 
-        properties[constants.INCLUDES] = set(properties[constants.INCLUDES])
-        for unit, calls in properties[constants.CALLS_NAIVE].items():
-            properties[constants.CALLS_NAIVE][unit] = set(calls)
-        return properties
+
+# load the properties of all preprocessed files, or of the given paths only, as (path, properties) pairs
+def load_preprocessed_files(paths=None):
+    if use_database():
+        db = get_database()
+        if paths is None:
+            rows = db.execute("SELECT path, properties FROM preprocessed_files")
+        else:
+            paths = list(paths)
+            # stay below the maximum number of sqlite host parameters
+            rows = (row for i in range(0, len(paths), 500) for row in db.execute(
+                "SELECT path, properties FROM preprocessed_files WHERE path IN ({})".format(
+                    ",".join("?" * len(paths[i:i + 500]))), paths[i:i + 500]))
+        for path, serialized in rows:
+            yield path, deserialize_properties(serialized)
+    else:
+        if paths is None:
+            paths = preprocessed_file_paths()
+        for path in paths:
+            properties = load_preprocessed_file(path)
+            if properties:
+                yield path, properties
+
+
+# find the paths of all files, for which preprocessed properties are stored
+def preprocessed_file_paths():
+    if use_database():
+        return set(path for path, in get_database().execute("SELECT path FROM preprocessed_files"))
+    return set(str(filepath.relative_to(constants.DUMP_FOLDER_JSON).as_posix())[:-len(".json")]
+               for filepath in constants.DUMP_FOLDER_JSON.rglob("*.json"))
+
+
+def delete_preprocessed_files(paths):
+    record_changes(paths)
+    if constants.BLOB_CACHE:
+        save_path_blobs({path: None for path in paths}, constants.EXTRACTOR)
+    if use_database():
+        db = get_database()
+        db.executemany("DELETE FROM preprocessed_files WHERE path = ?", ((path,) for path in paths))
+        db.commit()
     else:
+        for path in paths:
+            filepath = json_dump_path(path)
+            if filepath.exists():
+                filepath.unlink()
+
+
+# Save the properties of parsed git blobs, expects an iterable of (blob, extractor, properties).
+# Blobs are cached per extractor, as the extractors do not agree on every file.
+def save_blob_properties(blob_properties):
+    blob_properties = list(blob_properties)
+    intern_properties([properties for _, _, properties in blob_properties])
+    now = time.time()
+    rows = []
+    for blob, extractor, properties in blob_properties:
+        serialized = serialize_properties(properties)
+        rows.append((blob, extractor, serialized, len(serialized), now))
+    db = get_database()
+    db.executemany("INSERT OR REPLACE INTO blobs (blob, extractor, properties, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                   rows)
+    db.commit()
+
+
+# load the properties of all given blobs that are cached for the extractor, as a dict from blob to properties
+def load_blob_properties(blobs, extractor):
+    db = get_database()
+    blobs = list(blobs)
+    blob_properties = {}
+    # stay below the maximum number of sqlite host parameters
+    for i in range(0, len(blobs), 500):
+        chunk = blobs[i:i + 500]
+        rows = db.execute("SELECT blob, properties FROM blobs WHERE extractor = ? AND blob IN ({})"
+                          .format(",".join("?" * len(chunk))), [extractor, *chunk])
+        for blob, serialized in rows:
+            blob_properties[blob] = deserialize_properties(serialized)
+    now = time.time()
+    db.executemany("UPDATE blobs SET last_used = ? WHERE blob = ? AND extractor = ?",
+                   ((now, blob, extractor) for blob in blob_properties))
+    db.commit()
+    return blob_properties
+
+
+# save the named unit spans of parsed git blobs, expects an iterable of (blob, extractor, spans)
+def save_blob_spans(blob_spans):
+    now = time.time()
+    rows = []
+    for blob, extractor, spans in blob_spans:
+        serialized = ujson.dumps(spans)
+        rows.append((blob, extractor, serialized, len(serialized), now))
+    db = get_database()
+    db.executemany("INSERT OR REPLACE INTO blob_spans (blob, extractor, spans, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                   rows)
+    db.commit()
+
+
+# load the named unit spans of all given blobs that are cached for the extractor, as a dict from blob to spans
+def load_blob_spans(blobs, extractor):
+    db = get_database()
+    blobs = list(blobs)
+    blob_spans = {}
+    # stay below the maximum number of sqlite host parameters
+    for i in range(0, len(blobs), 500):
+        chunk = blobs[i:i + 500]
+        rows = db.execute("SELECT blob, spans FROM blob_spans WHERE extractor = ? AND blob IN ({})"
+                          .format(",".join("?" * len(chunk))), [extractor, *chunk])
+        for blob, serialized in rows:
+            blob_spans[blob] = ujson.loads(serialized)
+    now = time.time()
+    db.executemany("UPDATE blob_spans SET last_used = ? WHERE blob = ? AND extractor = ?",
+                   ((now, blob, extractor) for blob in blob_spans))
+    db.commit()
+    return blob_spans
+
+
+# Remember from which blob and with which extractor the preprocessed file of a path was created,
+# a blob of None removes the entry.
+def save_path_blobs(path_blobs, extractor):
+    db = get_database()
+    db.executemany("INSERT OR REPLACE INTO path_blobs (path, blob, extractor) VALUES (?, ?, ?)",
+                   ((path, blob, extractor) for path, blob in path_blobs.items() if blob))
+    db.executemany("DELETE FROM path_blobs WHERE path = ?",
+                   ((path,) for path, blob in path_blobs.items() if not blob))
+    db.commit()
+
+
+# the blobs of the preprocessed files created with the extractor, the others are outdated
+def load_path_blobs(extractor):
+    return dict(get_database().execute("SELECT path, blob FROM path_blobs WHERE extractor = ?", (extractor,)))
+
+
+# save the path to blob mapping of a revision, only the most recently used revisions are kept
+def save_revision_blobs(revision, path_blobs):
+    db = get_database()
+    db.execute("INSERT OR REPLACE INTO revisions (revision, last_used) VALUES (?, ?)", (revision, time.time()))
+    db.execute("DELETE FROM revision_blobs WHERE revision = ?", (revision,))
+    db.executemany("INSERT INTO revision_blobs (revision, path, blob) VALUES (?, ?, ?)",
+                   ((revision, path, blob) for path, blob in path_blobs.items()))
+    outdated = db.execute("SELECT revision FROM revisions ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                          (constants.BLOB_CACHE_REVISIONS,)).fetchall()
+    db.executemany("DELETE FROM revision_blobs WHERE revision = ?", outdated)
+    db.executemany("DELETE FROM revisions WHERE revision = ?", outdated)
+    db.commit()
+
+
+def load_revision_blobs(revision):
+    db = get_database()
+    if not db.execute("SELECT 1 FROM revisions WHERE revision = ?", (revision,)).fetchone():
         return None
+    db.execute("UPDATE revisions SET last_used = ? WHERE revision = ?", (time.time(), revision))
+    db.commit()
+    return dict(db.execute("SELECT path, blob FROM revision_blobs WHERE revision = ?", (revision,)))
+
+
+# Evict the least recently used blobs, which are neither referenced by a path nor a saved revision,
+# until the cache of properties and spans fits into max_size bytes. Returns the number of evicted entries.
+def evict_blobs(max_size):
+    db = get_database()
+    total_size = sum(db.execute("SELECT COALESCE(SUM(size), 0) FROM {}".format(table)).fetchone()[0]
+                     for table in ("blobs", "blob_spans"))
+    if total_size <= max_size:
+        return 0
+    rows = db.execute("SELECT entry_table, blob, extractor, size FROM "
+                      "(SELECT 'blobs' AS entry_table, blob, extractor, size, last_used FROM blobs UNION ALL "
+                      "SELECT 'blob_spans', blob, extractor, size, last_used FROM blob_spans) WHERE "
+                      "blob NOT IN (SELECT blob FROM path_blobs) AND "
+                      "blob NOT IN (SELECT blob FROM revision_blobs) "
+                      "ORDER BY last_used").fetchall()
+    evicted = {"blobs": [], "blob_spans": []}
+    for table, blob, extractor, size in rows:
+        if total_size <= max_size:
+            break
+        evicted[table].append((blob, extractor))
+        total_size -= size
+    for table, entries in evicted.items():
+        db.executemany("DELETE FROM {} WHERE blob = ? AND extractor = ?".format(table), entries)
+    db.commit()
+    return sum(len(entries) for entries in evicted.values())
 
 
 def save_paths(paths):
+    if use_database():
+        db = get_database()
+        db.execute("DELETE FROM paths")
+        db.executemany("INSERT INTO paths (path) VALUES (?)", ((path,) for path in paths))
+        db.commit()
+        return
+
     with open(constants.DUMP_PATH_LIST, 'w') as fp:
         ujson.dump(list(paths), fp)
 
 
 def load_paths():
+    if use_database():
+        return set(path for path, in get_database().execute("SELECT path FROM paths"))
+
     if constants.DUMP_PATH_LIST.exists():
         with open(constants.DUMP_PATH_LIST, 'r') as fp:
             paths = ujson.load(fp)
@@ -57,14 +405,57 @@ def load_paths():
         return set([])
 
 
+# save the fingerprints of the preprocessed files the call graph was built from
+def save_call_graph_files(call_graph_files):
+    with open(constants.CALL_GRAPH_FILES, 'w') as fp:
+        ujson.dump(call_graph_files, fp)
+
+
+def load_call_graph_files():
+    if Path(constants.CALL_GRAPH_FILES).exists():
+        with open(constants.CALL_GRAPH_FILES, 'r') as fp:
+            return ujson.load(fp)
+    else:
+        return None
+
+
+# the symbol table is memory mapped, both dicts are read-only views of it
 def load_id_dicts():
-    id_to_named_unit = {}
-    named_unit_to_id = {}
+    table = symbol_table.SymbolTable(constants.SYMBOL_TABLE)
+    return table.id_to_named_unit, table.named_unit_to_id
+
+
+def save_id_dicts(named_unit_to_id, size):
+    symbol_table.save_symbol_table(constants.SYMBOL_TABLE, named_unit_to_id, size)
+
+
+# Save the indptr and indices of a csr graph as .npy files. Every file is replaced atomically, so that graphs still
+# mapped by other processes stay valid. The index dtype is the one scipy picks, so that loading does not copy.
+def save_called_by_graph(graph):
+    directory = constants.CALLED_BY_GRAPH
+    directory.mkdir(parents=True, exist_ok=True)
+    dtype = np.int32 if max(graph.shape[0], graph.nnz) <= np.iinfo(np.int32).max else np.int64
+    for file_name, array in (("indices", graph.indices), ("indptr", graph.indptr)):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=str(directory), suffix=".npy")
+        with os.fdopen(file_descriptor, "wb") as fp:
+            np.save(fp, array.astype(dtype, copy=False))
+        os.replace(temporary_path, str(directory / (file_name + ".npy")))
+
+
+# Load the called_by_graph as a read-only csr matrix over the memory mapped arrays, None if it was never saved.
+# The data of every edge is a broadcast 1, so that loading takes constant time and memory.
+def load_called_by_graph():
+    directory = constants.CALLED_BY_GRAPH
+    if not (directory / "indptr.npy").exists():
+        return None
+    indices = np.load(str(directory / "indices.npy"), mmap_mode="r")
+    indptr = np.load(str(directory / "indptr.npy"), mmap_mode="r")
+    size = len(indptr) - 1
+    return csr_matrix((np.broadcast_to(np.int8(1), indices.shape), indices, indptr), shape=(size, size), copy=False)
 
-    with open("id_to_named_unit.json", "r") as file:
-        id_to_named_unit_from_file = ujson.load(file)
-        for k, v in id_to_named_unit_from_file.items():
-            id_to_named_unit[int(k)] = (v[0], v[1])
-            named_unit_to_id[(v[0], v[1])] = int(k)
 
-    return id_to_named_unit, named_unit_to_id
+# Load the call graph, the transpose of the called_by_graph, as a read-only csc matrix over the same memory mapped
+# arrays, None if it was never saved.
+def load_call_graph():
+    called_by_graph = load_called_by_graph()
+    return called_by_graph.transpose() if called_by_graph is not None else None
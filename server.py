@@ -0,0 +1,115 @@
+from pathlib import Path
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import sys
+import json
+import time
+import threading
+import traceback
+import constants
+import git_objects
+import find_conflicts
+import precompute
+
+
+# Keeps the preprocessed files, the call graph and the ID dicts in memory and answers merge checks.
+# Call graph and preprocessed files are refreshed incrementally, if a query needs a different state. Only the files
+# parsed for the merge of the query are loaded again, unless another process changed the preprocessed files.
+class AnalysisState:
+    def __init__(self, src_path):
+        self.src_path = src_path
+        self.lock = threading.Lock()
+        self.preprocessed_files = precompute.PreprocessedFiles()
+        # called_by_graph, id_to_named_unit and named_unit_to_id
+        self.call_graph = None
+        # resolved master and branches the call graph was prepared for
+        self.prepared_for = None
+        self.results = OrderedDict()
+
+    # resolved through the long running git processes of the repository, which also serve the diffs of all queries
+    def resolve_revisions(self, revisions):
+        channel = git_objects.git_channel(self.src_path)
+        return [channel.resolve(revision) for revision in revisions]
+
+    # With top_count or time_budget, only the closest conflicts are searched for. Results cut short by the time budget
+    # are marked as incomplete and not cached.
+    def query(self, master, branches, top_count=None, time_budget=None):
+        with self.lock:
+            revisions = self.resolve_revisions([master] + [revision for branch in branches for revision in branch])
+            prepared_key = (revisions[0], tuple(revisions[1:]))
+            key = (prepared_key, top_count)
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+
+            if self.prepared_for != prepared_key:
+                self.call_graph = find_conflicts.prepare_call_graph(self.src_path, master, branches,
+                                                                    self.preprocessed_files)
+                self.prepared_for = prepared_key
+            if top_count is None and time_budget is None:
+                potential_conflicts = find_conflicts.find_potential_conflicts(self.src_path, branches,
+                                                                              *self.call_graph)
+                complete = True
+            else:
+                potential_conflicts, complete = find_conflicts.find_closest_potential_conflicts(
+                    self.src_path, branches, *self.call_graph, top_count, time_budget)
+            result = find_conflicts.summarize_potential_conflicts(potential_conflicts)
+            result["complete"] = complete
+            if not complete:
+                return result
+
+            self.results[key] = result
+            if len(self.results) > constants.SERVER_CACHED_RESULTS:
+                self.results.popitem(last=False)
+            return result
+
+
+# expects a POST request with a json body
+# {"master": MASTER_REVISION, "branches": [REQUESTED_MASTER_REVISION-BRANCH_REVISION, ...]}
+# optionally with "top": K and "time_budget": SECONDS to only search for the K closest conflicts within the given time
+class QueryHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            master = request["master"]
+            branches = [branch.split(constants.BRANCH_SEPARATOR) for branch in request["branches"]]
+            top_count = int(request["top"]) if request.get("top") is not None else None
+            time_budget = float(request["time_budget"]) if request.get("time_budget") is not None else None
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_error(400, "expected {\"master\": revision, \"branches\": [revision-revision, ...]}")
+            return
+
+        start_time = time.time()
+        try:
+            result = self.server.state.query(master, branches, top_count, time_budget)
+        except git_objects.UnknownRevisionError as error:
+            self.send_error(400, str(error))
+            return
+        except Exception as error:
+            traceback.print_exc()
+            self.send_error(500, "analysis failed: {}".format(error))
+            return
+        print("answered query in {0:.2f} seconds".format(time.time() - start_time))
+
+        body = json.dumps(result, default=sorted).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    # expect input in the format PATH_TO_SOURCE_FOLDER [PORT]
+    # optionally preceded by --quiet and --extractor=tokenizer, as for find_conflicts.py
+    arguments, _ = find_conflicts.parse_options(sys.argv[1:], ["--quiet", "--extractor"])
+    src_path = Path(arguments[0]).resolve()
+    port = int(arguments[1]) if len(arguments) > 1 else constants.SERVER_PORT
+    server = HTTPServer((constants.SERVER_HOST, port), QueryHandler)
+    server.state = AnalysisState(src_path)
+    print("listening on {}:{}".format(constants.SERVER_HOST, port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
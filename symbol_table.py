@@ -0,0 +1,140 @@
+from pathlib import Path
+from collections.abc import Mapping
+import os
+import zlib
+import tempfile
+import numpy as np
+
+# On disk, a symbol table is a directory of .npy files:
+# path_pool, path_offsets: the interned paths, encoded as utf-8 and concatenated
+# name_pool: the names of all named units, in the order of their IDs
+# units: (path index, name offset, name length) for every ID, path index -1 for unused IDs
+# hashes, hash_ids: crc32 of path and name of every named unit, sorted, and the ID of each hash
+UNIT_DTYPE = np.dtype([("path", "<i4"), ("name", "<i8"), ("length", "<i4")])
+FILES = ["path_pool", "path_offsets", "name_pool", "units", "hashes", "hash_ids"]
+
+
+def encode(string):
+    return string.encode("utf-8", "surrogatepass")
+
+
+def decode(pool, start, end):
+    return bytes(pool[start:end]).decode("utf-8", "surrogatepass")
+
+
+def named_unit_hash(path, name):
+    return zlib.crc32(encode(name), zlib.crc32(encode(path) + b"\0"))
+
+
+def pool_and_offsets(encoded_strings):
+    offsets = np.zeros(len(encoded_strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded_strings], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded_strings), dtype=np.uint8), offsets
+
+
+# Write the symbol table of the given dict from (path, name) to ID, for IDs from 0 to size - 1.
+# Every file is replaced atomically, so that tables still mapped by other processes stay valid.
+def save_symbol_table(directory, named_unit_to_id, size):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    paths = sorted(set([path for path, _ in named_unit_to_id.keys()]))
+    path_index = {path: index for index, path in enumerate(paths)}
+    path_pool, path_offsets = pool_and_offsets([encode(path) for path in paths])
+
+    units = np.zeros(size, dtype=UNIT_DTYPE)
+    units["path"] = -1
+    names = [b""] * size
+    unit_ids = np.fromiter(named_unit_to_id.values(), dtype=np.int64, count=len(named_unit_to_id))
+    hashes = np.empty(len(named_unit_to_id), dtype=np.uint32)
+    for position, ((path, name), unit_id) in enumerate(named_unit_to_id.items()):
+        units["path"][unit_id] = path_index[path]
+        names[unit_id] = encode(name)
+        hashes[position] = named_unit_hash(path, name)
+    name_pool, name_offsets = pool_and_offsets(names)
+    units["name"] = name_offsets[:-1]
+    units["length"] = np.diff(name_offsets)
+
+    order = np.argsort(hashes, kind="stable")
+    arrays = {"path_pool": path_pool, "path_offsets": path_offsets, "name_pool": name_pool, "units": units,
+              "hashes": hashes[order], "hash_ids": unit_ids[order]}
+    for file_name in FILES:
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=str(directory), suffix=".npy")
+        with os.fdopen(file_descriptor, "wb") as fp:
+            np.save(fp, arrays[file_name])
+        os.replace(temporary_path, str(directory / (file_name + ".npy")))
+
+
+# Read-only view of a symbol table on disk. The arrays are memory mapped, only the paths are decoded on load.
+class SymbolTable:
+    def __init__(self, directory):
+        self.arrays = {file_name: np.load(str(Path(directory) / (file_name + ".npy")), mmap_mode="r")
+                       for file_name in FILES}
+        path_pool = self.arrays["path_pool"]
+        path_offsets = self.arrays["path_offsets"]
+        self.paths = [decode(path_pool, path_offsets[index], path_offsets[index + 1])
+                      for index in range(len(path_offsets) - 1)]
+        self.units = self.arrays["units"]
+        self.size = len(self.arrays["hash_ids"])
+        self.id_to_named_unit = IdToNamedUnit(self)
+        self.named_unit_to_id = NamedUnitToId(self)
+
+    def named_unit(self, unit_id):
+        if not isinstance(unit_id, (int, np.integer)) or not 0 <= unit_id < len(self.units):
+            return None
+        path_index, name, length = self.units[unit_id]
+        if path_index < 0:
+            return None
+        return self.paths[path_index], decode(self.arrays["name_pool"], name, name + length)
+
+    def unit_id(self, path, name):
+        hashes = self.arrays["hashes"]
+        named_unit_hash_value = named_unit_hash(path, name)
+        start = np.searchsorted(hashes, named_unit_hash_value, side="left")
+        end = np.searchsorted(hashes, named_unit_hash_value, side="right")
+        for unit_id in self.arrays["hash_ids"][start:end]:
+            if self.named_unit(unit_id) == (path, name):
+                return int(unit_id)
+        return None
+
+    def unit_ids(self):
+        return np.sort(self.arrays["hash_ids"])
+
+
+# ID -> (path, name)
+class IdToNamedUnit(Mapping):
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, unit_id):
+        named_unit = self.table.named_unit(unit_id)
+        if named_unit is None:
+            raise KeyError(unit_id)
+        return named_unit
+
+    def __iter__(self):
+        return (int(unit_id) for unit_id in self.table.unit_ids())
+
+    def __len__(self):
+        return self.table.size
+
+
+# (path, name) -> ID
+class NamedUnitToId(Mapping):
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, named_unit):
+        unit_id = self.table.unit_id(*named_unit)
+        if unit_id is None:
+            raise KeyError(named_unit)
+        return unit_id
+
+    def __iter__(self):
+        return (self.table.named_unit(unit_id) for unit_id in self.table.unit_ids())
+
+    def __len__(self):
+        return self.table.size
+
+    def items(self):
+        return [(self.table.named_unit(unit_id), int(unit_id)) for unit_id in self.table.unit_ids()]
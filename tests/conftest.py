@@ -0,0 +1,20 @@
+from pathlib import Path
+import sys
+import pytest
+
+# the modules of the repository are imported from its root, as the scripts do
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import save_and_load as io
+
+
+# Run the test in an empty working directory, in which the preprocessed files, the call graph and the symbol table
+# are stored, with a fresh connection to its database.
+@pytest.fixture
+def work_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(io, "database", None)
+    monkeypatch.setattr(io, "symbol_ids", None)
+    yield tmp_path
+    if io.database is not None:
+        io.database.close()
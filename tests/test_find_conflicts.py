@@ -0,0 +1,70 @@
+import time
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random
+import constants
+import find_conflicts
+
+
+def test_map_changed_units_keeps_id_zero():
+    branches = [["master", "branch_1"], ["master", "branch_2"]]
+    branch_changed_units = [{"a.cpp": {"f", "unknown"}}, {"a.cpp": {"f"}, "b.h": {"g"}}]
+    named_unit_to_id = {("a.cpp", "f"): 0, ("b.h", "g"): 1}
+    unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids = find_conflicts.map_changed_units(
+        branches, branch_changed_units, named_unit_to_id)
+    assert unit_id_to_branch_revision == {0: {"branch_1", "branch_2"}, 1: {"branch_2"}}
+    assert branch_revision_to_unit_id == {"branch_1": {0}, "branch_2": {0, 1}}
+    assert changed_ids == [0, 1]
+
+
+# a random called_by_graph with the callers of the changed units of random branches
+def random_analysis(seed):
+    rng = np.random.default_rng(seed)
+    size = int(rng.integers(5, 150))
+    called_by_graph = sparse_random(size, size, density=0.04, format="csr", random_state=seed)
+    called_by_graph.data[:] = 1
+    branch_revision_to_unit_id = {"branch_{}".format(i): set(rng.choice(size, size=min(size, int(rng.integers(0, 12))),
+                                                                        replace=False).tolist())
+                                  for i in range(int(rng.integers(2, 5)))}
+    unit_id_to_branch_revision = {}
+    for branch, unit_ids in branch_revision_to_unit_id.items():
+        for unit_id in unit_ids:
+            unit_id_to_branch_revision.setdefault(unit_id, set([])).add(branch)
+    changed_ids = sorted(unit_id_to_branch_revision.keys())
+    callers, caller_paths, incidence = find_conflicts.find_callers(called_by_graph, changed_ids)
+    id_to_named_unit = {unit_id: ("f.cpp", str(unit_id)) for unit_id in range(size)}
+    return unit_id_to_branch_revision, branch_revision_to_unit_id, changed_ids, callers, caller_paths, incidence, \
+        id_to_named_unit
+
+
+# the search for the closest conflicts finds the conflicts of the full search with the same sort keys
+@pytest.mark.parametrize("seed", range(40))
+def test_closest_potential_conflicts_match_full_search(seed, monkeypatch):
+    monkeypatch.setattr(constants, "PAIR_BLOCK_SIZE", 7)
+    monkeypatch.setattr(constants, "MAX_PATH_LENGTH", int(np.random.default_rng(seed).integers(1, 4)))
+    analysis = random_analysis(seed)
+    full = find_conflicts.examine_pairs(*analysis)
+    sort_keys = [find_conflicts.potential_conflict_sort_key(conflict) for conflict in full]
+
+    closest, complete = find_conflicts.closest_potential_conflicts(*analysis)
+    assert complete
+    assert sorted(map(str, closest)) == sorted(map(str, full))
+    assert [find_conflicts.potential_conflict_sort_key(conflict) for conflict in closest] == sort_keys
+    for top_count in (1, 3, 10):
+        closest, complete = find_conflicts.closest_potential_conflicts(*analysis, top_count=top_count)
+        assert complete
+        assert [find_conflicts.potential_conflict_sort_key(conflict) for conflict in closest] == sort_keys[:top_count]
+
+    closest, complete = find_conflicts.closest_potential_conflicts(*analysis, top_count=5,
+                                                                   deadline=time.perf_counter() - 1)
+    assert closest == [] and (not complete or not full)
+
+
+def test_sort_key_tiers_cover_all_distances():
+    for max_distance in range(4):
+        tiers = list(find_conflicts.sort_key_tiers(max_distance))
+        assert [sort_key for sort_key, _ in tiers] == sorted(sort_key for sort_key, _ in tiers)
+        distance_pairs = [pair for _, pairs in tiers for pair in pairs]
+        # every pair of distances belongs to exactly one tier
+        assert sorted(distance_pairs) == [(distance_1, distance_2) for distance_1 in range(max_distance + 1)
+                                          for distance_2 in range(max_distance + 1)]
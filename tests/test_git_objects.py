@@ -0,0 +1,121 @@
+import subprocess as sp
+import constants
+import git_objects
+
+BLOB_A = "1" * 40
+BLOB_B = "2" * 40
+BLOB_C = "3" * 40
+
+# the output of "diff-tree --stdin -p -U0 --full-index" for one pair: a changed file with all kinds of hunks,
+# an added file, a deleted file and a file whose added lines look like headers
+PATCH = "\n".join([
+    "f" * 40,
+    "diff --git a/src/a.cpp b/src/a.cpp",
+    "index {}..{} 100644".format(BLOB_C, BLOB_A),
+    "--- a/src/a.cpp",
+    "+++ b/src/a.cpp",
+    "@@ -3 +3 @@ int main()",
+    "-    return 1;",
+    "+    return 0;",
+    "@@ -10,0 +11,3 @@ void helper()",
+    "+a",
+    "+b",
+    "+c",
+    "@@ -20,2 +23,0 @@",
+    "-x",
+    "-y",
+    "diff --git a/include/new.h b/include/new.h",
+    "new file mode 100644",
+    "index {}..{}".format("0" * 40, BLOB_B),
+    "--- /dev/null",
+    "+++ b/include/new.h",
+    "@@ -0,0 +1,2 @@",
+    "+++ b/fake.h",
+    "+diff --git a/fake.h b/fake.h",
+    "diff --git a/src/old.cpp b/src/old.cpp",
+    "deleted file mode 100644",
+    "index {}..{}".format(BLOB_C, "0" * 40),
+    "--- a/src/old.cpp",
+    "+++ /dev/null",
+    "@@ -1,2 +0,0 @@",
+    "-int old();",
+    "-",
+    "",
+]).encode("utf-8")
+
+
+def test_parse_patch():
+    changes = git_objects.parse_patch(PATCH.splitlines(keepends=True))
+    assert changes == {"src/a.cpp": (BLOB_A, [range(3, 3), range(11, 14), range(23, 23)]),
+                       "include/new.h": (BLOB_B, [range(1, 3)])}
+
+
+def test_parse_empty_patch():
+    assert git_objects.parse_patch([]) == {}
+    assert git_objects.parse_patch([("f" * 40 + "\n").encode("utf-8")]) == {}
+
+
+def test_split_paths():
+    assert git_objects.split_paths([b"commit\0src/a.cpp\0include/\xc3\xbc.h\0"]) == ["src/a.cpp", "include/ü.h"]
+    assert git_objects.split_paths([b"commit\0"]) == []
+    # paths with line breaks span several lines
+    assert git_objects.split_paths([b"commit\0a\n", b"b.cpp\0c.h\0"]) == ["a\nb.cpp", "c.h"]
+
+
+def git(path, *arguments):
+    return sp.check_output([*constants.GIT_CALL, str(path), *arguments])
+
+
+# the patch of a real repository, as read by GitChannel
+def test_parse_patch_of_git_output(tmp_path):
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "config", "user.email", "test@example.com")
+    git(tmp_path, "config", "user.name", "test")
+    (tmp_path / "a.cpp").write_text("".join("line {}\n".format(i) for i in range(1, 11)))
+    (tmp_path / "b.h").write_text("removed\n")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-q", "-m", "base")
+    base = str(git(tmp_path, "rev-parse", "HEAD"), 'utf-8').strip()
+
+    lines = ["line {}\n".format(i) for i in range(1, 11)]
+    lines[1] = "changed 2\n"
+    lines[5:7] = ["changed 6\n", "changed 7\n", "added\n"]
+    del lines[-1]
+    (tmp_path / "a.cpp").write_text("".join(lines))
+    (tmp_path / "b.h").unlink()
+    (tmp_path / "c.h").write_text("new\n")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-q", "-m", "change")
+
+    output = git(tmp_path, "diff-tree", "-r", "-p", "-U0", "--full-index", base, "HEAD")
+    blobs = {path: str(git(tmp_path, "rev-parse", "HEAD:" + path), 'utf-8').strip() for path in ("a.cpp", "c.h")}
+    assert git_objects.parse_patch(output.splitlines(keepends=True)) == {"a.cpp": (blobs["a.cpp"], [range(2, 2), range(6, 9), range(10, 10)]),
+                                               "c.h": (blobs["c.h"], [range(1, 1)])}
+
+
+# the outputs of several queries are read from the same processes, one after another
+def test_branch_diffs_through_channel(tmp_path):
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "config", "user.email", "test@example.com")
+    git(tmp_path, "config", "user.name", "test")
+    (tmp_path / "a.cpp").write_text("int a;\n")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-q", "-m", "base")
+    git(tmp_path, "branch", "-q", "base")
+    for branch, file_name in (("first", "b.h"), ("second", "c dü.h")):
+        git(tmp_path, "checkout", "-q", "-b", branch, "base")
+        (tmp_path / file_name).write_text("int {}_1;\nint {}_2;\n".format(branch, branch))
+        (tmp_path / "a.cpp").write_text("int a;\nint {};\n".format(branch))
+        git(tmp_path, "add", "-A")
+        git(tmp_path, "commit", "-q", "-m", branch)
+
+    channel = git_objects.GitChannel(tmp_path)
+    try:
+        diffs = channel.branch_diffs([("base", "first"), ("base", "second"), ("first", "second"), ("base", "base")])
+    finally:
+        channel.close()
+    assert [sorted(changed_paths) for changed_paths, _ in diffs] == [["a.cpp", "b.h"], ["a.cpp", "c dü.h"],
+                                                                      ["a.cpp", "b.h", "c dü.h"], []]
+    assert {path: intervals for path, (_, intervals) in diffs[1][1].items()} == {"a.cpp": [range(2, 2)],
+                                                                                 "c dü.h": [range(1, 3)]}
+    assert diffs[3][1] == {}
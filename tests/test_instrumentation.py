@@ -0,0 +1,31 @@
+import pytest
+import instrumentation
+
+MEGABYTE = 1024 ** 2
+
+
+@pytest.fixture(autouse=True)
+def fresh_stages(monkeypatch):
+    monkeypatch.setattr(instrumentation, "stages", [])
+    if not instrumentation.reset_peak_rss():
+        pytest.skip("the peak resident set size can not be reset")
+
+
+def allocate(size):
+    data = bytearray(size)
+    # touch every page, so that it is resident
+    data[::4096] = b"1" * len(data[::4096])
+    return len(data)
+
+
+# every stage measures its own peak, outer stages include the peaks of the stages within them
+def test_stage_peaks_are_measured_per_stage():
+    with instrumentation.stage("outer"):
+        with instrumentation.stage("large"):
+            allocate(200 * MEGABYTE)
+        with instrumentation.stage("small"):
+            pass
+    stages = {record["stage"]: record for record in instrumentation.stages}
+    assert stages["large"]["max_rss_bytes"] > stages["small"]["max_rss_bytes"] + 150 * MEGABYTE
+    assert stages["outer"]["max_rss_bytes"] >= stages["large"]["max_rss_bytes"]
+    assert stages["small"]["process_max_rss_bytes"] >= stages["large"]["max_rss_bytes"]
@@ -0,0 +1,243 @@
+from io import BytesIO
+import sqlite3
+import subprocess as sp
+import numpy as np
+from lxml import etree
+import pytest
+import constants
+import instrumentation
+import precompute
+import save_and_load as io
+
+
+def file_properties(path, includes, calls):
+    return {constants.INCLUDES: set(includes) | {path},
+            constants.CALLS_NAIVE: {unit: set(names) for unit, names in calls.items()}}
+
+
+VERSION_1 = {
+    "a.h": file_properties("a.h", [], {"f": ["g"], "g": ["h"], "unused": []}),
+    "b.h": file_properties("b.h", ["a.h"], {"h": [], "k": ["f", "g"]}),
+    "c.cpp": file_properties("c.cpp", ["b.h"], {"main": ["k", "f", "missing"]}),
+    "d.cpp": file_properties("d.cpp", ["b.h"], {"run": ["g2", "k"]}),
+}
+
+# g is replaced by g2, which d.cpp calls without changing, c.cpp is deleted and e.cpp added
+VERSION_2 = {
+    "a.h": file_properties("a.h", [], {"f": ["g2"], "g2": ["h"], "unused": []}),
+    "b.h": file_properties("b.h", ["a.h"], {"h": [], "k": ["f", "g2"]}),
+    "d.cpp": file_properties("d.cpp", ["b.h"], {"run": ["g2", "k"]}),
+    "e.cpp": file_properties("e.cpp", ["a.h"], {"main": ["f", "k"], "other": ["main"]}),
+}
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(constants, "PROGRESS_BARS", False)
+
+
+def save_version(files):
+    io.delete_preprocessed_files(io.preprocessed_file_paths() - set(files.keys()))
+    io.save_preprocessed_files(files.items())
+    io.save_paths(files.keys())
+
+
+# the edges of a called_by_graph as (caller, callee) pairs of named units
+def named_edges(called_by_graph, id_to_named_unit):
+    callees, callers = called_by_graph.nonzero()
+    return set([(id_to_named_unit[int(caller)], id_to_named_unit[int(callee)])
+                for caller, callee in zip(callers, callees)])
+
+
+def build(incremental):
+    called_by_graph, id_to_named_unit, named_unit_to_id = precompute.build_call_graph(incremental)
+    return called_by_graph, dict(id_to_named_unit.items()), dict(named_unit_to_id.items())
+
+
+def test_full_call_graph(work_path):
+    save_version(VERSION_1)
+    called_by_graph, id_to_named_unit, named_unit_to_id = build(False)
+    assert len(named_unit_to_id) == 7 and called_by_graph.shape == (7, 7)
+    assert named_edges(called_by_graph, id_to_named_unit) == {
+        (("a.h", "f"), ("a.h", "g")), (("b.h", "k"), ("a.h", "f")), (("b.h", "k"), ("a.h", "g")),
+        (("c.cpp", "main"), ("b.h", "k")), (("c.cpp", "main"), ("a.h", "f")), (("d.cpp", "run"), ("b.h", "k"))}
+
+
+def test_incremental_call_graph_matches_full_build(work_path):
+    save_version(VERSION_1)
+    _, _, previous_ids = build(False)
+    save_version(VERSION_2)
+    called_by_graph, id_to_named_unit, named_unit_to_id = build(True)
+    edges = named_edges(called_by_graph, id_to_named_unit)
+    assert (("d.cpp", "run"), ("a.h", "g2")) in edges
+
+    # unchanged named units keep their IDs, the IDs of removed units are reused
+    for named_unit in [("a.h", "f"), ("a.h", "unused"), ("b.h", "k"), ("d.cpp", "run")]:
+        assert named_unit_to_id[named_unit] == previous_ids[named_unit]
+    assert called_by_graph.shape[0] == max(len(previous_ids), len(named_unit_to_id))
+
+    full_graph, full_id_to_named_unit, full_named_unit_to_id = build(False)
+    assert set(named_unit_to_id.keys()) == set(full_named_unit_to_id.keys())
+    assert edges == named_edges(full_graph, full_id_to_named_unit)
+
+
+def test_incremental_call_graph_without_changes(work_path):
+    save_version(VERSION_1)
+    called_by_graph, id_to_named_unit, named_unit_to_id = build(False)
+    edges = named_edges(called_by_graph, id_to_named_unit)
+    rebuilt_graph, rebuilt_id_to_named_unit, rebuilt_named_unit_to_id = build(True)
+    assert rebuilt_named_unit_to_id == named_unit_to_id
+    assert named_edges(rebuilt_graph, rebuilt_id_to_named_unit) == edges
+
+
+# removing most named units compacts the IDs, so that the graph does not keep the size of its largest version
+def test_incremental_call_graph_compacts_ids(work_path):
+    files = {"many.h": file_properties("many.h", [], {"unit_{}".format(i): ["unit_0"] for i in range(20)}),
+             "user.cpp": file_properties("user.cpp", ["many.h"], {"main": ["unit_3", "unit_19"]})}
+    save_version(files)
+    build(False)
+    files["many.h"] = file_properties("many.h", [], {"unit_3": ["unit_0"], "unit_0": []})
+    save_version(files)
+    called_by_graph, id_to_named_unit, named_unit_to_id = build(True)
+    assert called_by_graph.shape == (3, 3)
+    assert sorted(named_unit_to_id.values()) == [0, 1, 2]
+    assert named_edges(called_by_graph, id_to_named_unit) == {
+        (("many.h", "unit_3"), ("many.h", "unit_0")), (("user.cpp", "main"), ("many.h", "unit_3"))}
+    assert np.array_equal(io.load_call_graph().toarray(), called_by_graph.transpose().toarray())
+
+
+# IDs are assigned in the order of paths and names, so that every full build numbers the units alike
+def test_full_call_graph_assigns_sorted_ids(work_path):
+    save_version(VERSION_1)
+    _, _, named_unit_to_id = build(False)
+    assert sorted(named_unit_to_id, key=named_unit_to_id.get) == sorted(named_unit_to_id)
+
+
+# a resident state only loads the files changed since the last build, unless another connection wrote the database
+def test_resident_call_graph_loads_changed_files(work_path):
+    resident = precompute.PreprocessedFiles()
+    save_version(VERSION_1)
+    precompute.build_call_graph(True, resident)
+    instrumentation.take_counts()
+
+    io.delete_preprocessed_files(["c.cpp"])
+    io.save_preprocessed_files((path, VERSION_2[path]) for path in ["a.h", "b.h", "e.cpp"])
+    io.save_paths(VERSION_2.keys())
+    called_by_graph, id_to_named_unit, named_unit_to_id = precompute.build_call_graph(True, resident)
+    assert instrumentation.take_counts()[("preprocessed_files_loaded", ())] == 3
+    edges = named_edges(called_by_graph, id_to_named_unit)
+    full_graph, full_id_to_named_unit, _ = build(False)
+    assert edges == named_edges(full_graph, full_id_to_named_unit)
+    instrumentation.take_counts()
+
+    other = sqlite3.connect(str(constants.DUMP_DATABASE))
+    other.execute("DELETE FROM paths WHERE path = ?", ("e.cpp",))
+    other.commit()
+    other.close()
+    called_by_graph, id_to_named_unit, named_unit_to_id = precompute.build_call_graph(True, resident)
+    assert instrumentation.take_counts()[("preprocessed_files_loaded", ())] == 3
+    assert ("e.cpp", "main") not in named_unit_to_id
+    assert named_edges(called_by_graph, id_to_named_unit) == edges - {edge for edge in edges if edge[0][0] == "e.cpp"}
+
+
+# the units named by a file of every parse, with the number of files reused from the blob cache and parsed
+def parse(src_path):
+    precompute.parse_source_code(src_path, changed_files=set([]), workers=1)
+    counts = instrumentation.take_counts()
+    units = {path: sorted(properties[constants.CALLS_NAIVE]) for path, properties in io.load_preprocessed_files()}
+    return units, counts.get(("blob_cache_hits", ()), 0), counts[("files_parsed", ())]
+
+
+# switching the extractor parses the unchanged files again, the results of both extractors stay cached
+def test_parse_source_code_reparses_files_of_another_extractor(work_path, monkeypatch):
+    src_path = work_path / "src"
+    src_path.mkdir()
+    sp.run(["git", "init", "-q", str(src_path)], check=True)
+    (src_path / "a.cpp").write_text("void f() { g(); }\n")
+    monkeypatch.setattr(constants, "BLOB_CACHE", True)
+    monkeypatch.setattr(constants, "EXTRACTOR", constants.EXTRACTOR_TOKENIZER)
+    instrumentation.take_counts()
+    assert parse(src_path) == ({"a.cpp": ["f"]}, 0, 1)
+    assert parse(src_path) == ({"a.cpp": ["f"]}, 0, 0)
+
+    monkeypatch.setattr(constants, "EXTRACTOR", constants.EXTRACTOR_SRCML)
+    monkeypatch.setattr(precompute, "extract_properties", lambda src_path, paths, queries: [
+        ({constants.INCLUDES: set([]), constants.CALLS_NAIVE: {"srcml_f": set([])}}, constants.EXTRACTOR_SRCML)
+        for _ in paths])
+    assert parse(src_path) == ({"a.cpp": ["srcml_f"]}, 0, 1)
+
+    monkeypatch.setattr(constants, "EXTRACTOR", constants.EXTRACTOR_TOKENIZER)
+    assert parse(src_path) == ({"a.cpp": ["f"]}, 1, 0)
+
+
+# A srcml archive of two files with every kind of named unit: declarations in namespaces, classes with members,
+# operators and templates, which are no named units, qualified names, a macro block, structs, enums, typedefs,
+# constructors and unions. Only some elements have positions, the others get their lines from their descendants.
+SRCML_ARCHIVE = b"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<unit xmlns="http://www.srcML.org/srcML/src" xmlns:cpp="http://www.srcML.org/srcML/cpp" \
+xmlns:pos="http://www.srcML.org/srcML/position" revision="1.0.0">
+<unit revision="1.0.0" language="C++" filename="a.cpp">\
+<cpp:include pos:start="1:1" pos:end="1:15">#<cpp:directive>include</cpp:directive> <cpp:file>"b.h"</cpp:file>\
+</cpp:include>
+<cpp:include>#<cpp:directive>include</cpp:directive> <cpp:file>&lt;vector&gt;</cpp:file></cpp:include>
+<namespace pos:start="3:1" pos:end="9:1">namespace <name>ns</name> <block>{
+<decl_stmt pos:start="4:1" pos:end="4:10"><decl><type><name>Foo</name></type> <name>global_foo</name> <init>= <expr>\
+<call><name>make</name><argument_list>()</argument_list></call></expr></init></decl>;</decl_stmt>
+<class pos:start="5:1" pos:end="8:2">class <name>Bar</name> <super_list>: <super><specifier>public</specifier> \
+<name>Base</name></super></super_list><block>{<private type="default">
+<function pos:start="6:1" pos:end="6:30"><type><name>int</name></type> <name>get</name><parameter_list>()\
+</parameter_list> <block>{<block_content> <return>return <expr><call><name><name>helper</name><operator>::</operator>\
+<name>compute</name></name><argument_list>(<argument><expr><name>x</name></expr></argument>)</argument_list></call>\
+</expr>;</return> </block_content>}</block></function>
+<function_decl><type pos:start="7:1" pos:end="7:4"><name>void</name></type> <name>set</name><parameter_list>(\
+<parameter><decl><type><name>Value</name></type> <name>v</name></decl></parameter>)</parameter_list>;</function_decl>
+</private>}</block>;</class>
+}</block></namespace>
+<function type="operator" pos:start="10:1" pos:end="10:20"><type><name>bool</name></type> <name>operator\
+<operator>==</operator></name><parameter_list>()</parameter_list><block>{<block_content><expr_stmt><expr><call>\
+<name>compare</name><argument_list>()</argument_list></call></expr>;</expr_stmt></block_content>}</block></function>
+<template pos:start="11:1" pos:end="11:40">template<parameter_list>&lt;<parameter><type><name>typename</name></type> \
+<name>T</name></parameter>&gt;</parameter_list> <class>class <name>Tpl</name> <block>{}</block>;</class></template>
+<function pos:start="12:1" pos:end="17:1"><type><name>void</name></type> <name><name>Bar</name><operator>::</operator>\
+<name>run</name></name><parameter_list>()</parameter_list> <block>{<block_content>
+<comment type="line">// hi</comment>
+<expr_stmt pos:start="14:1" pos:end="14:6"><expr><call><name>get</name><argument_list>()</argument_list></call></expr>;\
+</expr_stmt>
+<macro pos:start="15:1" pos:end="15:16"><name>DEFINE_THING</name><argument_list>(<argument>a</argument>)\
+</argument_list></macro> <block pos:start="15:18" pos:end="16:1">{<block_content> <expr_stmt><expr><call>\
+<name>inner</name><argument_list>()</argument_list></call></expr>;</expr_stmt> </block_content>}</block>
+</block_content>}</block></function>
+<struct pos:start="18:1" pos:end="18:30">struct <name>S</name> <block>{<public type="default"> <decl_stmt><decl><type>\
+<name>Other</name></type> <name>o</name></decl>;</decl_stmt> </public>}</block>;</struct>
+<enum pos:start="19:1" pos:end="19:15">enum <name>E</name> <block>{ <decl><name>A</name></decl> }</block>;</enum>
+<typedef pos:start="20:1" pos:end="20:17">typedef <type><name>int</name></type> <name>myint</name>;</typedef>
+<constructor><name pos:start="21:1" pos:end="21:8"><name>Bar</name><operator>::</operator><name>Bar</name></name>\
+<parameter_list>()</parameter_list> <member_init_list>: <call><name>Base</name><argument_list>()</argument_list>\
+</call></member_init_list> <block pos:start="22:1" pos:end="23:1">{}</block></constructor>
+</unit>
+<unit revision="1.0.0" language="C++" filename="b.h">\
+<function_decl pos:start="1:1" pos:end="1:15"><type><name>int</name></type> <name>compute</name><parameter_list>()\
+</parameter_list>;</function_decl>
+<union pos:start="2:1" pos:end="2:20">union <name>U</name> <block>{ <decl_stmt><decl><type><name>int</name></type> \
+<name>i</name></decl>;</decl_stmt> }</block>;</union></unit>
+</unit>"""
+
+
+# the streaming extraction agrees with the extraction from the whole tree
+def test_streaming_extractor_matches_tree_extraction():
+    xpath_includes, xpath_named_units, xpath_calls, xpath_name = precompute.compile_preprocessing_queries()
+    streamed = {filename: (properties, spans) for filename, properties, spans in
+                precompute.StreamingExtractor(xpath_name).extract(BytesIO(SRCML_ARCHIVE))}
+    root = etree.fromstring(SRCML_ARCHIVE)
+    units = list(root.iterchildren(constants.TAGS["unit"]))
+    assert sorted(streamed) == ["a.cpp", "b.h"]
+    assert streamed["a.cpp"][1] == [(5, 8, "Bar"), (6, 6, "get"), (7, 7, "set"), (12, 17, "run"),
+                                    (15, 16, "DEFINE_THING(a)"), (18, 18, "S"), (19, 19, "E"), (20, 20, "myint"),
+                                    (21, 23, "Bar")]
+    for unit in units:
+        properties = {constants.INCLUDES: set([]), constants.CALLS_NAIVE: {}}
+        precompute.find_includes(xpath_includes, unit, properties)
+        precompute.find_named_units(xpath_named_units, xpath_calls, xpath_name, unit, properties)
+        streamed_properties, streamed_spans = streamed[unit.get("filename")]
+        assert streamed_properties == properties
+        assert streamed_spans == precompute.find_named_unit_spans(xpath_named_units, xpath_name, unit)
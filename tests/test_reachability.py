@@ -0,0 +1,83 @@
+import numpy as np
+from scipy.sparse import csr_matrix, csgraph
+import reachability
+
+
+def random_graph(size, edges, seed):
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, size, edges)
+    columns = rng.integers(0, size, edges)
+    graph = csr_matrix((np.ones(edges, dtype=np.int8), (rows, columns)), shape=(size, size))
+    graph.sum_duplicates()
+    return graph
+
+
+# every (source, node) pair within max_depth edges, with its distance, found by the breadth first search of scipy
+def expected_pairs(graph, sources, max_depth):
+    distances = csgraph.shortest_path(graph, unweighted=True, indices=sources)
+    return {(origin, node): int(distance) for origin, row in enumerate(distances)
+            for node, distance in enumerate(row) if distance <= max_depth}
+
+
+def test_bounded_bfs_matches_unbounded_search():
+    graph = random_graph(200, 500, seed=1)
+    sources = [0, 5, 5, 17, 199]
+    for max_depth in (0, 1, 3, 10):
+        origins, nodes, distances, predecessors = reachability.bounded_bfs(graph, sources, max_depth)
+        found = {(int(origin), int(node)): int(distance) for origin, node, distance in zip(origins, nodes, distances)}
+        assert len(found) == len(origins)
+        assert found == expected_pairs(graph, sources, max_depth)
+        assert list(zip(origins, nodes)) == sorted(zip(origins, nodes))
+
+
+def test_bounded_bfs_predecessors_lie_on_shortest_paths():
+    graph = random_graph(100, 300, seed=2)
+    sources = [3, 40]
+    origins, nodes, distances, predecessors = reachability.bounded_bfs(graph, sources, 5)
+    distance = {(int(origin), int(node)): int(d) for origin, node, d in zip(origins, nodes, distances)}
+    for origin, node, d, predecessor in zip(origins, nodes, distances, predecessors):
+        if d == 0:
+            assert node == sources[origin] and predecessor == -1
+        else:
+            assert graph[predecessor, node]
+            assert distance[(int(origin), int(predecessor))] == d - 1
+
+
+def test_bounded_bfs_without_sources_or_edges():
+    graph = csr_matrix((4, 4), dtype=np.int8)
+    origins, nodes, distances, predecessors = reachability.bounded_bfs(graph, [2], 3)
+    assert origins.tolist() == [0] and nodes.tolist() == [2] and distances.tolist() == [0]
+    assert predecessors.tolist() == [-1]
+    assert all(len(array) == 0 for array in reachability.bounded_bfs(graph, [], 3))
+
+
+def test_bounded_reachability_matches_matrix_powers():
+    graph = random_graph(150, 300, seed=3)
+    for max_depth, block_size in ((1, 150), (2, 7), (4, 32), (6, 1)):
+        expected = csr_matrix(graph.shape, dtype=bool)
+        power = csr_matrix(graph, dtype=np.int64)
+        for _ in range(max_depth):
+            expected = expected + power.astype(bool)
+            power = (power @ graph).astype(bool).astype(np.int64)
+        reachable = reachability.bounded_reachability(graph, max_depth, block_size)
+        assert reachable.dtype == bool
+        assert (reachable != expected.astype(bool)).nnz == 0
+
+
+def test_bounded_reachability_of_empty_graph():
+    assert reachability.bounded_reachability(csr_matrix((0, 0), dtype=np.int8), 3, 16).shape == (0, 0)
+
+
+def test_shortest_paths_follow_the_predecessors_back_to_the_source():
+    graph = random_graph(120, 360, seed=4)
+    sources = [1, 60, 60]
+    origins, nodes, distances, predecessors = reachability.bounded_bfs(graph, sources, 6)
+    paths = reachability.shortest_paths(graph.shape[0], origins, nodes, predecessors)
+    assert paths.shape[0] == len(nodes)
+    assert paths.shape[1] == distances.max() + 1
+    for origin, node, distance, path in zip(origins, nodes, distances, paths):
+        path = path[path >= 0].tolist()
+        assert len(path) == distance + 1
+        assert path[0] == node and path[-1] == sources[origin]
+        # the path leads from the node back to its source, against the edges of the graph
+        assert all(graph[predecessor, node] for node, predecessor in zip(path, path[1:]))
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import symbol_table
+
+
+@pytest.fixture
+def named_unit_to_id():
+    # ID 2 is unused, as after removing a named unit in an incremental build
+    return {("src/a.cpp", "main"): 0, ("src/a.cpp", "helper"): 1, ("include/b.h", "main"): 3,
+            ("include/ü.h", "operator<<"): 4, ("src/a.cpp", ""): 5}
+
+
+def test_symbol_table_round_trip(tmp_path, named_unit_to_id):
+    symbol_table.save_symbol_table(tmp_path, named_unit_to_id, 6)
+    table = symbol_table.SymbolTable(tmp_path)
+    assert dict(table.named_unit_to_id.items()) == named_unit_to_id
+    assert dict(table.id_to_named_unit.items()) == {unit_id: named_unit
+                                                   for named_unit, unit_id in named_unit_to_id.items()}
+    assert len(table.named_unit_to_id) == len(table.id_to_named_unit) == len(named_unit_to_id)
+    assert sorted(table.id_to_named_unit) == [0, 1, 3, 4, 5]
+    for named_unit, unit_id in named_unit_to_id.items():
+        assert table.named_unit_to_id[named_unit] == unit_id
+        assert table.id_to_named_unit[np.int64(unit_id)] == named_unit
+
+
+def test_symbol_table_misses(tmp_path, named_unit_to_id):
+    symbol_table.save_symbol_table(tmp_path, named_unit_to_id, 6)
+    table = symbol_table.SymbolTable(tmp_path)
+    for unit_id in (2, 6, -1, "0"):
+        assert unit_id not in table.id_to_named_unit
+        with pytest.raises(KeyError):
+            table.id_to_named_unit[unit_id]
+    assert ("src/a.cpp", "missing") not in table.named_unit_to_id
+    assert ("src/missing.cpp", "main") not in table.named_unit_to_id
+    assert table.named_unit_to_id.get(("include/b.h", "helper")) is None
+
+
+# named units with colliding hashes are told apart by comparing path and name
+def test_symbol_table_hash_collisions(tmp_path, named_unit_to_id, monkeypatch):
+    monkeypatch.setattr(symbol_table, "named_unit_hash", lambda path, name: 7)
+    symbol_table.save_symbol_table(tmp_path, named_unit_to_id, 6)
+    table = symbol_table.SymbolTable(tmp_path)
+    for named_unit, unit_id in named_unit_to_id.items():
+        assert table.named_unit_to_id[named_unit] == unit_id
+    assert ("src/a.cpp", "missing") not in table.named_unit_to_id
+
+
+# saving replaces the files, so that a table loaded before keeps reading the old IDs
+def test_symbol_table_survives_replacement(tmp_path, named_unit_to_id):
+    symbol_table.save_symbol_table(tmp_path, named_unit_to_id, 6)
+    table = symbol_table.SymbolTable(tmp_path)
+    symbol_table.save_symbol_table(tmp_path, {("src/c.cpp", "other"): 0}, 1)
+    assert table.named_unit_to_id[("src/a.cpp", "helper")] == 1
+    assert symbol_table.SymbolTable(tmp_path).id_to_named_unit[0] == ("src/c.cpp", "other")
+
+
+def test_empty_symbol_table(tmp_path):
+    symbol_table.save_symbol_table(tmp_path, {}, 0)
+    table = symbol_table.SymbolTable(tmp_path)
+    assert len(table.named_unit_to_id) == 0
+    assert list(table.id_to_named_unit) == []
+    assert ("a", "b") not in table.named_unit_to_id
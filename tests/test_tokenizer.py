@@ -0,0 +1,103 @@
+import constants
+import tokenizer
+
+
+def extract(*lines):
+    properties, spans = tokenizer.extract_source("\n".join(lines) + "\n")
+    return properties[constants.INCLUDES], properties[constants.CALLS_NAIVE], spans
+
+
+def test_function_with_includes_and_calls():
+    includes, calls, spans = extract(
+        '#include "a.h"',
+        "#include <vector>",
+        "int add(int a, int b) {",
+        "  return helper(a) + b;",
+        "}")
+    # only quoted includes are local files
+    assert includes == {"a.h"}
+    assert calls == {"add": {"add", "helper", "a"}}
+    assert spans == [(3, 5, "add")]
+
+
+def test_constructors_and_destructors():
+    includes, calls, spans = extract(
+        "struct Point {",
+        "  Point(int x) : x(x) {}",
+        "  ~Point() { release(); }",
+        "  int x;",
+        "};",
+        "Point::Point() : x(make()) {",
+        "}")
+    assert includes == set([])
+    # the calls of the members are also calls of their class
+    assert calls == {"Point": {"Point", "x", "release", "make"}, "~Point": {"~Point", "release"}}
+    assert spans == [(1, 5, "Point"), (2, 2, "Point"), (3, 3, "~Point"), (6, 7, "Point")]
+
+
+def test_classes_and_declarators():
+    _, calls, spans = extract(
+        "namespace ns {",
+        "class Base;",
+        "class Widget : public Base {",
+        "  void draw();",
+        "};",
+        "int counter = 0, *pointer;",
+        "struct { int a; } anonymous;",
+        "}")
+    assert calls == {"Base": {"Base"}, "Widget": {"Widget"}, "draw": {"draw"}, "counter": {"counter"},
+                     "pointer": {"pointer"}, "anonymous": {"anonymous"}}
+    assert spans == [(2, 2, "Base"), (3, 5, "Widget"), (4, 4, "draw"), (6, 6, "counter"), (6, 6, "pointer"),
+                     (7, 7, "anonymous")]
+
+
+def test_variables_outside_of_namespaces_are_no_named_units():
+    _, calls, spans = extract(
+        "int counter = start();",
+        "void run() { int local = 0; }")
+    assert calls == {"run": {"run"}}
+    assert spans == [(2, 2, "run")]
+
+
+def test_typedefs():
+    _, calls, spans = extract(
+        "typedef struct Node { int v; } Node;",
+        "typedef void (*Callback)(Event*);",
+        "typedef unsigned long Size;")
+    assert calls == {"Node": {"Node"}, "Callback": {"Callback", "Event"}, "Size": {"Size"}}
+    assert spans == [(1, 1, "Node"), (1, 1, "Node"), (2, 2, "Callback"), (3, 3, "Size")]
+
+
+def test_macro_blocks_are_named_by_their_text():
+    _, calls, spans = extract(
+        "FOR_EACH(item, items) {",
+        "  visit(item);",
+        "}",
+        "TEST(Suite, Case) {",
+        "  check();",
+        "}")
+    assert calls == {"FOR_EACH(item, items)": {"FOR_EACH(item, items)", "visit", "item"},
+                     "TEST(Suite, Case)": {"TEST(Suite, Case)", "check"}}
+    assert spans == [(1, 3, "FOR_EACH(item, items)"), (4, 6, "TEST(Suite, Case)")]
+
+
+def test_operators_belong_to_the_units_around_them():
+    _, calls, spans = extract(
+        "class Vec {",
+        "  Vec operator+(const Vec& o) const { return add(o); }",
+        "  bool operator()(int i) { return at(i); }",
+        "};")
+    assert calls == {"Vec": {"Vec", "add", "o", "at", "i"}}
+    assert spans == [(1, 4, "Vec")]
+
+
+def test_extern_blocks_and_templates():
+    _, calls, spans = extract(
+        'extern "C" {',
+        "void c_api(void) { impl(); }",
+        "}",
+        "template <typename T>",
+        "T max_of(std::vector<T> const& v) { return *std::max_element(v.begin(), v.end()); }")
+    assert calls == {"c_api": {"c_api", "impl"},
+                     "max_of": {"max_of", "T", "std", "vector", "v", "max_element", "begin", "end"}}
+    assert spans == [(2, 2, "c_api"), (4, 5, "max_of")]
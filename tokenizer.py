@@ -0,0 +1,528 @@
+import re
+import constants
+
+# Extracts includes, named units with their naive calls and their line spans from C++ source without srcml.
+# The source is split into tokens by a single regular expression and declarations are recognized by their shape,
+# e.g. a name followed by a parameter list and a body. Like srcml, nothing is preprocessed: macros are read as written
+# and both branches of conditional compilation are read. The calls of a named unit are the names used like calls
+# or types: called names with all names in their arguments, qualifiers, template arguments and names followed by
+# a declared name. Declarations hidden behind macros may be missed and names used as types are guessed, so the result
+# is less precise than the one of srcml, in exchange for a much faster extraction.
+
+# a "#" starts a directive, anywhere else it can only appear in the definition of a macro, which is a directive itself
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>(?:\s|\\\n)+)
+  | (?P<comment>//(?:\\\n|[^\n])*|/\*.*?(?:\*/|\Z))
+  | (?P<literal>(?:u8|[uUL])?R"(?P<delimiter>[^()\\\s]{0,16})\(.*?\)(?P=delimiter)"
+      | (?:u8|[uUL])?"(?:\\.|[^"\\\n])*"?
+      | (?:u8|[uUL])?'(?:\\.|[^'\\\n])*'?
+      | \.?[0-9](?:[eEpP][+-]|[0-9A-Za-z_.])*)
+  | (?P<identifier>[A-Za-z_$][A-Za-z0-9_$]*)
+  | (?P<directive>\#(?:\\\n|/\*.*?\*/|[^\n])*)
+  | (?P<punctuation>::|->|.)
+""", re.VERBOSE | re.DOTALL)
+INCLUDE_PATTERN = re.compile(r'[ \t]*#[ \t]*include[ \t]*("[^"\n]*")')
+
+# tokens are (kind, text, line, start offset, end offset)
+KIND, TEXT, LINE, START, END = range(5)
+IDENTIFIER = "identifier"
+LITERAL = "literal"
+PUNCTUATION = "punctuation"
+# stands for the body of a class defined in a statement
+CLASS_BODY = "class body"
+
+KEYWORDS = frozenset("""
+    alignas alignof and and_eq asm auto bitand bitor bool break case catch char char8_t char16_t char32_t class compl
+    concept const consteval constexpr constinit const_cast continue co_await co_return co_yield decltype default delete
+    do double dynamic_cast else enum explicit export extern false final float for friend goto if inline int long
+    mutable namespace new noexcept not not_eq nullptr operator or or_eq override private protected public register
+    reinterpret_cast requires return short signed sizeof static static_assert static_cast struct switch template this
+    thread_local throw true try typedef typeid typename union unsigned using virtual void volatile wchar_t while xor
+    xor_eq __attribute__ __declspec
+""".split())
+CASTS = frozenset(["static_cast", "dynamic_cast", "const_cast", "reinterpret_cast"])
+CLASS_KEYWORDS = frozenset(["class", "struct", "union", "enum"])
+SPECIFIERS = frozenset(["static", "inline", "virtual", "extern", "constexpr", "consteval", "constinit", "explicit",
+                        "friend", "thread_local", "mutable", "register", "export"])
+# specifiers followed by an argument list
+ATTRIBUTES = frozenset(["__attribute__", "__declspec", "alignas"])
+ACCESS_LABELS = frozenset(["public", "protected", "private", "slots", "signals", "Q_SLOTS", "Q_SIGNALS"])
+# number of tokens searched for the end of a template argument list
+ANGLE_LOOKAHEAD = 64
+ANGLE_STOPS = frozenset([";", "{", "}", "=", "|", "?"])
+
+# scopes, named variables are only declared in namespaces
+FILE, EXTERN, NAMESPACE, CLASS, BODY = "file", "extern", "namespace", "class", "body"
+
+
+def tokenize(source):
+    tokens = []
+    includes = set([])
+    line = 1
+    for match in TOKEN_PATTERN.finditer(source):
+        kind = match.lastgroup
+        if kind == IDENTIFIER or kind == PUNCTUATION:
+            # never contain a line break
+            tokens.append((kind, match.group(), line, match.start(), match.end()))
+            continue
+        text = match.group()
+        if kind == LITERAL:
+            tokens.append((kind, text, line, match.start(), match.end()))
+        elif kind == "directive":
+            include = INCLUDE_PATTERN.match(text)
+            if include:
+                included_file = include.group(1).split("\"")
+                if len(included_file) == 3:
+                    includes.add(included_file[1])
+        line += text.count("\n")
+    return tokens, includes
+
+
+def matching_parentheses(tokens):
+    closing = {}
+    open_positions = []
+    for position, token in enumerate(tokens):
+        if token[TEXT] == "(":
+            open_positions.append(position)
+        elif token[TEXT] == ")" and open_positions:
+            closing[open_positions.pop()] = position
+    return closing
+
+
+# position of the ">" closing the template argument list opened at position, None if "<" is a comparison
+def closing_angle(tokens, position):
+    depth = 0
+    parentheses = 0
+    for end in range(position, min(len(tokens), position + ANGLE_LOOKAHEAD)):
+        text = tokens[end][TEXT]
+        if text == "<":
+            depth += 1
+        elif text == ">":
+            depth -= 1
+            if depth == 0:
+                return end
+        elif text == "(":
+            parentheses += 1
+        elif text == ")":
+            parentheses -= 1
+            if parentheses < 0:
+                return None
+        elif text in ANGLE_STOPS or (text == "&" and end + 1 < len(tokens) and tokens[end + 1][TEXT] == "&"):
+            return None
+    return None
+
+
+def is_name(token):
+    return token[KIND] == IDENTIFIER and token[TEXT] not in KEYWORDS
+
+
+# Find the names used like calls or types in the given tokens.
+# The argument list at position parameters declares parameters, its names are no arguments of a call.
+def find_calls(tokens, parameters=None):
+    closing = matching_parentheses(tokens)
+    calls = set([])
+    # the names up to this position are arguments of a call or of a template
+    arguments_end = -1
+    for position, token in enumerate(tokens):
+        if token[KIND] != IDENTIFIER:
+            continue
+        text = token[TEXT]
+        if position < arguments_end:
+            if text not in KEYWORDS:
+                calls.add(text)
+            continue
+        if text in KEYWORDS and text not in CASTS:
+            continue
+
+        following = position + 1
+        following_text = tokens[following][TEXT] if following < len(tokens) else None
+        if following_text == "<":
+            end = closing_angle(tokens, following)
+            if end is not None:
+                arguments_end = end
+                following = end + 1
+                following_text = tokens[following][TEXT] if following < len(tokens) else None
+                if text not in KEYWORDS:
+                    calls.add(text)
+        if following_text == "(" and following != parameters:
+            arguments_end = max(arguments_end, closing.get(following, len(tokens)))
+            if text not in KEYWORDS:
+                calls.add(text)
+                # the objects of a member call, like the compound name of the call in srcml
+                previous = position - 1
+                while previous > 0 and tokens[previous][TEXT] in (".", "->") and is_name(tokens[previous - 1]):
+                    calls.add(tokens[previous - 1][TEXT])
+                    previous -= 2
+        elif text in KEYWORDS:
+            continue
+        elif following_text == "::":
+            calls.add(text)
+        elif following < len(tokens) and (is_name(tokens[following]) or following_text in ("const", "volatile")):
+            calls.add(text)
+        elif following_text in ("*", "&") and following + 1 < len(tokens):
+            after = tokens[following + 1]
+            if is_name(after) or after[TEXT] in ("*", "&", ")", ",", ">", "const"):
+                calls.add(text)
+    return calls
+
+
+# position after the argument list starting at position, which may also be a template argument list
+def skip_arguments(tokens, position):
+    if tokens[position][TEXT] == "<":
+        end = closing_angle(tokens, position)
+        return len(tokens) if end is None else end + 1
+    depth = 0
+    for end in range(position, len(tokens)):
+        text = tokens[end][TEXT]
+        if text in ("(", "["):
+            depth += 1
+        elif text in (")", "]"):
+            depth -= 1
+            if depth == 0:
+                return end + 1
+    return len(tokens)
+
+
+# position of the first token after template parameter lists, specifiers and attributes
+def skip_specifiers(tokens):
+    position = 0
+    while position < len(tokens):
+        text = tokens[position][TEXT]
+        following = tokens[position + 1][TEXT] if position + 1 < len(tokens) else None
+        if text == "template" and following == "<":
+            position = skip_arguments(tokens, position + 1)
+        elif text in ATTRIBUTES and following == "(":
+            position = skip_arguments(tokens, position + 1)
+        elif text == "[" and following == "[":
+            position = skip_arguments(tokens, position)
+        elif text in SPECIFIERS and tokens[position][KIND] == IDENTIFIER:
+            position += 1
+        else:
+            return position
+    return position
+
+
+# Find the name of a function declared by the tokens from start on.
+# Returns (position of the parameter list, position where the qualified name starts, name, qualifier calls),
+# with the name None for operators, or None if the tokens declare no function.
+def find_function(tokens, start):
+    depth = 0
+    for position in range(start, len(tokens)):
+        text = tokens[position][TEXT]
+        if depth == 0 and text == "=" or text == ";":
+            return None
+        if text == "operator" and depth == 0:
+            parameters = position + 1
+            if parameters < len(tokens) and tokens[parameters][TEXT] == "(":
+                # operator()
+                parameters += 2
+            while parameters < len(tokens) and tokens[parameters][TEXT] != "(":
+                parameters += 1
+            return (parameters, position, None, set([])) if parameters < len(tokens) else None
+        if text == "(" and depth == 0 and position > start:
+            name_position = position - 1
+            qualifier_calls = set([])
+            if tokens[name_position][TEXT] == ">":
+                # template specialization, e.g. foo<int>(...)
+                opening = name_position
+                nesting = 0
+                while opening > start:
+                    nesting += {">": 1, "<": -1}.get(tokens[opening][TEXT], 0)
+                    if nesting == 0:
+                        break
+                    opening -= 1
+                qualifier_calls.update(token[TEXT] for token in tokens[opening:name_position] if is_name(token))
+                name_position = opening - 1
+            if name_position >= start and is_name(tokens[name_position]):
+                name = tokens[name_position][TEXT]
+                qualified_start = name_position
+                if qualified_start > start and tokens[qualified_start - 1][TEXT] == "~":
+                    name = "~" + name
+                    qualified_start -= 1
+                while qualified_start - 1 > start and tokens[qualified_start - 1][TEXT] == "::" and \
+                        is_name(tokens[qualified_start - 2]):
+                    qualifier_calls.add(tokens[qualified_start - 2][TEXT])
+                    qualified_start -= 2
+                return position, qualified_start, name, qualifier_calls
+        if text in ("(", "["):
+            depth += 1
+        elif text in (")", "]"):
+            depth -= 1
+    return None
+
+
+# Find the name of a class, struct, union or enum defined or declared by the tokens from start on.
+# Returns (name, position after the name, number of names), the name "" for anonymous ones, or None if the tokens
+# declare no class. More than one name, e.g. "struct Node node", can only be a definition with a macro before the name.
+def find_class(tokens, start):
+    if start >= len(tokens) or tokens[start][TEXT] not in CLASS_KEYWORDS:
+        return None
+    position = start + 1
+    if tokens[start][TEXT] == "enum" and position < len(tokens) and tokens[position][TEXT] in ("class", "struct"):
+        position += 1
+    name = ""
+    names = 0
+    while position < len(tokens):
+        token = tokens[position]
+        if token[TEXT] in ATTRIBUTES or (token[TEXT] == "[" and position + 1 < len(tokens) and
+                                         tokens[position + 1][TEXT] == "["):
+            position = skip_arguments(tokens, position + 1 if token[TEXT] in ATTRIBUTES else position)
+        elif token[TEXT] == "<" and name:
+            position = skip_arguments(tokens, position)
+        elif token[TEXT] in ("final", "::"):
+            position += 1
+        elif is_name(token):
+            if tokens[position - 1][TEXT] != "::":
+                names += 1
+            name = token[TEXT]
+            position += 1
+        elif token[TEXT] in (":", "{", ";"):
+            return name, position, names
+        else:
+            return None
+    return name, position, names
+
+
+# Names declared by the given tokens of a declaration, e.g. "a" and "b" for "int a = 1, *b;".
+def declarator_names(tokens):
+    names = []
+    name = None
+    declarator_done = False
+    depth = 0
+    position = 0
+    while position < len(tokens):
+        token = tokens[position]
+        text = token[TEXT]
+        if depth == 0 and text == "<" and position > 0 and is_name(tokens[position - 1]):
+            position = skip_arguments(tokens, position)
+            continue
+        if text in ("(", "[", "{"):
+            if depth == 0 and text == "(" and position + 2 < len(tokens) and tokens[position + 1][TEXT] == "*" \
+                    and is_name(tokens[position + 2]) and not declarator_done:
+                # pointer to a function or an array
+                name = tokens[position + 2][TEXT]
+                declarator_done = True
+            elif depth == 0:
+                declarator_done = True
+            depth += 1
+        elif text in (")", "]", "}"):
+            depth -= 1
+        elif depth == 0 and text == "=":
+            declarator_done = True
+        elif depth == 0 and text in (",", ";"):
+            if name:
+                names.append(name)
+            name = None
+            declarator_done = False
+        elif depth == 0 and is_name(token) and not declarator_done:
+            name = text
+        position += 1
+    if name:
+        names.append(name)
+    return names
+
+
+class Extractor:
+    def __init__(self, source):
+        self.source = source
+        self.tokens, includes = tokenize(source)
+        self.position = 0
+        self.properties = {constants.INCLUDES: includes, constants.CALLS_NAIVE: {}}
+        self.spans = []
+        # open named units as [name, calls, first line]
+        self.frames = []
+
+    def extract(self):
+        self.scan(FILE)
+        return self.properties, sorted(self.spans, key=lambda span: span[0])
+
+    def record(self, name, calls, first, last):
+        if name:
+            self.properties[constants.CALLS_NAIVE].setdefault(name, {name}).update(calls)
+            self.spans.append((first, last, name))
+
+    def add_calls(self, calls):
+        if self.frames:
+            self.frames[-1][1].update(calls)
+
+    def open_frame(self, name, calls, first):
+        self.frames.append([name, set(calls), first])
+
+    # the calls of a named unit are also calls of the named units around it
+    def close_frame(self, last, qualifier_calls=()):
+        name, calls, first = self.frames.pop()
+        self.record(name, calls | set(qualifier_calls), first, last)
+        self.add_calls(calls)
+
+    # Read the tokens of a scope up to its closing brace, which is returned, None at the end of the file.
+    def scan(self, scope, class_name=None):
+        statement = []
+        while self.position < len(self.tokens):
+            token = self.tokens[self.position]
+            self.position += 1
+            text = token[TEXT]
+            if token[KIND] != PUNCTUATION:
+                statement.append(token)
+            elif text == "}":
+                if scope == FILE:
+                    # unbalanced braces, e.g. from conditional compilation
+                    continue
+                self.end_statement(statement, scope, class_name)
+                return token
+            elif text == ";":
+                statement.append(token)
+                self.end_statement(statement, scope, class_name)
+                statement = []
+            elif text == "{":
+                statement = self.open_brace(statement, token, scope, class_name)
+            elif text == ":" and scope == CLASS and statement and statement[-1][TEXT] in ACCESS_LABELS:
+                statement = []
+            else:
+                statement.append(token)
+        self.end_statement(statement, scope, class_name)
+        return None
+
+    # Read a brace enclosed initializer into the statement, returns the statement.
+    def read_initializer(self, statement, brace):
+        statement.append(brace)
+        depth = 1
+        while self.position < len(self.tokens) and depth:
+            token = self.tokens[self.position]
+            self.position += 1
+            depth += {"{": 1, "}": -1}.get(token[TEXT], 0) if token[KIND] == PUNCTUATION else 0
+            statement.append(token)
+        return statement
+
+    # Read the body of a named unit. Returns the closing brace.
+    def read_body(self, name, calls, first, scope, class_name=None):
+        self.open_frame(name, calls, first)
+        return self.scan(scope, class_name)
+
+    def last_line(self, closing):
+        return closing[LINE] if closing else self.tokens[-1][LINE]
+
+    # Handle an opening brace ending the given statement. Returns the tokens of the statement continuing after the
+    # brace, e.g. the declarators after a class definition.
+    def open_brace(self, statement, brace, scope, class_name):
+        start = skip_specifiers(statement)
+        first = statement[0][LINE] if statement else brace[LINE]
+        typedef = start < len(statement) and statement[start][TEXT] == "typedef"
+        class_found = find_class(statement, start + 1 if typedef else start)
+        if class_found is not None:
+            name = class_found[0]
+            closing = self.read_body(name, find_calls(statement), first,
+                                     BODY if "enum" in [token[TEXT] for token in statement[start:start + 2]] else CLASS,
+                                     name)
+            self.close_frame(self.last_line(closing))
+            return statement + [(CLASS_BODY, "{}", self.last_line(closing), brace[START], brace[END])]
+        if scope == BODY:
+            self.add_calls(find_calls(statement))
+            self.scan(BODY)
+            return []
+
+        if statement and statement[0][TEXT] == "extern" and len(statement) == 2 and statement[1][KIND] == LITERAL:
+            self.scan(EXTERN)
+            return []
+        if start < len(statement) and statement[start][TEXT] == "namespace":
+            self.scan(NAMESPACE)
+            return []
+
+        function = find_function(statement, start)
+        if function is None or (statement and statement[-1][TEXT] not in (")", "}") and
+                                self.in_initializer_list(statement, function[0])):
+            return self.read_initializer(statement, brace)
+        parameters, qualified_start, name, qualifier_calls = function
+        parameters_end = skip_arguments(statement, parameters)
+        if name and qualified_start == start and qualifier_calls == set([]) and \
+                parameters_end == len(statement) and start == 0 and \
+                not (scope == CLASS and name in (class_name, "~{}".format(class_name))):
+            # a macro followed by a block, named by the text of the macro
+            name = self.source[statement[0][START]:statement[-1][END]]
+            closing = self.read_body(name, set([]), first, BODY)
+            self.close_frame(self.last_line(closing))
+            return []
+        closing = self.read_body(name, find_calls(statement, parameters), first, BODY)
+        if name is None:
+            # operators are no named units, their calls belong to the units around them
+            self.add_calls(self.frames.pop()[1])
+        else:
+            self.close_frame(self.last_line(closing), qualifier_calls)
+        return []
+
+    # whether a brace after the parameter list of a constructor starts the initializer of a member
+    @staticmethod
+    def in_initializer_list(statement, parameters):
+        end = skip_arguments(statement, parameters)
+        return any(token[TEXT] == ":" for token in statement[end:]) and \
+            (is_name(statement[-1]) or statement[-1][TEXT] == ">")
+
+    # Handle a statement ending with ";" or the end of its scope.
+    def end_statement(self, statement, scope, class_name):
+        if not statement:
+            return
+        if scope == BODY:
+            self.add_calls(find_calls(statement))
+            return
+        first = statement[0][LINE]
+        last = statement[-1][LINE]
+        start = skip_specifiers(statement)
+        if start >= len(statement) or statement[start][TEXT] in ("using", "namespace", "template", "static_assert"):
+            return
+        class_definition = any(token[KIND] == CLASS_BODY for token in statement)
+        function = None
+        if statement[start][TEXT] != "typedef" and not class_definition:
+            function = find_function(statement, start)
+        calls = find_calls(statement, function[0] if function else None)
+        self.add_calls(calls)
+        if statement[start][TEXT] == "typedef":
+            names = declarator_names(self.declarators(statement, start + 1))
+            if names:
+                self.record(names[0], calls, first, last)
+            return
+        if class_definition:
+            # the declarators following the definition of a class
+            if scope == NAMESPACE:
+                for name in declarator_names(self.declarators(statement, start)):
+                    self.record(name, calls, first, last)
+            return
+
+        class_found = find_class(statement, start)
+        if class_found is not None:
+            name, end, names = class_found
+            if names == 1 and end < len(statement) and statement[end][TEXT] in (";", ":"):
+                self.record(name, calls, first, last)
+                return
+        if function is not None:
+            _, qualified_start, name, qualifier_calls = function
+            # without a type, only constructors and destructors are declared, others are calls of macros
+            declared = qualified_start > start or qualifier_calls or \
+                (scope == CLASS and name in (class_name, "~{}".format(class_name)))
+            if name and declared:
+                self.record(name, calls | qualifier_calls, first, last)
+            return
+        if scope == NAMESPACE:
+            for name in declarator_names(self.declarators(statement, start)):
+                self.record(name, calls, first, last)
+
+    # tokens of a declaration after its type, the body of a class defined in it is already removed
+    @staticmethod
+    def declarators(statement, start):
+        for position in range(len(statement) - 1, start - 1, -1):
+            if statement[position][KIND] == CLASS_BODY:
+                return statement[position + 1:]
+        return statement[start:]
+
+
+# Extract the includes and named units of C++ source code.
+# Returns (properties, spans) with the same structure as the extraction from srcml.
+def extract_source(source):
+    return Extractor(source).extract()
+
+
+# Extract a file, None if it can not be read
+def extract_file(path):
+    try:
+        source = path.read_bytes().decode("utf-8", "replace")
+    except OSError:
+        return None
+    return extract_source(source)